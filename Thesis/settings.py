@@ -16,6 +16,26 @@ from dotenv import load_dotenv
 load_dotenv()
 
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+# Giới hạn (ước lượng) số token dữ liệu tài chính đưa vào prompt chatbot
+CHATBOT_CONTEXT_TOKEN_BUDGET = int(os.getenv('CHATBOT_CONTEXT_TOKEN_BUDGET', 6000))
+# Số lời gọi Gemini chạy đồng thời tối đa trong mỗi tiến trình (daphne worker)
+CHATBOT_MAX_CONCURRENT_GENERATIONS = int(os.getenv('CHATBOT_MAX_CONCURRENT_GENERATIONS', 8))
+# Cache câu trả lời chatbot (LRU + TTL); SEMANTIC = True để tìm câu hỏi tương tự bằng ChromaDB
+CHATBOT_ANSWER_CACHE_SIZE = int(os.getenv('CHATBOT_ANSWER_CACHE_SIZE', 512))
+CHATBOT_ANSWER_CACHE_TTL = int(os.getenv('CHATBOT_ANSWER_CACHE_TTL', 3600))
+CHATBOT_ANSWER_CACHE_SEMANTIC = os.getenv('CHATBOT_ANSWER_CACHE_SEMANTIC', 'False') == 'True'
+# Chỉ số thị trường dùng để tính Beta: 'cap' (theo vốn hóa) hoặc 'equal' (bình quân đều)
+MARKET_INDEX_WEIGHTING = os.getenv('MARKET_INDEX_WEIGHTING', 'cap')
+# Backend LLM của FinAgent: gemini | record | replay | auto | stub (xem investment_advisor/llm_backends.py)
+FINAGENT_LLM_BACKEND = os.getenv('FINAGENT_LLM_BACKEND', 'gemini')
+FINAGENT_LLM_CASSETTE_DIR = os.getenv('FINAGENT_LLM_CASSETTE_DIR', 'llm_cassettes')
+FINAGENT_STUB_LATENCY = float(os.getenv('FINAGENT_STUB_LATENCY', 0))
+# Giới hạn gọi Gemini dùng chung cho FinAgent (theo quota của API key) + số lần thử lại khi 429 / 5xx
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv('GEMINI_REQUESTS_PER_MINUTE', 10))
+GEMINI_TOKENS_PER_MINUTE = int(os.getenv('GEMINI_TOKENS_PER_MINUTE', 250000))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', 5))
+# Cache embedding (hash nội dung -> vector) cho ký ức FinAgent
+FINAGENT_EMBEDDING_CACHE_PATH = os.getenv('FINAGENT_EMBEDDING_CACHE_PATH', './chroma_db_storage/embedding_cache.sqlite3')
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.contrib import messages
 from .models import *
+from .utils import refresh_financial_ratios
+from .data_cache import bump_data_version
 
 # --- PHẦN XỬ LÝ NÚT XÓA ---
 
@@ -27,6 +29,14 @@ def delete_table_data(modeladmin, request, queryset):
     # 4. Thực hiện xóa TOÀN BỘ dữ liệu chỉ của bảng này
     # Lệnh này tương đương: DELETE FROM ten_bang;
     current_model.objects.all().delete()
+
+    # Dữ liệu nguồn của chỉ số tài chính bị xóa -> dựng lại bảng chỉ số
+    if current_model in (CongTy, ThiTruongChungKhoang, TongHopTaiChinh, BangCanDoiKeToan, BangKetQuaKinhDoanh):
+        refresh_financial_ratios()
+    # Giá bị xóa -> trạng thái chỉ báo kỹ thuật không còn đúng
+    if current_model is ThiTruongChungKhoang:
+        TrangThaiChiBao.objects.all().delete()
+    bump_data_version()
     
     modeladmin.message_user(request, f"Đã xóa thành công toàn bộ {count} dòng dữ liệu trong bảng {model_name}.", level=messages.SUCCESS)
 
@@ -38,12 +48,28 @@ class CommonAdmin(admin.ModelAdmin):
     actions = [delete_table_data]
     list_per_page = 20
 
+    # Sửa / xóa từng dòng -> payload và chỉ báo kỹ thuật đã cache hết hiệu lực
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        bump_data_version()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        bump_data_version()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        bump_data_version()
+
 # Đăng ký từng bảng
 admin.site.register(CongTy, CommonAdmin)
 admin.site.register(ThiTruongChungKhoang, CommonAdmin)
 admin.site.register(TongHopTaiChinh, CommonAdmin)
 admin.site.register(BangCanDoiKeToan, CommonAdmin)
 admin.site.register(BangKetQuaKinhDoanh, CommonAdmin)
+admin.site.register(ChiSoTaiChinh, CommonAdmin)
+admin.site.register(TrangThaiChiBao, CommonAdmin)
+admin.site.register(BackfillTask, CommonAdmin)
 admin.site.register(Conversation, CommonAdmin)
 admin.site.register(Message, CommonAdmin)
 admin.site.register(TinTuc, CommonAdmin)
\ No newline at end of file
@@ -0,0 +1,187 @@
+# investment_advisor/answer_cache.py
+"""
+Cache câu trả lời của chatbot cho các câu hỏi lặp lại ("ROE của HPG?", ...).
+
+- Khóa: câu hỏi đã chuẩn hóa + phiên bản dữ liệu (data_cache). Khi có dữ liệu
+  tài chính mới, phiên bản đổi nên mọi câu trả lời cũ tự hết hiệu lực.
+- Tầng 1: LRU trong tiến trình (OrderedDict) có TTL.
+- Tầng 2 (tùy chọn, CHATBOT_ANSWER_CACHE_SEMANTIC = True): tìm câu hỏi tương tự
+  bằng embedding trong ChromaDB (cùng thư mục ./chroma_db_storage với FinAgentSystem).
+  Chỉ dùng lại khi 2 câu hỏi nhắc tới đúng cùng các mã CK, để "ROE của HPG?"
+  không trả lời nhầm cho "ROE của FPT?".
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .data_cache import aget_data_version
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_TTL_SECONDS = 60 * 60
+DEFAULT_MAX_DISTANCE = 0.08  # Khoảng cách cosine tối đa để coi là "cùng câu hỏi"
+CHROMA_PATH = "./chroma_db_storage"
+CHROMA_COLLECTION = "chatbot_answer_cache"
+
+
+def normalize_question(question):
+    """Chữ thường, bỏ dấu câu, gộp khoảng trắng (giữ dấu tiếng Việt)."""
+    return " ".join(re.findall(r"\w+", (question or "").lower()))
+
+
+class AnswerCache:
+    def __init__(self, max_entries=None, ttl_seconds=None, semantic=None, max_distance=None):
+        self.max_entries = max_entries or getattr(settings, 'CHATBOT_ANSWER_CACHE_SIZE', DEFAULT_MAX_ENTRIES)
+        self.ttl_seconds = ttl_seconds or getattr(settings, 'CHATBOT_ANSWER_CACHE_TTL', DEFAULT_TTL_SECONDS)
+        self.semantic = semantic if semantic is not None else getattr(settings, 'CHATBOT_ANSWER_CACHE_SEMANTIC', False)
+        self.max_distance = max_distance or getattr(settings, 'CHATBOT_ANSWER_CACHE_MAX_DISTANCE', DEFAULT_MAX_DISTANCE)
+
+        self._entries = OrderedDict()  # {(version, câu hỏi chuẩn hóa): (câu trả lời, hết hạn lúc)}
+        self._version = None
+        self._lock = threading.Lock()
+        self._collection = None
+
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    # ---------------- Tầng 1: LRU trong tiến trình ----------------
+    def _check_version(self, version):
+        # Dữ liệu đã đổi -> bỏ toàn bộ câu trả lời cũ
+        if self._version != version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._version = version
+
+    def _get_local(self, version, key):
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            answer, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return answer
+
+    def _set_local(self, version, key, answer):
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = (answer, time.time() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # ---------------- Tầng 2: tìm câu hỏi tương tự (ChromaDB) ----------------
+    def _get_collection(self):
+        if self._collection is None:
+            import chromadb  # Chỉ cần khi bật semantic cache
+            client = chromadb.PersistentClient(path=CHROMA_PATH)
+            self._collection = client.get_or_create_collection(
+                name=CHROMA_COLLECTION, metadata={"hnsw:space": "cosine"}
+            )
+        return self._collection
+
+    def _get_semantic(self, version, question, tickers):
+        results = self._get_collection().query(
+            query_texts=[question],
+            n_results=1,
+            where={"$and": [{"data_version": version}, {"tickers": tickers}]},
+        )
+        if not results["ids"] or not results["ids"][0]:
+            return None
+        distance = results["distances"][0][0]
+        meta = results["metadatas"][0][0]
+        if distance > self.max_distance or meta.get("expires_at", 0) < time.time():
+            return None
+        return meta.get("answer")
+
+    def _set_semantic(self, version, key, question, tickers, answer):
+        collection = self._get_collection()
+        # Xóa câu trả lời của các phiên bản dữ liệu cũ
+        collection.delete(where={"data_version": {"$ne": version}})
+        collection.upsert(
+            ids=[hashlib.sha1(f"{version}:{key}".encode()).hexdigest()],
+            documents=[question],
+            metadatas=[{
+                "data_version": version,
+                "tickers": tickers,
+                "answer": answer,
+                "expires_at": time.time() + self.ttl_seconds,
+            }],
+        )
+
+    # ---------------- API ----------------
+    async def aget(self, question, tickers=""):
+        """Câu trả lời đã cache cho câu hỏi (hoặc None). tickers: các mã CK được nhắc tới, VD "FPT,HPG"."""
+        version = await aget_data_version()
+        key = normalize_question(question)
+
+        answer = self._get_local(version, key)
+        if answer is not None:
+            self.hits += 1
+            return answer
+
+        if self.semantic:
+            try:
+                answer = await sync_to_async(self._get_semantic, thread_sensitive=False)(version, question, tickers)
+            except Exception as e:
+                logger.error(f"Lỗi tra cứu semantic cache: {e}")
+                answer = None
+            if answer is not None:
+                self.semantic_hits += 1
+                self._set_local(version, key, answer)
+                return answer
+
+        self.misses += 1
+        return None
+
+    async def aset(self, question, answer, tickers=""):
+        version = await aget_data_version()
+        key = normalize_question(question)
+        self._set_local(version, key, answer)
+
+        if self.semantic:
+            try:
+                await sync_to_async(self._set_semantic, thread_sensitive=False)(version, key, question, tickers, answer)
+            except Exception as e:
+                logger.error(f"Lỗi lưu semantic cache: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self):
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "semantic": self.semantic,
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.semantic_hits) / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+# Một cache cho mỗi tiến trình
+answer_cache = AnswerCache()
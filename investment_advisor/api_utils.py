@@ -0,0 +1,190 @@
+# investment_advisor/api_utils.py
+"""
+Tiện ích cho các API đọc dữ liệu lớn (giá ngày, BCTC):
+
+- fields=...   : chỉ lấy các cột cần dùng (projection)
+- cursor=...   : phân trang keyset (WHERE khóa > khóa cuối trang trước) thay cho
+                 OFFSET, nên trang sau cùng nhanh như trang đầu
+- format=...   : json (phân trang), ndjson / csv (stream toàn bộ, bộ nhớ không đổi
+                 theo kích thước bảng)
+"""
+import base64
+import csv
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+STREAM_CHUNK_SIZE = 2000
+STREAM_FORMATS = ('ndjson', 'csv')
+
+
+class ApiQueryError(ValueError):
+    """Tham số truy vấn không hợp lệ (trả về HTTP 400)."""
+
+
+def parse_list(request, name):
+    """?ticker=HPG,FPT&ticker=MWG -> ['HPG', 'FPT', 'MWG']"""
+    values = []
+    for raw in request.GET.getlist(name):
+        values.extend(part.strip() for part in raw.split(',') if part.strip())
+    return values
+
+
+def parse_int_list(request, name):
+    try:
+        return [int(value) for value in parse_list(request, name)]
+    except ValueError:
+        raise ApiQueryError(f"'{name}' phải là số nguyên.")
+
+
+def parse_date(request, name):
+    value = request.GET.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise ApiQueryError(f"'{name}' phải có dạng YYYY-MM-DD.")
+
+
+def parse_int(request, name, default, minimum, maximum):
+    value = request.GET.get(name)
+    if not value:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise ApiQueryError(f"'{name}' phải là số nguyên.")
+    if number < minimum or number > maximum:
+        raise ApiQueryError(f"'{name}' phải trong khoảng {minimum}..{maximum}.")
+    return number
+
+
+def parse_limit(request, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    return parse_int(request, 'limit', default, 1, maximum)
+
+
+def parse_choice(request, name, choices, default):
+    value = request.GET.get(name, default).lower()
+    if value not in choices:
+        raise ApiQueryError(f"'{name}' phải là một trong: {', '.join(choices)}.")
+    return value
+
+
+def parse_fields(request, model, required):
+    """
+    Danh sách cột (attname, VD 'congTy_id') cần trả về.
+    Chấp nhận cả tên field ('congTy') lẫn attname ('congTy_id'); các cột `required`
+    (khóa phân trang) luôn được thêm vào đầu.
+    """
+    attnames = {}
+    for field in model._meta.concrete_fields:
+        attnames[field.name] = field.attname
+        attnames[field.attname] = field.attname
+
+    requested = parse_list(request, 'fields')
+    if not requested:
+        columns = [field.attname for field in model._meta.concrete_fields]
+    else:
+        unknown = [name for name in requested if name not in attnames]
+        if unknown:
+            raise ApiQueryError(f"Trường không tồn tại: {', '.join(unknown)}")
+        columns = [attnames[name] for name in requested]
+
+    ordered = list(required)
+    ordered += [column for column in columns if column not in ordered]
+    return ordered
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, cls=DjangoJSONEncoder, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def cursor_text(value):
+    if not isinstance(value, str):
+        raise TypeError("không phải chuỗi")
+    return value
+
+
+def cursor_date(value):
+    return datetime.date.fromisoformat(value)
+
+
+def cursor_int(value):
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise TypeError("không phải số nguyên")
+    return int(value)
+
+
+def decode_cursor(token, parsers):
+    """
+    Giải mã cursor thành list giá trị (khóa của dòng cuối trang trước).
+
+    parsers: mỗi phần tử của cursor 1 hàm kiểm tra / chuyển kiểu (cursor_text, cursor_date,
+    cursor_int...). Sai số phần tử hoặc giá trị sai kiểu -> ApiQueryError (HTTP 400).
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ApiQueryError("'cursor' không hợp lệ.")
+    if not isinstance(values, list) or len(values) != len(parsers):
+        raise ApiQueryError("'cursor' không hợp lệ.")
+    try:
+        return [parse(value) for parse, value in zip(parsers, values)]
+    except (ValueError, TypeError):
+        raise ApiQueryError("'cursor' không hợp lệ.")
+
+
+def response_format(request):
+    fmt = request.GET.get('format', 'json').lower()
+    if fmt not in ('json',) + STREAM_FORMATS:
+        raise ApiQueryError("'format' phải là json, ndjson hoặc csv.")
+    return fmt
+
+
+def to_columnar(columns, rows):
+    """[(a1, b1), (a2, b2)] -> {'a': [a1, a2], 'b': [b1, b2]}"""
+    data = {column: [] for column in columns}
+    for row in rows:
+        for column, value in zip(columns, row):
+            data[column].append(value)
+    return data
+
+
+class _Echo:
+    """File giả cho csv.writer: write() trả về luôn chuỗi để stream."""
+
+    def write(self, value):
+        return value
+
+
+def stream_rows(rows, columns, fmt, filename):
+    """
+    StreamingHttpResponse NDJSON / CSV từ iterator các tuple (VD: values_list().iterator()).
+    Mỗi dòng được ghi ngay khi đọc từ DB, không giữ cả bảng trong bộ nhớ.
+    """
+    if fmt == 'csv':
+        writer = csv.writer(_Echo())
+
+        def generate():
+            yield writer.writerow(columns)
+            for row in rows:
+                yield writer.writerow(row)
+
+        response = StreamingHttpResponse(generate(), content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    else:
+        encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+        def generate():
+            for row in rows:
+                yield encoder.encode(dict(zip(columns, row))) + '\n'
+
+        response = StreamingHttpResponse(generate(), content_type='application/x-ndjson; charset=utf-8')
+    return response
@@ -0,0 +1,230 @@
+# investment_advisor/backfill.py
+"""
+Backfill market intelligence cho nhiều mã / nhiều ngày song song.
+
+- plan_backfill: tạo hàng đợi công việc (mã, ngày giao dịch) trong bảng BackfillTask.
+  Bảng này là checkpoint: công việc DONE không chạy lại, nên lệnh bị ngắt giữa chừng
+  chỉ cần chạy lại với cùng tham số để làm tiếp.
+- run_backfill: chạy hàng đợi trên ThreadPoolExecutor giới hạn số worker. Tốc độ gọi
+  Gemini do rate limiter chung (rate_limit.py) điều tiết, nên tăng worker không vượt quota.
+  Mặc định các ngày của cùng 1 mã chạy lần lượt theo thứ tự thời gian (ký ức quá khứ
+  có trước khi truy vấn), các mã khác nhau chạy song song.
+- Mỗi công việc lưu thời gian từng bước (data / lmi / retrieval / pmi) và tổng thời gian.
+- Khi agent bật bộ đệm ghi sau (memory_buffer.py), công việc xong phần LLM ở trạng thái
+  FLUSHING và chỉ thành DONE sau khi ký ức của nó đã được flush vào Chroma; bị ngắt /
+  flush lỗi thì công việc FLUSHING được chạy lại ở lần sau. Chạy theo thứ tự thì bộ đệm
+  được flush trước ngày kế tiếp của cùng mã (nên lệnh mặc định tắt bộ đệm trừ khi --unordered).
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.db import connections
+from django.db.models import F
+from django.utils import timezone
+
+from .models import BackfillTask, ThiTruongChungKhoang
+from .utils import get_formatted_news, get_formatted_financials, get_price_action
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+
+class BackfillError(RuntimeError):
+    """Công việc backfill thất bại (module LLM trả về rỗng)."""
+
+
+# ==========================================================
+# HÀNG ĐỢI / CHECKPOINT
+# ==========================================================
+def plan_backfill(symbols, start_date, end_date):
+    """
+    Thêm công việc PENDING cho mọi (mã, ngày có giá) trong khoảng; công việc đã có giữ nguyên.
+    Trả về số công việc mới.
+    """
+    pairs = (
+        ThiTruongChungKhoang.objects
+        .filter(congTy_id__in=symbols, ngay__range=(start_date, end_date))
+        .order_by().values_list('congTy_id', 'ngay').distinct()
+    )
+    existing = BackfillTask.objects.filter(
+        cong_ty_id__in=symbols, date__range=(start_date, end_date)
+    ).count()
+    BackfillTask.objects.bulk_create(
+        [BackfillTask(cong_ty_id=ma, date=ngay) for ma, ngay in pairs],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+    total = BackfillTask.objects.filter(cong_ty_id__in=symbols, date__range=(start_date, end_date)).count()
+    return total - existing
+
+
+def pending_tasks(symbols, start_date, end_date, retry_failed=False):
+    """
+    Công việc cần chạy, theo thứ tự (ngày, mã). RUNNING / FLUSHING còn sót từ lần chạy bị
+    ngắt (ký ức có thể chưa được ghi) được chạy lại; FAILED chỉ chạy lại khi retry_failed.
+    """
+    statuses = ['PENDING', 'RUNNING', 'FLUSHING'] + (['FAILED'] if retry_failed else [])
+    return list(
+        BackfillTask.objects
+        .filter(cong_ty_id__in=symbols, date__range=(start_date, end_date), status__in=statuses)
+        .order_by('date', 'cong_ty_id')
+        .values_list('id', 'cong_ty_id', 'date')
+    )
+
+
+def backfill_progress(symbols, start_date, end_date):
+    """Số công việc theo trạng thái: {'PENDING': .., 'DONE': .., ...}"""
+    rows = (
+        BackfillTask.objects
+        .filter(cong_ty_id__in=symbols, date__range=(start_date, end_date))
+        .order_by().values_list('status')
+    )
+    counts = {status: 0 for status, _ in BackfillTask.STATUS_CHOICES}
+    for (status,) in rows:
+        counts[status] += 1
+    return counts
+
+
+# ==========================================================
+# CHẠY 1 CÔNG VIỆC
+# ==========================================================
+def run_market_intelligence(agent, symbol, date):
+    """
+    LMI (tự lưu vào market_memory) -> Diversified Retrieval -> PMI cho 1 (mã, ngày);
+    kết quả PMI cũng được lưu vào market_memory (PMI_SUMMARY). Chạy lại ghi đè theo id.
+    Trả về dict thời gian từng bước (giây); lỗi -> BackfillError.
+    """
+    timings = {}
+    date_str = str(date)
+
+    start_time = time.perf_counter()
+    news = get_formatted_news(symbol, date)
+    fins = get_formatted_financials(symbol, date)
+    prices = get_price_action(symbol, date)
+    timings['data'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    latest_analysis = agent.run_latest_market_intelligence(symbol, date_str, news, fins, prices)
+    timings['lmi'] = time.perf_counter() - start_time
+    if not latest_analysis:
+        raise BackfillError("LMI thất bại")
+
+    start_time = time.perf_counter()
+    historical_context = agent.retrieve_past_market_intelligence(latest_analysis.get('queries', {}))
+    timings['retrieval'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    final_insight = agent.run_past_market_intelligence(latest_analysis, historical_context)
+    if not final_insight:
+        raise BackfillError("PMI thất bại (ký ức LMI đã được lưu, chạy lại sẽ ghi đè)")
+    agent.save_past_market_intelligence(symbol, date_str, final_insight)
+    timings['pmi'] = time.perf_counter() - start_time
+    return timings
+
+
+def _mark_flushed(task_id):
+    BackfillTask.objects.filter(id=task_id, status='FLUSHING').update(status='DONE')
+
+
+def _execute(agent, task_id, symbol, date):
+    """Chạy 1 công việc trong worker thread và cập nhật checkpoint. Trả về (task_id, ok, giây)."""
+    start_time = time.perf_counter()
+    try:
+        BackfillTask.objects.filter(id=task_id).update(status='RUNNING', started_at=timezone.now())
+        try:
+            timings = run_market_intelligence(agent, symbol, date)
+        except Exception as e:
+            duration = time.perf_counter() - start_time
+            logger.error(f"Backfill {symbol} {date}: {e}")
+            BackfillTask.objects.filter(id=task_id).update(
+                status='FAILED', error=str(e)[:2000], attempts=F('attempts') + 1,
+                duration_seconds=duration, finished_at=timezone.now(),
+            )
+            return task_id, False, duration
+
+        duration = time.perf_counter() - start_time
+        buffer = agent.memory_buffer
+        BackfillTask.objects.filter(id=task_id).update(
+            status='FLUSHING' if buffer is not None else 'DONE', error='', timings=timings,
+            attempts=F('attempts') + 1, duration_seconds=duration, finished_at=timezone.now(),
+        )
+        if buffer is not None:
+            # Checkpoint DONE chỉ sau khi ký ức của công việc đã vào Chroma
+            buffer.on_flushed(lambda: _mark_flushed(task_id))
+        return task_id, True, duration
+    finally:
+        # Mỗi worker thread có kết nối DB riêng -> đóng để không rò kết nối
+        connections.close_all()
+
+
+# ==========================================================
+# ĐIỀU PHỐI
+# ==========================================================
+def _flush_before_next(agent, symbol):
+    """
+    Chế độ theo thứ tự + bộ đệm ghi sau: flush trước khi chạy ngày kế tiếp của `symbol`,
+    để retrieval của ngày N+1 thấy ký ức ngày N. Flush lỗi -> False (không chạy tiếp mã
+    này; các ngày còn lại giữ PENDING cho lần chạy sau).
+    """
+    if agent.memory_buffer is None:
+        return True
+    try:
+        agent.memory_buffer.flush()
+        return True
+    except Exception as e:
+        logger.error(f"Backfill {symbol}: flush ký ức lỗi, dừng các ngày tiếp theo ({e})")
+        return False
+
+
+def run_backfill(agent, tasks, workers=DEFAULT_WORKERS, ordered=True, on_done=None, stop_event=None):
+    """
+    Chạy `tasks` (list (id, mã, ngày) như pending_tasks) trên `workers` thread.
+
+    ordered=True: mỗi mã tối đa 1 công việc đang chạy, theo thứ tự ngày; nếu agent bật bộ đệm
+                  ghi sau thì flush trước mỗi ngày kế tiếp của cùng mã (lô ghi nhỏ lại).
+    on_done(symbol, date, ok, seconds): callback sau mỗi công việc (in tiến độ).
+    stop_event: threading.Event; khi set thì không nhận công việc mới (Ctrl+C), chờ việc đang chạy xong.
+    Trả về (số công việc thành công, số thất bại).
+    """
+    queues = {}
+    for task_id, symbol, date in tasks:
+        queues.setdefault(symbol, deque()).append((task_id, symbol, date))
+    # Lượt chờ: mã có ngày sớm nhất được chạy trước
+    ready = deque(sorted(queues, key=lambda symbol: queues[symbol][0][2]))
+    flat = deque(tasks)
+    succeeded = failed = 0
+    stop_event = stop_event or threading.Event()
+
+    def next_task():
+        if not ordered:
+            return flat.popleft() if flat else None
+        if not ready:
+            return None
+        return queues[ready.popleft()].popleft()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backfill') as executor:
+        running = {}
+        while True:
+            while not stop_event.is_set() and len(running) < workers:
+                task = next_task()
+                if task is None:
+                    break
+                running[executor.submit(_execute, agent, *task)] = task
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task_id, symbol, date = running.pop(future)
+                _, ok, seconds = future.result()
+                succeeded += ok
+                failed += not ok
+                if ordered and queues[symbol] and _flush_before_next(agent, symbol):
+                    ready.append(symbol)
+                if on_done:
+                    on_done(symbol, date, ok, seconds)
+    return succeeded, failed
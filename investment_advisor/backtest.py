@@ -0,0 +1,408 @@
+# investment_advisor/backtest.py
+"""
+Backtest theo sự kiện trên giá ngày ThiTruongChungKhoang.
+
+- Mỗi phiên: chiến lược ra quyết định BUY / SELL / HOLD -> sổ tiền / cổ phiếu (Ledger)
+  khớp lệnh, áp dụng Rule #9 của Decision module (không đủ tiền thì không mua,
+  không có cổ phiếu thì không bán). Quyết định được ghi hàng loạt vào TradingDecision.
+- Chiến lược quy tắc (3 Strategy trong prompt Decision: MACD Crossover, KDJ + RSI,
+  Mean Reversion) tính tín hiệu dạng vector trên chuỗi chỉ báo (indicators.py), nên
+  vòng lặp chỉ còn cập nhật sổ trên mảng NumPy: nhiều năm dữ liệu chạy trong vài giây.
+- AgentStrategy gọi FinAgentSystem từng phiên (chậm, tốn API) với cùng sổ tài khoản.
+- Kết quả: đường vốn (equity), drawdown, lợi nhuận năm hóa, Sharpe.
+"""
+import math
+
+import numpy as np
+import pandas as pd
+from django.db import transaction
+
+from .indicators import get_indicators, summarize_technical_signals, describe_kline, describe_price_movements
+from .models import CongTy, ThiTruongChungKhoang, TradingDecision
+
+DEFAULT_CASH = 100_000_000  # 100 triệu VNĐ
+LOT_SIZE = 100              # Lô chẵn HOSE
+FEE_RATE = 0.0015           # Phí môi giới mỗi chiều
+SELL_TAX_RATE = 0.001       # Thuế TNCN khi bán
+TRADING_DAYS_PER_YEAR = 252
+PRICE_UNIT = 1000           # Giá trong DB tính theo nghìn VNĐ
+ACTIONS = ('BUY', 'SELL', 'HOLD')
+
+
+# ==========================================================
+# SỔ TÀI KHOẢN
+# ==========================================================
+class Ledger:
+    """Tiền mặt (VNĐ) + số cổ phiếu đang giữ của 1 mã. Mua toàn bộ tiền theo lô, bán toàn bộ."""
+
+    def __init__(self, cash=DEFAULT_CASH, position=0, lot_size=LOT_SIZE, fee_rate=FEE_RATE, sell_tax_rate=SELL_TAX_RATE):
+        self.cash = float(cash)
+        self.position = int(position)
+        self.lot_size = lot_size
+        self.fee_rate = fee_rate
+        self.sell_tax_rate = sell_tax_rate
+        self.trades = 0
+
+    def status(self):
+        return {"cash": round(float(self.cash), 2), "position": self.position}
+
+    def apply(self, action, price):
+        """
+        Khớp lệnh `action` tại giá `price` (VNĐ). Trả về (lệnh thực hiện, ghi chú).
+        Lệnh vi phạm Rule #9 bị đổi thành HOLD.
+        """
+        if action == 'BUY':
+            lots = int(self.cash // (price * self.lot_size * (1 + self.fee_rate))) if price > 0 else 0
+            if lots == 0:
+                return 'HOLD', "BUY blocked: cash is lower than the price of one lot."
+            shares = lots * self.lot_size
+            self.cash -= shares * price * (1 + self.fee_rate)
+            self.position += shares
+            self.trades += 1
+            return 'BUY', f"Bought {shares} shares at {price:,.0f} VND."
+        if action == 'SELL':
+            if self.position == 0:
+                return 'HOLD', "SELL blocked: no shares to sell."
+            shares = self.position
+            self.cash += shares * price * (1 - self.fee_rate - self.sell_tax_rate)
+            self.position = 0
+            self.trades += 1
+            return 'SELL', f"Sold {shares} shares at {price:,.0f} VND."
+        return 'HOLD', ""
+
+    def equity(self, price):
+        return self.cash + self.position * price
+
+
+# ==========================================================
+# CHIẾN LƯỢC QUY TẮC (tín hiệu vector)
+# ==========================================================
+def _cross_above(a, b):
+    return (a > b) & (a.shift(1) <= b.shift(1))
+
+
+def _cross_below(a, b):
+    return (a < b) & (a.shift(1) >= b.shift(1))
+
+
+class RuleStrategy:
+    """Chiến lược tính toàn bộ tín hiệu một lượt: signals(frame) -> Series 'BUY' / 'SELL' / 'HOLD'."""
+    name = "rule"
+
+    def buy_sell(self, frame):
+        raise NotImplementedError
+
+    def signals(self, frame):
+        buy, sell = self.buy_sell(frame)
+        actions = np.where(buy.fillna(False), 'BUY', np.where(sell.fillna(False), 'SELL', 'HOLD'))
+        return pd.Series(actions, index=frame.index)
+
+    def explain(self, row):
+        """Một dòng giải thích cho TradingDecision (analysis_log)."""
+        return ""
+
+
+class MACDCrossoverStrategy(RuleStrategy):
+    """Strategy 1: BUY khi DIF cắt lên DEA, SELL khi cắt xuống."""
+    name = "macd_crossover"
+
+    def buy_sell(self, frame):
+        return _cross_above(frame['dif'], frame['dea']), _cross_below(frame['dif'], frame['dea'])
+
+    def explain(self, row):
+        return f"MACD: DIF {row['dif']:.3f}, DEA {row['dea']:.3f}, Histogram {row['macd_hist']:+.3f}."
+
+
+class KDJRSIStrategy(RuleStrategy):
+    """Strategy 2: K cắt lên D khi RSI chưa quá mua -> BUY; K cắt xuống D khi RSI chưa quá bán -> SELL."""
+    name = "kdj_rsi"
+
+    def __init__(self, rsi_buy_max=50, rsi_sell_min=50):
+        self.rsi_buy_max = rsi_buy_max
+        self.rsi_sell_min = rsi_sell_min
+
+    def buy_sell(self, frame):
+        buy = _cross_above(frame['kdj_k'], frame['kdj_d']) & (frame['rsi'] <= self.rsi_buy_max)
+        sell = _cross_below(frame['kdj_k'], frame['kdj_d']) & (frame['rsi'] >= self.rsi_sell_min)
+        return buy, sell
+
+    def explain(self, row):
+        return f"KDJ: K {row['kdj_k']:.1f}, D {row['kdj_d']:.1f}, J {row['kdj_j']:.1f}; RSI(14) {row['rsi']:.1f}."
+
+
+class MeanReversionStrategy(RuleStrategy):
+    """Strategy 3: Z-score giá so với MA20 (độ lệch chuẩn Bollinger) < -z -> BUY, > z -> SELL."""
+    name = "mean_reversion"
+
+    def __init__(self, z_entry=2.0):
+        self.z_entry = z_entry
+
+    @staticmethod
+    def z_score(frame):
+        std = (frame['boll_upper'] - frame['boll_mid']) / 2
+        return (frame['close'] - frame['boll_mid']) / std.where(std > 0)
+
+    def buy_sell(self, frame):
+        z = self.z_score(frame)
+        return z < -self.z_entry, z > self.z_entry
+
+    def explain(self, row):
+        std = (row['boll_upper'] - row['boll_mid']) / 2
+        z = (row['close'] - row['boll_mid']) / std if std else float('nan')
+        return f"Mean Reversion: Z-score {z:+.2f} (close {row['close']:.2f}, MA20 {row['boll_mid']:.2f})."
+
+
+RULE_STRATEGIES = {
+    MACDCrossoverStrategy.name: MACDCrossoverStrategy,
+    KDJRSIStrategy.name: KDJRSIStrategy,
+    MeanReversionStrategy.name: MeanReversionStrategy,
+}
+
+
+# ==========================================================
+# CHIẾN LƯỢC AGENT (gọi Gemini từng phiên)
+# ==========================================================
+class AgentStrategy:
+    """
+    Mỗi phiên: LMI (tin tức + BCTC + giá) -> Decision module với tín hiệu kỹ thuật thật
+    và trạng thái tài khoản của sổ backtest. Các bước reflection (LLR/HLR) được thay
+    bằng mô tả giá / Kline từ indicators.py để giữ số lời gọi API ở mức 2 / phiên.
+    """
+    name = "agent"
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.history = []  # Quyết định BUY / SELL trong lần chạy này (chưa ghi DB)
+        self.label = self.name  # Tên chiến lược lưu trong TradingDecision (theo cách khớp lệnh)
+        self.start = None
+
+    def begin(self, label, start):
+        """run_backtest gọi trước phiên đầu: lịch sử DB chỉ đọc trước `start`, cùng `label`."""
+        self.label = label
+        self.start = start
+        self.history = []
+
+    def decide(self, symbol, date, frame, account_status):
+        from .utils import get_formatted_news, get_formatted_financials, get_price_action
+
+        date_str = str(date)
+        lmi_result = self.agent.run_latest_market_intelligence(
+            symbol, date_str,
+            get_formatted_news(symbol, date),
+            get_formatted_financials(symbol, date),
+            get_price_action(symbol, date),
+        )
+        market_intelligence = lmi_result.get('summary', 'N/A') if lmi_result else "N/A"
+        decision = self.agent.run_decision_making(
+            symbol=symbol,
+            date_str=date_str,
+            market_intelligence=market_intelligence,
+            llr_reflection=f"{describe_price_movements(frame)}\n{describe_kline(frame)}",
+            hlr_reflection=format_past_decisions(
+                symbol, self.start or date, strategy=self.label, recent=self.history
+            ),
+            technical_signals=summarize_technical_signals(frame),
+            account_status=account_status,
+        )
+        if not decision:
+            return {"action": "HOLD", "analysis": "", "reasoning": "Decision module failed -> HOLD."}
+        if str(decision.get('action', '')).upper() in ('BUY', 'SELL'):
+            self.history.append((date, decision['action'].upper(), decision.get('reasoning', '')))
+        return decision
+
+
+# ==========================================================
+# ENGINE
+# ==========================================================
+def performance_metrics(equity, trades=0, risk_free_rate=0.0):
+    """Lợi nhuận, lợi nhuận năm hóa, độ biến động, Sharpe (năm hóa), drawdown lớn nhất."""
+    if equity.empty:
+        return {}
+    returns = equity.pct_change().dropna()
+    drawdown = equity / equity.cummax() - 1
+    years = len(equity) / TRADING_DAYS_PER_YEAR
+    total_return = equity.iloc[-1] / equity.iloc[0] - 1
+    excess = returns - risk_free_rate / TRADING_DAYS_PER_YEAR
+    std = returns.std()
+    return {
+        "start_equity": float(equity.iloc[0]),
+        "end_equity": float(equity.iloc[-1]),
+        "total_return": float(total_return),
+        "annual_return": float((1 + total_return) ** (1 / years) - 1) if years > 0 and total_return > -1 else None,
+        "annual_volatility": float(std * math.sqrt(TRADING_DAYS_PER_YEAR)) if len(returns) > 1 else None,
+        "sharpe": float(excess.mean() / std * math.sqrt(TRADING_DAYS_PER_YEAR)) if len(returns) > 1 and std > 0 else None,
+        "max_drawdown": float(drawdown.min()),
+        "max_drawdown_date": drawdown.idxmin(),
+        "trades": trades,
+        "sessions": len(equity),
+    }
+
+
+def strategy_label(name, fill='close'):
+    """
+    Tên chiến lược ghi vào TradingDecision.strategy: khớp ở giá đóng cửa (mặc định) giữ
+    nguyên tên (VD 'agent', như account_status_before / format_past_decisions đọc),
+    khớp ở giá mở cửa phiên sau thêm hậu tố để 2 cách khớp không trộn lịch sử.
+    """
+    return name if fill == 'close' else f"{name}@{fill}"
+
+
+def run_backtest(symbol, strategy, start=None, end=None, initial_cash=DEFAULT_CASH,
+                 fill='close', record=True, replace=True, progress=None):
+    """
+    Chạy backtest `strategy` cho `symbol` trong [start, end].
+
+    strategy: RuleStrategy (nhanh, tín hiệu vector) hoặc đối tượng có decide(symbol, date,
+              frame, account_status) -> {"action", "analysis", "reasoning"} (VD AgentStrategy).
+    fill: 'close' = khớp ở giá đóng cửa phiên ra quyết định; 'next_open' = giá mở cửa phiên sau.
+    record: ghi mỗi phiên 1 dòng TradingDecision (trạng thái tài khoản lúc ra quyết định),
+            strategy = strategy_label(strategy.name, fill).
+    replace: xóa các dòng cũ của cùng mã / chiến lược / cách khớp / khoảng ngày trước khi ghi
+             (mặc định; False = ghi thêm, chạy lại sẽ có 2 bộ quyết định trùng ngày).
+    progress: callback(index, total, date) cho chiến lược chạy chậm.
+
+    Trả về dict {"equity": Series, "drawdown": Series, "metrics": dict, "decisions": list}.
+    """
+    symbol = symbol.upper()
+    frame = get_indicators(symbol)
+    # Giữ lịch sử trước `start` cho chỉ báo, chỉ giao dịch trong [start, end]
+    if end is not None:
+        frame = frame.loc[:end]
+    first = frame.index.searchsorted(start) if start is not None else 0
+    if first >= len(frame):
+        raise ValueError(f"Không có dữ liệu giá của {symbol} trong khoảng đã chọn.")
+
+    dates = frame.index
+    closes = frame['close'].to_numpy() * PRICE_UNIT
+    opens = frame['open'].to_numpy() * PRICE_UNIT
+    signals = strategy.signals(frame).to_numpy() if isinstance(strategy, RuleStrategy) else None
+    label = strategy_label(strategy.name, fill)
+    if hasattr(strategy, 'begin'):
+        strategy.begin(label, dates[first])
+
+    ledger = Ledger(initial_cash)
+    equity = np.empty(len(frame) - first)
+    company = CongTy(maChungKhoan=symbol)
+    decisions = []
+    pending = None  # (lệnh, lý do) chờ khớp ở giá mở cửa phiên sau (fill='next_open')
+
+    for step, i in enumerate(range(first, len(frame))):
+        if pending is not None:
+            # Kết quả khớp thật (có thể bị Rule #9 đổi thành HOLD) ghi vào quyết định phiên trước
+            executed, note = ledger.apply(pending[0], opens[i])
+            if record:
+                decisions[-1].action = executed
+                decisions[-1].final_reasoning = f"{pending[1]} {note}".strip()
+            pending = None
+
+        status = ledger.status()
+        if signals is not None:
+            action = signals[i]
+            row = frame.iloc[i] if record else None
+            analysis = strategy.explain(row) if record else ""
+            reasoning = f"{strategy.name}: {action} signal." if action != 'HOLD' else f"{strategy.name}: no signal."
+        else:
+            if progress:
+                progress(step, len(equity), dates[i])
+            result = strategy.decide(symbol, dates[i], frame.iloc[:i + 1], status)
+            action = str(result.get('action', 'HOLD')).upper()
+            action = action if action in ACTIONS else 'HOLD'
+            analysis = result.get('analysis', '')
+            reasoning = result.get('reasoning', '')
+
+        if fill == 'next_open':
+            # Khớp ở giá mở cửa phiên sau (Ledger.apply kiểm tra Rule #9 gồm cả phí lúc khớp)
+            executed, note = action, ""
+            if action != 'HOLD':
+                if i + 1 < len(frame):
+                    pending = (action, reasoning)
+                else:
+                    executed, note = 'HOLD', "Not filled: no next session to execute at the open."
+        else:
+            executed, note = ledger.apply(action, closes[i])
+
+        equity[step] = ledger.equity(closes[i])
+        if record:
+            decisions.append(TradingDecision(
+                cong_ty=company,
+                date=dates[i],
+                account_cash=status["cash"],
+                account_position=status["position"],
+                analysis_log=analysis,
+                action=executed,
+                final_reasoning=f"{reasoning} {note}".strip(),
+                strategy=label,
+            ))
+
+    equity = pd.Series(equity, index=pd.to_datetime(dates[first:]))
+    if record and decisions:
+        with transaction.atomic():
+            if replace:
+                TradingDecision.objects.filter(
+                    cong_ty__maChungKhoan=symbol, strategy=label,
+                    date__range=(dates[first], dates[-1]),
+                ).delete()
+            save_decisions(symbol, decisions)
+
+    return {
+        "equity": equity,
+        "drawdown": equity / equity.cummax() - 1,
+        "metrics": performance_metrics(equity, ledger.trades),
+        "decisions": decisions,
+    }
+
+
+def save_decisions(symbol, decisions):
+    """Ghi hàng loạt TradingDecision (FK cong_ty dùng id của CongTy)."""
+    company = CongTy.objects.get(maChungKhoan=symbol)
+    for decision in decisions:
+        decision.cong_ty = company
+    TradingDecision.objects.bulk_create(decisions, batch_size=1000)
+
+
+# ==========================================================
+# TRẠNG THÁI TÀI KHOẢN / LỊCH SỬ QUYẾT ĐỊNH CHO AGENT
+# ==========================================================
+def account_status_before(symbol, date, strategy=AgentStrategy.name, initial_cash=DEFAULT_CASH):
+    """
+    Trạng thái tài khoản trước phiên `date`: lấy TradingDecision gần nhất trước đó (cùng
+    `strategy`) và khớp lệnh của nó ở giá đóng cửa ngày đó. Chưa có lịch sử -> tiền mặt ban đầu.
+    """
+    last = (
+        TradingDecision.objects
+        .filter(cong_ty__maChungKhoan=symbol, strategy=strategy, date__lt=date)
+        .order_by('-date', '-created_at')
+        .first()
+    )
+    if last is None:
+        return {"cash": initial_cash, "position": 0}
+    ledger = Ledger(last.account_cash, last.account_position)
+    close = (
+        ThiTruongChungKhoang.objects
+        .filter(congTy_id=symbol, ngay=last.date)
+        .values_list('giaDongCua', flat=True)
+        .first()
+    )
+    if close:
+        ledger.apply(last.action, float(close) * PRICE_UNIT)
+    return ledger.status()
+
+
+def format_past_decisions(symbol, date, strategy=AgentStrategy.name, recent=(), limit=5):
+    """
+    Các quyết định BUY / SELL gần nhất trước `date` dạng text cho High-Level Reflection.
+    recent: list (ngày, lệnh, lý do) chưa ghi DB (quyết định của lần backtest đang chạy);
+            backtest truyền `date` = phiên đầu để không đọc dòng cũ trong khoảng đang chạy lại.
+    """
+    items = list(recent)[-limit:]
+    if len(items) < limit:
+        rows = (
+            TradingDecision.objects
+            .filter(cong_ty__maChungKhoan=symbol, strategy=strategy, date__lt=min(items[0][0], date) if items else date)
+            .exclude(action='HOLD')
+            .order_by('-date')
+            .values_list('date', 'action', 'final_reasoning')[:limit - len(items)]
+        )
+        items = list(reversed(rows)) + items
+    lines = [f"{day}: {action} - {reasoning[:200]}" for day, action, reasoning in items]
+    return "\n".join(lines) if lines else "No past trading decisions recorded."
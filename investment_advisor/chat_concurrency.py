@@ -0,0 +1,90 @@
+# investment_advisor/chat_concurrency.py
+"""
+Giới hạn số lời gọi Gemini chạy đồng thời trong một tiến trình (daphne worker).
+
+Mỗi câu hỏi chat phải lấy 1 "slot" trước khi gọi Gemini. Khi hết slot, câu hỏi
+xếp hàng chờ trên event loop (không chiếm thread), nên một worker phục vụ được
+nhiều cuộc chat cùng lúc mà không bị nghẽn đầu hàng.
+
+Số slot: settings.CHATBOT_MAX_CONCURRENT_GENERATIONS (mặc định 8).
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+DEFAULT_MAX_CONCURRENT = 8
+
+
+class GenerationLimiter:
+    """Semaphore theo tiến trình + số liệu hàng đợi (queue depth, thời gian chờ)."""
+
+    def __init__(self, max_concurrent=None):
+        self._max_concurrent = max_concurrent
+        self._semaphore = None
+        self._loop = None
+        self.waiting = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_waiting = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    @property
+    def max_concurrent(self):
+        if self._max_concurrent is None:
+            self._max_concurrent = getattr(settings, 'CHATBOT_MAX_CONCURRENT_GENERATIONS', DEFAULT_MAX_CONCURRENT)
+        return self._max_concurrent
+
+    def _get_semaphore(self):
+        # asyncio.Semaphore gắn với event loop -> tạo lại nếu loop đổi (VD: khi test)
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+            self._loop = loop
+        return self._semaphore
+
+    @asynccontextmanager
+    async def slot(self):
+        semaphore = self._get_semaphore()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        start_time = time.perf_counter()
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        waited = time.perf_counter() - start_time
+        self.total_wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self.active += 1
+        try:
+            yield
+        except BaseException:
+            self.failed += 1
+            raise
+        else:
+            self.completed += 1
+        finally:
+            self.active -= 1
+            semaphore.release()
+
+    def metrics(self):
+        finished = self.completed + self.failed
+        return {
+            "max_concurrent": self.max_concurrent,
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait_ms": round(self.total_wait_seconds / finished * 1000, 2) if finished else 0.0,
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 2),
+        }
+
+
+# Một limiter cho mỗi tiến trình
+gemini_limiter = GenerationLimiter()
@@ -0,0 +1,238 @@
+# investment_advisor/chat_context.py
+"""
+Chọn dữ liệu chỉ số tài chính đưa vào prompt của chatbot.
+
+Thay vì nhồi toàn bộ get_financial_ratios_data() vào mỗi câu hỏi, chỉ lấy các
+công ty được nhắc tới (mã CK, tên công ty, ngành). Nếu câu hỏi không nhắc tới
+công ty nào thì dùng bản tóm tắt theo ngành / toàn thị trường. Kích thước context
+luôn bị giới hạn bởi CHATBOT_CONTEXT_TOKEN_BUDGET.
+"""
+import json
+import re
+import statistics
+import unicodedata
+
+from django.conf import settings
+
+from .data_cache import aget_data_version
+from .models import CongTy
+from .utils import aget_financial_ratios_data
+
+DEFAULT_TOKEN_BUDGET = 6000
+CHARS_PER_TOKEN = 3  # Ước lượng thận trọng cho JSON + tiếng Việt
+
+# Các cụm từ chung trong tên công ty, bỏ đi khi so khớp tên
+COMPANY_NAME_PREFIXES = [
+    "cong ty co phan", "cong ty tnhh", "cong ty", "ctcp", "tap doan", "tong cong ty",
+    "ngan hang thuong mai co phan", "ngan hang tmcp", "ngan hang",
+]
+SUMMARY_KEYS = ["ROA", "ROE", "PE", "PB", "TangTruongLoiNhuan", "HeSoNoTrenTongTaiSan"]
+
+_directory_cache = {}
+
+
+def get_token_budget():
+    return getattr(settings, 'CHATBOT_CONTEXT_TOKEN_BUDGET', DEFAULT_TOKEN_BUDGET)
+
+
+def normalize_text(text):
+    """Chữ thường, bỏ dấu tiếng Việt, gộp khoảng trắng."""
+    text = (text or "").lower().replace("đ", "d")
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    text = re.sub(r"[^a-z0-9]+", " ", text)
+    return f" {text.strip()} "
+
+
+def _core_company_name(name):
+    normalized = normalize_text(name)
+    for prefix in COMPANY_NAME_PREFIXES:
+        normalized = normalized.replace(f" {prefix} ", " ")
+    return normalized.strip()
+
+
+def _directory_entry(ma, ten, nganh):
+    return {
+        "ma": ma,
+        "ten": _core_company_name(ten),
+        "nganh": normalize_text(nganh).strip() if nganh else "",
+        "nganh_goc": nganh or "Khác",
+    }
+
+
+def _directory_queryset():
+    return CongTy.objects.exclude(maChungKhoan='a').values_list('maChungKhoan', 'tenCongTy', 'nganh')
+
+
+def _cached_directory(version):
+    cached = _directory_cache.get('directory')
+    if cached and cached[0] == version:
+        return cached[1]
+    return None
+
+
+async def aget_company_directory():
+    """
+    Danh sách công ty (mã, tên rút gọn, ngành) đã chuẩn hóa, cache theo phiên bản dữ liệu (async ORM).
+    """
+    version = await aget_data_version()
+    directory = _cached_directory(version)
+    if directory is not None:
+        return directory
+
+    directory = [_directory_entry(*row) async for row in _directory_queryset()]
+    _directory_cache['directory'] = (version, directory)
+    return directory
+
+
+def find_mentioned_companies(question, directory):
+    """
+    Trả về (danh sách mã được nhắc tới theo thứ tự xuất hiện, danh sách ngành được nhắc tới).
+    """
+    codes = {entry["ma"] for entry in directory}
+    normalized_question = normalize_text(question)
+
+    mentioned = []
+
+    def add(ma):
+        if ma not in mentioned:
+            mentioned.append(ma)
+
+    # 1. Mã chứng khoán (HPG, fpt...)
+    for token in re.findall(r"[A-Za-z0-9]{3,10}", question):
+        if token.upper() in codes:
+            add(token.upper())
+
+    # 2. Tên công ty (bỏ dấu: "hòa phát" -> "hoa phat")
+    for entry in directory:
+        if len(entry["ten"]) >= 4 and f" {entry['ten']} " in normalized_question:
+            add(entry["ma"])
+
+    # 3. Ngành nghề -> toàn bộ công ty cùng ngành
+    sectors = []
+    for entry in directory:
+        sector = entry["nganh"]
+        if sector and sector not in sectors and f" {sector} " in normalized_question:
+            sectors.append(sector)
+    for entry in directory:
+        if entry["nganh"] in sectors:
+            add(entry["ma"])
+
+    return mentioned, sectors
+
+
+async def amentioned_tickers(question):
+    """Các mã CK được nhắc tới trong câu hỏi, dạng chuỗi "FPT,HPG" (dùng làm khóa cache)."""
+    mentioned, _ = find_mentioned_companies(question, await aget_company_directory())
+    return ",".join(sorted(mentioned))
+
+
+def _compact(value):
+    if isinstance(value, float):
+        return round(value, 4)
+    return value
+
+
+def _compact_company(company_data, max_years=None):
+    reports = company_data.get("annual_reports", {})
+    years = sorted(reports.keys(), reverse=True)
+    if max_years is not None:
+        years = years[:max_years]
+    return {
+        "tenCongTy": company_data.get("tenCongTy"),
+        "annual_reports": {
+            year: {key: _compact(value) for key, value in reports[year].items()}
+            for year in sorted(years)
+        },
+    }
+
+
+def _dumps(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def build_market_summary(data, directory, sectors=None):
+    """
+    Tóm tắt gọn theo ngành: số công ty, trung vị các chỉ số năm gần nhất,
+    và 3 công ty ROE cao nhất mỗi ngành.
+    """
+    sector_of = {entry["ma"]: entry["nganh_goc"] for entry in directory}
+    latest_year = max((year for company in data.values() for year in company["annual_reports"]), default=None)
+    if latest_year is None:
+        return {}
+
+    groups = {}
+    for ma, company in data.items():
+        report = company["annual_reports"].get(latest_year)
+        if not report:
+            continue
+        sector = sector_of.get(ma, "Khác")
+        if sectors and normalize_text(sector).strip() not in sectors:
+            continue
+        groups.setdefault(sector, []).append((ma, report))
+
+    summary = {"nam": latest_year, "nganh": {}}
+    for sector, items in sorted(groups.items(), key=lambda item: -len(item[1])):
+        medians = {}
+        for key in SUMMARY_KEYS:
+            values = [report[key] for _, report in items if isinstance(report.get(key), (int, float))]
+            if values:
+                medians[key] = _compact(float(statistics.median(values)))
+        top_roe = sorted(items, key=lambda item: item[1].get("ROE") or 0, reverse=True)[:3]
+        summary["nganh"][sector] = {
+            "soCongTy": len(items),
+            "trungVi": medians,
+            "topROE": [ma for ma, _ in top_roe],
+        }
+    return summary
+
+
+def _select_companies(data, mentioned, budget_chars):
+    """Lấy dữ liệu các công ty được nhắc tới, thêm lần lượt cho tới khi hết ngân sách."""
+    selected = {}
+    for ma in mentioned:
+        if ma not in data:
+            continue
+        # Nếu quá ngân sách thì rút bớt số năm
+        for max_years in (None, 3, 1):
+            candidate = dict(selected)
+            candidate[ma] = _compact_company(data[ma], max_years)
+            if len(_dumps(candidate)) <= budget_chars:
+                selected = candidate
+                break
+        else:
+            break
+    if selected:
+        return _dumps(selected), "các công ty được nhắc tới trong câu hỏi"
+    return None
+
+
+def _summary_context(data, directory, sectors, budget_chars):
+    """Không nhắc tới công ty cụ thể -> tóm tắt theo ngành / toàn thị trường."""
+    if not data:
+        return "", ""
+    summary = build_market_summary(data, directory, sectors or None)
+    context = _dumps(summary)
+    while len(context) > budget_chars and summary.get("nganh"):
+        # Bỏ ngành ít công ty nhất cho tới khi vừa ngân sách
+        summary["nganh"].pop(list(summary["nganh"])[-1])
+        context = _dumps(summary)
+    return context, "tóm tắt trung vị chỉ số theo ngành (năm gần nhất)"
+
+
+async def abuild_ratio_context(question, token_budget=None):
+    """
+    Dựng chuỗi context JSON cho câu hỏi, không vượt quá token_budget (ước lượng).
+    Trả về (context, mô tả phạm vi dữ liệu). Dùng async ORM, không chiếm thread.
+    """
+    budget_chars = (token_budget or get_token_budget()) * CHARS_PER_TOKEN
+    directory = await aget_company_directory()
+    mentioned, sectors = find_mentioned_companies(question, directory)
+
+    if mentioned:
+        data = await aget_financial_ratios_data(company_codes=mentioned)
+        selected = _select_companies(data, mentioned, budget_chars)
+        if selected:
+            return selected
+
+    return _summary_context(await aget_financial_ratios_data(), directory, sectors, budget_chars)
@@ -1,23 +1,20 @@
 # your_app/consumers.py
 import json
+import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async # Rất quan trọng!
 
-# --- Import hàm Gemini của bạn ---
-# Giả sử bạn đặt hàm call_gemini trong file "gemini_utils.py"
-# (Bạn cần tạo file này và dán hàm call_gemini vào)
-from .utils import call_gemini 
-
-# --- Wrapper để gọi hàm đồng bộ (blocking) ---
-# Hàm call_gemini của bạn là hàm đồng bộ (blocking).
-# Gọi nó trực tiếp trong consumer (async) sẽ làm treo server.
-# @sync_to_async sẽ chạy hàm đó trong một thread riêng.
-@sync_to_async
-def async_call_gemini(prompt: str) -> str:
-    return call_gemini(prompt)
+# --- Hàm Gemini (async-first) ---
+# acall_gemini / stream_gemini dùng client.aio + async ORM nên chạy thẳng trên
+# event loop, không cần sync_to_async (vốn dồn mọi user vào 1 thread).
+# Số lời gọi đồng thời bị giới hạn bởi gemini_limiter (semaphore theo tiến trình).
+from .utils import acall_gemini, stream_gemini
+from .chat_concurrency import gemini_limiter
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    # Task sinh câu trả lời đang chạy của kết nối này (để hủy khi client ngắt)
+    generation_task = None
+
     # Được gọi khi client kết nối
     async def connect(self):
         await self.accept()
@@ -29,30 +26,86 @@ class ChatConsumer(AsyncWebsocketConsumer):
     # Được gọi khi client ngắt kết nối
     async def disconnect(self, close_code):
         print(f"WebSocket đã đóng với code: {close_code}", flush=True)
+        # Hủy câu trả lời đang sinh dở -> Gemini dừng stream, không tốn quota
+        await self.cancel_generation()
+
+    async def cancel_generation(self, notify=False):
+        task = self.generation_task
+        if task and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            if notify:
+                # Câu trả lời cũ sẽ không có bot_done / error -> báo client đóng bong bóng đang stream
+                await self.send(text_data=json.dumps({'type': 'bot_cancelled'}))
+        self.generation_task = None
 
     # Được gọi khi client gửi tin nhắn
     async def receive(self, text_data):
         try:
             text_data_json = json.loads(text_data)
             prompt = text_data_json['message']
+            # Mặc định stream; client cũ có thể gửi "stream": false để nhận 1 lần bot_response
+            use_stream = text_data_json.get('stream', True)
+
+            # Mỗi kết nối chỉ sinh 1 câu trả lời tại một thời điểm: câu hỏi mới thay câu cũ
+            # (client nhận bot_cancelled cho câu cũ trước các frame của câu mới).
+            await self.cancel_generation(notify=True)
+
+            # Gửi tin nhắn "Bot đang gõ..." về client (kèm số câu hỏi đang chờ trong hàng đợi)
+            await self.send(text_data=json.dumps({
+                'type': 'bot_loading',
+                'queue_depth': gemini_limiter.waiting
+            }))
+
+            # Chạy trong task riêng để receive() trả về ngay và disconnect() có thể hủy nó.
+            handler = self.stream_response if use_stream else self.send_full_response
+            self.generation_task = asyncio.create_task(handler(prompt))
+
+        except Exception as e:
+            # Gửi lỗi về client nếu có
+            await self.send_error(e)
+
+    async def stream_response(self, prompt):
+        try:
+            parts = []
+            async for text in stream_gemini(prompt):
+                parts.append(text)
+                await self.send(text_data=json.dumps({
+                    'type': 'bot_chunk',
+                    'message': text
+                }))
 
-            # Gửi tin nhắn "Bot đang gõ..." về client
+            # Kết thúc: gửi kèm toàn văn để client render Markdown / lưu lịch sử
             await self.send(text_data=json.dumps({
-                'type': 'bot_loading'
+                'type': 'bot_done',
+                'message': ''.join(parts)
             }))
+        except asyncio.CancelledError:
+            print("Đã hủy câu trả lời đang stream.", flush=True)
+            raise
+        except Exception as e:
+            await self.send_error(e)
 
-            # Gọi Gemini một cách an toàn (bất đồng bộ)
-            bot_response = await async_call_gemini(prompt)
+    async def send_full_response(self, prompt):
+        try:
+            # Gọi Gemini (async, không chặn event loop)
+            bot_response = await acall_gemini(prompt)
 
             # Gửi phản hồi của bot về client
             await self.send(text_data=json.dumps({
                 'type': 'bot_response',
                 'message': bot_response
             }))
-            
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            # Gửi lỗi về client nếu có
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': str(e)
-            }))
\ No newline at end of file
+            await self.send_error(e)
+
+    async def send_error(self, error):
+        await self.send(text_data=json.dumps({
+            'type': 'error',
+            'message': str(error)
+        }))
@@ -0,0 +1,107 @@
+# investment_advisor/data_cache.py
+"""
+Cache 2 tầng (trong tiến trình + cache dùng chung của Django) cho các payload
+được dựng từ dữ liệu tài chính.
+
+Mọi payload được gắn với một "phiên bản dữ liệu" (data version). Phiên bản này
+được đổi mỗi khi có dữ liệu mới được ghi (các view post_*_data, nút xóa trong
+admin, refresh_financial_ratios...), nên payload cũ tự động hết hiệu lực mà
+không cần đoán TTL.
+
+Lưu ý: cache mặc định của Django là LocMemCache (riêng từng tiến trình). Khi chạy
+nhiều worker/instance, cấu hình CACHES dùng chung (Redis, Memcached, DB...) để
+việc đổi phiên bản có hiệu lực ở tất cả các tiến trình.
+"""
+import gzip
+import hashlib
+import threading
+import uuid
+
+from django.core.cache import cache
+
+DATA_VERSION_KEY = "investment_advisor:data_version"
+PAYLOAD_KEY_PREFIX = "investment_advisor:payload"
+PAYLOAD_TIMEOUT = 60 * 60 * 24  # Payload tự hết hạn sau 1 ngày nếu không bị đổi phiên bản
+
+# Tầng 1: cache trong tiến trình {name: (version, payload)}
+_local_payloads = {}
+_local_lock = threading.Lock()
+
+
+def get_data_version():
+    """Phiên bản dữ liệu hiện tại (chuỗi ngẫu nhiên, đổi mỗi lần có dữ liệu mới)."""
+    version = cache.get(DATA_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        # add() chỉ ghi nếu chưa có -> tránh 2 tiến trình ghi đè nhau
+        if not cache.add(DATA_VERSION_KEY, version, timeout=None):
+            version = cache.get(DATA_VERSION_KEY) or version
+    return version
+
+
+async def aget_data_version():
+    """Bản async của get_data_version (cho consumer / code chạy trên event loop)."""
+    version = await cache.aget(DATA_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not await cache.aadd(DATA_VERSION_KEY, version, timeout=None):
+            version = await cache.aget(DATA_VERSION_KEY) or version
+    return version
+
+
+def bump_data_version():
+    """Đánh dấu dữ liệu đã thay đổi: mọi payload đã cache sẽ bị bỏ qua."""
+    version = uuid.uuid4().hex
+    cache.set(DATA_VERSION_KEY, version, timeout=None)
+    with _local_lock:
+        _local_payloads.clear()
+    return version
+
+
+class CachedPayload:
+    """Payload JSON đã serialize sẵn (kèm bản gzip và ETag)."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.gzipped = gzip.compress(raw, compresslevel=6)
+        self.etag = '"%s"' % hashlib.sha1(raw).hexdigest()
+
+
+def get_cached_payload(name, builder):
+    """
+    Lấy payload `name` của phiên bản dữ liệu hiện tại.
+
+    builder: hàm không tham số trả về bytes JSON, chỉ được gọi khi cả 2 tầng cache
+    đều chưa có payload của phiên bản này.
+    """
+    version = get_data_version()
+
+    local = _local_payloads.get(name)
+    if local and local[0] == version:
+        return local[1]
+
+    with _local_lock:
+        local = _local_payloads.get(name)
+        if local and local[0] == version:
+            return local[1]
+
+        # Tầng 2: cache dùng chung
+        shared_key = f"{PAYLOAD_KEY_PREFIX}:{name}:{version}"
+        payload = cache.get(shared_key)
+        if payload is None:
+            payload = CachedPayload(builder())
+            cache.set(shared_key, payload, timeout=PAYLOAD_TIMEOUT)
+
+        _local_payloads[name] = (version, payload)
+        return payload
+
+
+def etag_matches(request, etag):
+    """Kiểm tra header If-None-Match của request có khớp ETag không."""
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in header.split(",")]
+    return any(tag == etag or tag == f"W/{etag}" for tag in candidates)
@@ -0,0 +1,116 @@
+# investment_advisor/embedding_cache.py
+"""
+Cache embedding bền vững theo hash nội dung (SQLite), dùng chung cho ghi ký ức và truy vấn.
+
+Khóa = sha256(tên model + văn bản): cùng một đoạn văn bản chỉ được embed một lần
+qua mọi lần chạy (query lặp lại, document upsert lại không đổi nội dung).
+Vector lưu dạng float32 bytes. Đổi model embedding -> khóa khác, không dùng nhầm vector cũ.
+
+Đường dẫn: settings.FINAGENT_EMBEDDING_CACHE_PATH.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from django.conf import settings
+
+DEFAULT_CACHE_PATH = "./chroma_db_storage/embedding_cache.sqlite3"
+SQLITE_MAX_VARIABLES = 900  # Dưới giới hạn 999 tham số / câu lệnh của SQLite cũ
+
+
+def _model_name(embedding_function):
+    """Tên ổn định của model embedding (Chroma EF có name() / MODEL_NAME)."""
+    for attr in ('MODEL_NAME', 'model_name'):
+        value = getattr(embedding_function, attr, None)
+        if isinstance(value, str):
+            return value
+    try:
+        return str(embedding_function.name())
+    except Exception:
+        return type(embedding_function).__name__
+
+
+def content_hash(model, text):
+    return hashlib.sha256(f"{model}\0{text}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """Bảng SQLite (hash -> vector float32). An toàn khi nhiều thread dùng chung."""
+
+    def __init__(self, path=None):
+        self.path = path or getattr(settings, 'FINAGENT_EMBEDDING_CACHE_PATH', DEFAULT_CACHE_PATH)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get_many(self, keys):
+        """dict {hash: np.ndarray} cho các khóa đã có."""
+        found = {}
+        keys = list(keys)
+        with self._lock:
+            for start in range(0, len(keys), SQLITE_MAX_VARIABLES):
+                chunk = keys[start:start + SQLITE_MAX_VARIABLES]
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE hash IN ({','.join('?' * len(chunk))})", chunk
+                )
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, items):
+        """items: iterable (hash, vector)."""
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (hash, vector) VALUES (?, ?)", rows)
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbedder:
+    """
+    Bọc embedding function của Chroma: tra cache trước, chỉ embed (1 lô) các văn bản
+    chưa có, lưu lại rồi trả về vector đúng thứ tự đầu vào.
+    """
+
+    def __init__(self, embedding_function, cache=None):
+        self.embedding_function = embedding_function
+        self.cache = cache or EmbeddingCache()
+        self.model = _model_name(embedding_function)
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, texts):
+        texts = list(texts)
+        keys = [content_hash(self.model, text) for text in texts]
+        vectors = self.cache.get_many(set(keys))
+
+        # Văn bản chưa có trong cache (bỏ trùng lặp trong cùng lô)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            computed = self.embedding_function(list(missing.values()))
+            new_items = list(zip(missing, computed))
+            self.cache.put_many(new_items)
+            vectors.update((key, np.asarray(vector, dtype=np.float32)) for key, vector in new_items)
+
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+        return [vectors[key] for key in keys]
@@ -0,0 +1,335 @@
+# investment_advisor/file_formats.py
+"""
+Đọc file dữ liệu xuất từ cafef / vietstock (CSV, XLS, XLSX) thành DataFrame đã
+chuẩn hóa theo tên cột của model. Dùng bởi lệnh `manage.py load_market_data`.
+
+Bảng ánh xạ tiêu đề BCTC giống hệt headerMap trong templates/file/file_upload.html,
+nên file nạp qua trình duyệt hay qua lệnh đều cho cùng một kết quả.
+"""
+import os
+import re
+
+import pandas as pd
+
+# ==========================================================
+# ÁNH XẠ TIÊU ĐỀ CỘT -> TÊN TRƯỜNG
+# ==========================================================
+BALANCE_SHEET_HEADERS = {
+    # Định danh
+    'ma': 'ma',
+    'years': 'years',
+    'Quý': 'quy',
+
+    # Tài sản ngắn hạn
+    'A TÀI SẢN NGẮN HẠN': 'taiSanNganHan',
+    'Tiền và các khoản tương đương tiền': 'tienVaCacKhoanTuongDuongTien',
+    'Tiền': 'tien',
+    'Các khoản tương đương tiền': 'cacKhoanTuongDuongTien',
+    'Các khoản đầu tư tài chính ngắn hạn': 'cacKhoanDauTuTaiChinhNganHan',
+    'Chứng khoán kinh doanh': 'chungKhoanKinhDoanh',
+    'Dự phòng giảm giá chứng khoán kinh doanh': 'duPhongGiamGiaChungKhoanKinhDoanh',
+    'Đầu tư nắm giữ đến ngày đáo hạn': 'dauTuNamGiuDenNgayDaoHanNH',
+    'Các khoản phải thu ngắn hạn': 'cacKhoanPhaiThuNganHan',
+    'Phải thu ngắn hạn của khách hàng': 'phaiThuNganHanCuaKhachHang',
+    'Trả trước cho người bán ngắn hạn': 'traTruocChoNguoiBanNganHan',
+    'Phải thu nội bộ ngắn hạn': 'phaiThuNoiBoNganHan',
+    'Phải thu theo tiến độ kế hoạch hợp đồng xây dựng': 'phaiThuTheoTienDoKeHoachHopDongXayDung',
+    'Phải thu về cho vay ngắn hạn': 'phaiThuVeChoVayNganHan',
+    'Phải thu ngắn hạn khác': 'phaiThuNganHanKhac',
+    'Dự phòng phải thu ngắn hạn khó đòi': 'duPhongPhaiThuNganHanKhoDoi',
+    'Tài sản Thiếu chờ xử lý': 'taiSanThieuChoXuLy',
+    'Hàng tồn kho': 'hangTonKho',
+    'Dự phòng giảm giá hàng tồn kho': 'duPhongGiamGiaHangTonKho',
+    'Tài sản ngắn hạn khác': 'taiSanNganHanKhac',
+    'Chi phí trả trước ngắn hạn': 'chiPhiTraTruocNganHan',
+    'Thuế GTGT được khấu trừ': 'thueGTGTDuocKhauTru',
+    'Thuế và các khoản khác phải thu Nhà nước': 'thueVaCacKhoanKhacPhaiThuNhaNuoc',
+    'Giao dịch mua bán lại trái phiếu Chính phủ': 'giaoDichMuaBanLaiTraiPhieuChinhPhu',
+
+    # Tài sản dài hạn
+    'TÀI SẢN DÀI HẠN': 'taiSanDaiHan',
+    'Các khoản phải thu dài hạn': 'cacKhoanPhaiThuDaiHan',
+    'Phải thu dài hạn của khách hàng': 'phaiThuDaiHanCuaKhachHang',
+    'Trả trước cho người bán dài hạn': 'traTruocChoNguoiBanDaiHan',
+    'Vốn kinh doanh ở đơn vị trực thuộc': 'vonKinhDoanhODonViTrucThuoc',
+    'Phải thu nội bộ dài hạn': 'phaiThuNoiBoDaiHan',
+    'Phải thu về cho vay dài hạn': 'phaiThuVeChoVayDaiHan',
+    'Phải thu dài hạn khác': 'phaiThuDaiHanKhac',
+    'Dự phòng phải thu dài hạn khó đòi': 'duPhongPhaiThuDaiHanKhoDoi',
+    'Tài sản cố định': 'taiSanCoDinh',
+    'Tài sản cố định hữu hình': 'taiSanCoDinhHuuHinh',
+    'Nguyên giá': 'nguyenGia',
+    'Giá trị hao mòn lũy kế': 'giaTriHaoMonLuyKe',
+    'Tài sản cố định thuê tài chính': 'taiSanCoDinhThueTaiChinh',
+    'Tài sản cố định vô hình': 'taiSanCoDinhVoHinh',
+    'Bất động sản đầu tư': 'batDongSanDauTu',
+    'Tài sản dở dang dài hạn': 'taiSanDoDangDaiHan',
+    'Chi phí sản xuất kinh doanh dở dang dài hạn': 'chiPhiSanXuatKinhDoanhDoDangDaiHan',
+    'Chi phí xây dựng cơ bản dở dang': 'chiPhiXayDungCoBanDoDang',
+    'Đầu tư tài chính dài hạn': 'dauTuTaiChinhDaiHan',
+    'Đầu tư vào công ty con': 'dauTuVaoCongTyCon',
+    'Đầu tư vào công ty liên kết liên doanh': 'dauTuVaoCongTyLienKetLienDoanh',
+    'Đầu tư góp vốn vào đơn vị khác': 'dauTuGopVonVaoDonViKhac',
+    'Dự phòng đầu tư tài chính dài hạn': 'duPhongDauTuTaiChinhDaiHan',
+    'Tài sản dài hạn khác': 'taiSanDaiHanKhac',
+    'Chi phí trả trước dài hạn': 'chiPhiTraTruocDaiHan',
+    'Tài sản thuế thu nhập hoãn lại': 'taiSanThueThuNhapHoanLai',
+    'Thiết bị vật tư phụ tùng thay thế dài hạn': 'thietBiVatTuPhuTungThayTheDaiHan',
+    'Lợi thế thương mại': 'loiTheThuongMai',
+    'TỔNG CỘNG TÀI SẢN': 'tongCongTaiSan',
+
+    # Nợ phải trả
+    'NỢ PHẢI TRẢ': 'noPhaiTra',
+    'Nợ ngắn hạn': 'noNganHan',
+    'Phải trả người bán ngắn hạn': 'phaiTraNguoiBanNganHan',
+    'Người mua trả tiền trước ngắn hạn': 'nguoiMuaTraTienTruocNganHan',
+    'Thuế và các khoản phải nộp nhà nước': 'thueVaCacKhoanPhaiNopNhaNuoc',
+    'Phải trả người lao động': 'phaiTraNguoiLaoDong',
+    'Chi phí phải trả ngắn hạn': 'chiPhiPhaiTraNganHan',
+    'Phải trả nội bộ ngắn hạn': 'phaiTraNoiBoNganHan',
+    'Phải trả theo tiến độ kế hoạch hợp đồng xây dựng': 'phaiTraTheoTienDoKeHoachHopDongXayDungNH',
+    'Doanh thu chưa thực hiện ngắn hạn': 'doanhThuChuaThucHienNganHan',
+    'Phải trả ngắn hạn khác': 'phaiTraNganHanKhac',
+    'Vay và nợ thuê tài chính ngắn hạn': 'vayVaNoThueTaiChinhNganHan',
+    'Dự phòng phải trả ngắn hạn': 'duPhongPhaiTraNganHan',
+    'Quỹ khen thưởng phúc lợi': 'quyKhenThuongPhucLoi',
+    'Quỹ bình ổn giá': 'quyBinhOnGia',
+    'Nợ dài hạn': 'noDaiHan',
+    'Phải trả người bán dài hạn': 'phaiTraNguoiBanDaiHan',
+    'Người mua trả tiền trước dài hạn': 'nguoiMuaTraTienTruocDaiHan',
+    'Chi phí phải trả dài hạn': 'chiPhiPhaiTraDaiHan',
+    'Phải trả nội bộ về vốn kinh doanh': 'phaiTraNoiBoVeVonKinhDoanh',
+    'Phải trả nội bộ dài hạn': 'phaiTraNoiBoDaiHan',
+    'Doanh thu chưa thực hiện dài hạn': 'doanhThuChuaThucHienDaiHan',
+    'Phải trả dài hạn khác': 'phaiTraDaiHanKhac',
+    'Vay và nợ thuê tài chính dài hạn': 'vayVaNoThueTaiChinhDaiHan',
+    'Trái phiếu chuyển đổi': 'traiPhieuChuyenDoi',
+    'Cổ phiếu ưu đãi': 'coPhieuUuDai',
+    'Thuế thu nhập hoãn lại phải trả': 'thueThuNhapHoanLaiPhaiTra',
+    'Dự phòng phải trả dài hạn': 'duPhongPhaiTraDaiHan',
+    'Quỹ phát triển khoa học và công nghệ': 'quyPhatTrienKhoaHocVaCongNghe',
+
+    # Vốn chủ sở hữu
+    'VỐN CHỦ SỞ HỮU': 'vonChuSoHuu',
+    'Vốn chủ sở hữu': 'vonChuSoHuuCon',
+    'Vốn góp của chủ sở hữu': 'vonGopCuaChuSoHuu',
+    'Thặng dư vốn cổ phần': 'thangDuVonCoPhan',
+    'Quyền chọn chuyển đổi trái phiếu': 'quyenChonChuyenDoiTraiPhieu',
+    'Vốn khác của chủ sở hữu': 'vonKhacCuaChuSoHuu',
+    'Cổ phiếu quỹ': 'coPhieuQuy',
+    'Chênh lệch đánh giá lại tài sản': 'chenhLechDanhGiaLaiTaiSan',
+    'Chênh lệch tỷ giá hối đoái': 'chenhLechTyGiaHoiDoai',
+    'Quỹ đầu tư phát triển': 'quyDauTuPhatTrien',
+    'Quỹ hỗ trợ sắp xếp doanh nghiệp': 'quyHoTroSapXepDoanhNghiep',
+    'Quỹ khác thuộc vốn chủ sở hữu': 'quyKhacThuocVonChuSoHuu',
+    'Lợi nhuận sau thuế chưa phân phối': 'loiNhuanSauThueChuaPhanPhoi',
+    'Nguồn vốn đầu tư XDCB': 'nguonVonDauTuXDCB',
+    'Lợi ích cổ đông không kiểm soát': 'loiIchCoDongKhongKiemSoat',
+    'Nguồn kinh phí và quỹ khác': 'nguonKinhPhiVaQuyKhac',
+    'Nguồn kinh phí': 'nguonKinhPhi',
+    'Nguồn kinh phí đã hình thành TSCĐ': 'nguonKinhPhiDaHinhThanhTSCD',
+    'TỔNG CỘNG NGUỒN VỐN': 'tongCongNguonVon',
+
+}
+
+INCOME_STATEMENT_HEADERS = {
+    # Định danh
+    'ma': 'ma',
+    'years': 'years',
+    'Quý': 'quy',
+
+    # Các chỉ tiêu KQKD
+    'Doanh thu bán hàng và cung cấp dịch vụ': 'doanhThuBanHangVaCungCapDichVu',
+    'Các khoản giảm trừ doanh thu': 'cacKhoanGiamTruDoanhThu',
+    'Doanh thu thuần về bán hàng và cung cấp dịch vụ': 'doanhThuThuan',
+    'Giá vốn hàng bán': 'giaVonHangBan',
+    'Lợi nhuận gộp về bán hàng và cung cấp dịch vụ': 'loiNhuanGop',
+    'Doanh thu hoạt động tài chính': 'doanhThuHoatDongTaiChinh',
+    'Chi phí tài chính': 'chiPhiTaiChinh',
+    'Trong đó Chi phí lãi vay': 'trongDoChiPhiLaiVay',
+    'Phần lãi lỗ trong công ty liên doanh liên kết': 'phanLaiLoTrongCongTyLienDoanhLienKet',
+    'Chi phí bán hàng': 'chiPhiBanHang',
+    'Chi phí quản lý doanh nghiệp': 'chiPhiQuanLyDoanhNghiep',
+    'Lợi nhuận thuần từ hoạt động kinh doanh': 'loiNhuanThuanTuHoatDongKinhDoanh',
+    'Thu nhập khác': 'thuNhapKhac',
+    'Chi phí khác': 'chiPhiKhac',
+    'Lợi nhuận khác': 'loiNhuanKhac',
+    'Tổng lợi nhuận kế toán trước thuế': 'tongLoiNhuanKeToanTruocThue',
+    'Chi phí thuế TNDN hiện hành': 'chiPhiThueTNDNHienHanh',
+    'Chi phí thuế TNDN hoãn lại': 'chiPhiThueTNDNHoanLai',
+    'Lợi nhuận sau thuế thu nhập doanh nghiệp': 'loiNhuanSauThueThuNhapDoanhNghiep',
+
+}
+
+# File giá cafef (CSV, tiêu đề 2 tầng đã gộp bằng "_")
+CAFEF_PRICE_HEADERS = {
+    'Ngày': 'ngay',
+    'Ma': 'congTy',
+    'Giá (nghìn VNĐ)_Đóng cửa': 'giaDongCua',
+    'Giá (nghìn VNĐ)_Điều chỉnh': 'giaDieuChinh',
+    'Thay đổi': 'thayDoi',
+    'GD khớp lệnh_Khối lượng': 'klKhopLenh',
+    'GD khớp lệnh_Giá trị (tỷ VNĐ)': 'gtKhopLenh',
+    'GD thỏa thuận_Khối lượng': 'klThoaThuan',
+    'GD thỏa thuận_Giá trị (tỷ VNĐ)': 'gtThoaThuan',
+    'Giá (nghìn VNĐ)_Mở cửa': 'giaMoCua',
+    'Giá (nghìn VNĐ)_Cao nhất': 'giaCaoNhat',
+    'Giá (nghìn VNĐ)_Thấp nhất': 'giaThapNhat',
+}
+
+# File "Thống kê giá" của vietstock (XLS, VD: Agent/result/KQGD-102-ThongKeGia-*.xls)
+# Giá theo nghìn VNĐ, "Thay đổi giá" theo VNĐ, giá trị giao dịch theo triệu VNĐ.
+VIETSTOCK_PRICE_HEADERS = {
+    'Ngày': 'ngay',
+    'Mã': 'congTy',
+    'Mở cửa': 'giaMoCua',
+    'Đóng cửa': 'giaDongCua',
+    'Cao nhất': 'giaCaoNhat',
+    'Thấp nhất': 'giaThapNhat',
+    'Thay đổi giá_+/-': 'thayDoi',
+    'GD khớp lệnh_KL': 'klKhopLenh',
+    'GD khớp lệnh_GT': 'gtKhopLenh',
+    'GD thỏa thuận_KL': 'klThoaThuan',
+    'GD thỏa thuận_GT': 'gtThoaThuan',
+}
+VIETSTOCK_SCALE = {
+    'thayDoi': 1 / 1000,      # VNĐ -> nghìn VNĐ
+    'gtKhopLenh': 1 / 1000,   # triệu VNĐ -> tỷ VNĐ
+    'gtThoaThuan': 1 / 1000,
+}
+
+PRICE_COLUMNS = [
+    'congTy', 'ngay', 'giaDongCua', 'giaDieuChinh', 'thayDoi', 'klKhopLenh', 'gtKhopLenh',
+    'klThoaThuan', 'gtThoaThuan', 'giaMoCua', 'giaCaoNhat', 'giaThapNhat',
+]
+PRICE_INTEGER_COLUMNS = ['klKhopLenh', 'klThoaThuan']
+
+STATEMENT_HEADERS = {
+    'balance': BALANCE_SHEET_HEADERS,
+    'income': INCOME_STATEMENT_HEADERS,
+}
+
+EXCEL_EXTENSIONS = ('.xls', '.xlsx')
+
+
+def _clean_header(value):
+    """Gộp khoảng trắng / xuống dòng trong tiêu đề ("Đóng\n cửa" -> "Đóng cửa")."""
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return ''
+    return re.sub(r'\s+', ' ', str(value)).strip()
+
+
+def _to_number(series):
+    """'1,234' / '-0.6(-0.44 %)' / '' -> số (NaN nếu rỗng)."""
+    if series.dtype != object:
+        return pd.to_numeric(series, errors='coerce')
+    text = series.astype(str).str.strip().str.replace(',', '', regex=False)
+    # Giữ phần số đầu tiên (cột "Thay đổi" của cafef có dạng "-0.6(-0.44 %)")
+    text = text.str.extract(r'^([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)', expand=False)
+    return pd.to_numeric(text, errors='coerce')
+
+
+def _read_chunks(path, chunk_size, header=0):
+    """Đọc file theo từng khối (CSV đọc dạng stream, Excel đọc 1 lần rồi chia khối)."""
+    if path.lower().endswith(EXCEL_EXTENSIONS):
+        # Cần xlrd (.xls) hoặc openpyxl (.xlsx)
+        frame = pd.read_excel(path, header=header, dtype=object)
+        for start in range(0, len(frame), chunk_size):
+            yield frame.iloc[start:start + chunk_size]
+    else:
+        yield from pd.read_csv(
+            path, header=header, dtype=str, chunksize=chunk_size,
+            skip_blank_lines=True, encoding='utf-8-sig',
+        )
+
+
+# ==========================================================
+# FILE GIÁ
+# ==========================================================
+def _is_vietstock_layout(path):
+    if not path.lower().endswith(EXCEL_EXTENSIONS):
+        return False
+    head = pd.read_excel(path, header=None, nrows=2, dtype=object)
+    first_row = [_clean_header(value) for value in head.iloc[0]]
+    return 'STT' in first_row and 'Mã' in first_row
+
+
+def _vietstock_columns(path):
+    """Gộp tiêu đề 2 tầng của vietstock: "GD khớp lệnh" + "KL" -> "GD khớp lệnh_KL"."""
+    head = pd.read_excel(path, header=None, nrows=2, dtype=object)
+    columns, group = [], ''
+    for top, sub in zip(head.iloc[0], head.iloc[1]):
+        top, sub = _clean_header(top), _clean_header(sub)
+        if top:
+            group = top
+        if sub and group:
+            columns.append(f"{group}_{sub}")
+        else:
+            columns.append(top)
+    return columns
+
+
+def _normalize_prices(frame, header_map, scale=None, dayfirst=True):
+    frame = frame.rename(columns=lambda h: header_map.get(_clean_header(h), _clean_header(h)))
+    result = pd.DataFrame(index=frame.index)
+    result['congTy'] = frame['congTy'].astype(str).str.strip().str.upper() if 'congTy' in frame else None
+    result['ngay'] = pd.to_datetime(frame.get('ngay'), dayfirst=dayfirst, errors='coerce').dt.date
+
+    for column in PRICE_COLUMNS[2:]:
+        values = _to_number(frame[column]) if column in frame else pd.Series(float('nan'), index=frame.index)
+        if scale and column in scale:
+            values = values * scale[column]
+        result[column] = values
+
+    if result['giaDieuChinh'].isna().all():
+        # File không có giá điều chỉnh (vietstock) -> dùng giá đóng cửa
+        result['giaDieuChinh'] = result['giaDongCua']
+    for column in PRICE_INTEGER_COLUMNS:
+        result[column] = result[column].round().astype('Int64')
+
+    valid = result['congTy'].notna() & (result['congTy'] != '') & (result['congTy'] != 'NAN') & result['ngay'].notna()
+    return result[valid], int((~valid).sum())
+
+
+def read_price_file(path, chunk_size):
+    """
+    Sinh lần lượt (DataFrame cột PRICE_COLUMNS, số dòng bị bỏ) cho file giá
+    cafef (CSV) hoặc vietstock (XLS).
+    """
+    if _is_vietstock_layout(path):
+        columns = _vietstock_columns(path)
+        for chunk in _read_chunks(path, chunk_size, header=None):
+            chunk = chunk.iloc[2:] if chunk.index[0] == 0 else chunk
+            chunk.columns = columns
+            yield _normalize_prices(chunk, VIETSTOCK_PRICE_HEADERS, VIETSTOCK_SCALE, dayfirst=False)
+    else:
+        for chunk in _read_chunks(path, chunk_size):
+            yield _normalize_prices(chunk, CAFEF_PRICE_HEADERS)
+
+
+# ==========================================================
+# FILE BCTC (Bảng CĐKT / Bảng KQKD)
+# ==========================================================
+def read_statement_file(path, kind, chunk_size, value_fields):
+    """
+    Sinh lần lượt (DataFrame cột 'ma', 'nam', 'quy' + value_fields, số dòng bị bỏ).
+    Ô trống được ghi 0 (giống trang upload).
+    """
+    header_map = STATEMENT_HEADERS[kind]
+    for chunk in _read_chunks(path, chunk_size):
+        chunk = chunk.rename(columns=lambda h: header_map.get(_clean_header(h), _clean_header(h)))
+        result = pd.DataFrame(index=chunk.index)
+        result['ma'] = chunk['ma'].astype(str).str.strip().str.upper() if 'ma' in chunk else None
+        result['nam'] = _to_number(chunk['years']) if 'years' in chunk else float('nan')
+        result['quy'] = _to_number(chunk['quy']) if 'quy' in chunk else float('nan')
+        for column in value_fields:
+            if column in chunk:
+                result[column] = _to_number(chunk[column]).fillna(0).round().astype('int64')
+
+        valid = result['ma'].notna() & (result['ma'] != '') & (result['ma'] != 'NAN') & result['nam'].notna() & result['quy'].notna()
+        result = result[valid].astype({'nam': 'int64', 'quy': 'int64'})
+        yield result, int((~valid).sum())
+
+
+def describe_file(path):
+    return f"{os.path.basename(path)} ({os.path.getsize(path) / 1024:.0f} KB)"
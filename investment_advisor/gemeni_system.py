@@ -1,43 +1,224 @@
 import os
-import google.genai as genai
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
 from Thesis import settings
 import chromadb
+from chromadb.utils import embedding_functions
 from django.conf import settings
+from .llm_backends import get_backend
+from .embedding_cache import CachedEmbedder
+from .memory_buffer import DEFAULT_CHROMA_BATCH_SIZE, DEFAULT_MAX_RECORDS, MemoryWriteBuffer
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_CHROMA_PATH = "./chroma_db_storage"
+
 class FinAgentSystem:  # ĐÃ ĐỔI TÊN TỪ FinAgentMarketIntelligence
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, backend=None, chroma_path=None, chroma_client=None):
         """
         Khởi tạo hệ thống FinAgent với đa tầng ký ức.
+        backend: LLMBackend (llm_backends.py); None -> theo settings.FINAGENT_LLM_BACKEND
+        (mặc định Gemini thật, cần GEMINI_API_KEY).
+        chroma_client / chroma_path: nơi lưu ký ức; mặc định kho thật ./chroma_db_storage.
+        Benchmark / thử nghiệm truyền chromadb.EphemeralClient() để không ghi đè ký ức thật.
         """
-        # 1. Xử lý API Key
-        if not api_key:
-            api_key = os.environ.get("GEMINI_API_KEY") or getattr(settings, 'GEMINI_API_KEY', None)
-        
-        if not api_key:
-            raise ValueError("Vui lòng đặt GEMINI_API_KEY trong biến môi trường hoặc settings.py.")
-
-        # 2. Khởi tạo Client (New SDK)
-        self.client = genai.Client(api_key=api_key)
+        # 1-2. Backend LLM (Gemini / record-replay / stub)
+        self.backend = backend or get_backend(api_key=api_key)
         self.model_name = "gemini-2.5-flash" 
 
         # 3. Cấu hình Vector DB (ChromaDB)
         # PersistentClient giúp dữ liệu không bị mất khi restart server
-        self.chroma_client = chromadb.PersistentClient(path="./chroma_db_storage")
+        self.chroma_client = chroma_client or chromadb.PersistentClient(path=chroma_path or DEFAULT_CHROMA_PATH)
+        # Embedding mặc định của Chroma, giữ 1 instance để tính trước embedding khi ghi theo lô
+        self.embedding_function = embedding_functions.DefaultEmbeddingFunction()
+        # Mọi ghi / truy vấn ký ức embed qua cache theo hash nội dung (không embed lại cùng văn bản)
+        self.embedder = CachedEmbedder(self.embedding_function)
         
         # --- KHỞI TẠO 3 TẦNG KÝ ỨC ---
         # Tầng 1: Market Intelligence (Tin tức & Sự kiện vĩ mô)
-        self.market_memory = self.chroma_client.get_or_create_collection(name="market_memory")
+        self.market_memory = self.chroma_client.get_or_create_collection(
+            name="market_memory", embedding_function=self.embedding_function
+        )
         
         # Tầng 2: Low-Level Reflection (Mối quan hệ Tin tức - Giá)
-        self.low_level_memory = self.chroma_client.get_or_create_collection(name="low_level_memory")
+        self.low_level_memory = self.chroma_client.get_or_create_collection(
+            name="low_level_memory", embedding_function=self.embedding_function
+        )
         
         # Tầng 3: High-Level Reflection (Kinh nghiệm/Chiến lược giao dịch)
-        self.high_level_memory = self.chroma_client.get_or_create_collection(name="high_level_memory")
+        self.high_level_memory = self.chroma_client.get_or_create_collection(
+            name="high_level_memory", embedding_function=self.embedding_function
+        )
+
+        # Bộ đệm ghi sau (None = ghi ngay từng lần như cũ), bật bằng enable_memory_buffer()
+        self.memory_buffer = None
+
+    # =========================================================================
+    # GHI KÝ ỨC (trực tiếp hoặc qua bộ đệm ghi theo lô)
+    # =========================================================================
+
+    def enable_memory_buffer(self, max_records=DEFAULT_MAX_RECORDS):
+        """Gom các upsert ký ức và ghi theo lô (embedding tính trước). Nhớ gọi flush_memories() / close()."""
+        if self.memory_buffer is None:
+            try:
+                max_batch_size = self.chroma_client.get_max_batch_size()
+            except Exception:
+                max_batch_size = DEFAULT_CHROMA_BATCH_SIZE
+            self.memory_buffer = MemoryWriteBuffer(
+                {
+                    "market_memory": self.market_memory,
+                    "low_level_memory": self.low_level_memory,
+                    "high_level_memory": self.high_level_memory,
+                },
+                embed_documents=self.embed_documents,
+                max_records=max_records,
+                max_batch_size=max_batch_size,
+            )
+        return self.memory_buffer
+
+    def embed_documents(self, texts):
+        return self.embedder(texts)
+
+    def flush_memories(self):
+        """Ghi mọi ký ức đang chờ trong bộ đệm. Trả về số bản ghi."""
+        return self.memory_buffer.flush() if self.memory_buffer else 0
+
+    def close(self):
+        return self.flush_memories()
+
+    def _upsert_memory(self, collection_name, documents, metadatas, ids):
+        if self.memory_buffer is not None:
+            self.memory_buffer.add(collection_name, ids, documents, metadatas)
+        else:
+            getattr(self, collection_name).upsert(
+                documents=documents, metadatas=metadatas, ids=ids,
+                embeddings=self.embed_documents(documents),
+            )
+
+    def _query_memory(self, collection, query_text, n_results, where=None, embedding=None):
+        """collection.query với embedding lấy từ cache (thay cho query_texts)."""
+        kwargs = {"where": where} if where else {}
+        if embedding is None:
+            embedding = self.embed_documents([query_text])[0]
+        return collection.query(
+            query_embeddings=[embedding],
+            n_results=n_results,
+            **kwargs
+        )
+
+    # =========================================================================
+    # TRUY XUẤT KÝ ỨC GỘP (Diversified Retrieval + PLLR + PHLR)
+    # =========================================================================
+
+    # Query LMI -> nhãn duration trong market_memory (Top K = 1 mỗi duration)
+    MARKET_QUERY_DURATIONS = {
+        "short_term_query": "SHORT-TERM",
+        "medium_term_query": "MEDIUM-TERM",
+        "long_term_query": "LONG-TERM",
+    }
+
+    def retrieve_all(self, market_queries=None, llr_query=None, hlr_query=None, current_market_context=None):
+        """
+        Truy xuất mọi ký ức cần cho 1 bước agent trong 1 vòng:
+        - embed tất cả query (3 duration LMI, query LLR, query / context PHLR) bằng 1 lô
+        - các lời gọi Chroma chạy đồng thời (mỗi duration 1 query vì khác bộ lọc `where`)
+
+        Query nào không có thì phần tương ứng trả về thông báo như các hàm retrieve_* riêng lẻ.
+        Trả về dict:
+            historical_context: context cho PMI (Diversified Retrieval)
+            pllr: các reflection quá khứ tương tự (Top 2)
+            phlr: các bài học HLR quá khứ (Top 2)
+        """
+        # 1. Danh sách truy vấn: (khóa, collection, văn bản, n_results, where)
+        specs = []
+        for q_key, duration_label in self.MARKET_QUERY_DURATIONS.items():
+            q_text = (market_queries or {}).get(q_key)
+            if q_text:
+                specs.append((duration_label, self.market_memory, q_text, 1, {"duration": duration_label}))
+        if llr_query:
+            specs.append(("pllr", self.low_level_memory, llr_query, 2, None))
+        # Ưu tiên dùng context hiện tại để tìm bài học cũ
+        phlr_query = current_market_context or hlr_query
+        if phlr_query:
+            specs.append(("phlr", self.high_level_memory, phlr_query, 2, None))
+
+        # 2. Embed 1 lô (qua cache) rồi query đồng thời
+        # (lỗi của từng truy vấn được giữ trong results, phần định dạng trả thông báo lỗi tương ứng)
+        def query(spec, embedding):
+            key, collection, q_text, n_results, where = spec
+            try:
+                return key, self._query_memory(collection, q_text, n_results, where=where, embedding=embedding)
+            except Exception as e:
+                logger.error(f"Error retrieving {key}: {e}")
+                return key, e
+
+        results = {}
+        if specs:
+            try:
+                embeddings = self.embed_documents([spec[2] for spec in specs])
+            except Exception as e:
+                logger.error(f"Error embedding retrieval queries: {e}")
+                embeddings = None
+                results = {spec[0]: e for spec in specs}
+            if embeddings is not None and len(specs) == 1:
+                results = dict([query(specs[0], embeddings[0])])
+            elif embeddings is not None:
+                with ThreadPoolExecutor(max_workers=len(specs), thread_name_prefix='retrieval') as executor:
+                    results = dict(executor.map(query, specs, embeddings))
+
+        # 3. Định dạng context cho từng module
+        return {
+            "historical_context": self._format_market_context(results),
+            "pllr": self._format_past_reflections(results, llr_query),
+            "phlr": self._format_past_lessons(results, phlr_query),
+        }
+
+    def _format_market_context(self, results):
+        context_list = []
+        for duration_label in self.MARKET_QUERY_DURATIONS.values():
+            found = results.get(duration_label)
+            if found is None or isinstance(found, Exception):
+                continue
+            if found['documents'] and found['documents'][0]:
+                found_doc = found['documents'][0][0]
+                found_date = found['metadatas'][0][0]['date']
+                context_list.append(f"- Past ({duration_label} pattern from {found_date}): {found_doc}")
+        return "\n".join(context_list) if context_list else "No relevant history found (Cold start)."
+
+    @staticmethod
+    def _format_past_reflections(results, query_text):
+        if not query_text:
+            return "No query generated for retrieval."
+        found = results.get("pllr")
+        if isinstance(found, Exception):
+            return "Error retrieving history."
+        context_list = []
+        if found['documents']:
+            for doc, meta in zip(found['documents'][0], found['metadatas'][0]):
+                context_list.append(f"- Past Reflection ({meta['date']}): {doc}")
+        return "\n".join(context_list) if context_list else "No similar past reflections found."
+
+    @staticmethod
+    def _format_past_lessons(results, query_text):
+        if not query_text:
+            return "No query provided for PHLR retrieval."
+        found = results.get("phlr")
+        if isinstance(found, Exception):
+            return "Error retrieving HLR history."
+        context_list = []
+        if found['documents']:
+            for doc, meta in zip(found['documents'][0], found['metadatas'][0]):
+                context_list.append(f"--- LESSON LEARNED ({meta['date']}) ---\n{doc}")
+        return "\n".join(context_list) if context_list else "No relevant past trading lessons found."
+
+    def _generate_json(self, task, contents):
+        """Gọi backend LLM (task: lmi / pmi / llr / hlr / decision) và parse JSON trả về."""
+        text = self.backend.generate(
+            task, self.model_name, contents, config={'response_mime_type': 'application/json'}
+        )
+        return json.loads(text)
 
 
     # =========================================================================
@@ -91,12 +272,7 @@ class FinAgentSystem:  # ĐÃ ĐỔI TÊN TỪ FinAgentMarketIntelligence
             """
 
         try:
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                contents=prompt,
-                config={'response_mime_type': 'application/json'}
-            )
-            result = json.loads(response.text)
+            result = self._generate_json('lmi', prompt)
             
             # --- LƯU VÀO MEMORY (Chỉ lưu LMI) ---
             if result:
@@ -108,6 +284,13 @@ class FinAgentSystem:  # ĐÃ ĐỔI TÊN TỪ FinAgentMarketIntelligence
             return None
 
 
+    def retrieve_past_market_intelligence(self, queries):
+        """
+        [Diversified Retrieval] Mỗi query của LMI (short / medium / long-term) chỉ tìm trong
+        ký ức cùng duration (Top K = 1). Trả về historical_context cho PMI.
+        """
+        return self.retrieve_all(market_queries=queries)['historical_context']
+
     def run_past_market_intelligence(self, lmi_result, historical_context):
         
         # 1. Chuẩn bị Context đầu vào
@@ -151,16 +334,32 @@ class FinAgentSystem:  # ĐÃ ĐỔI TÊN TỪ FinAgentMarketIntelligence
         """
         
         try:
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                contents=prompt,
-                config={'response_mime_type': 'application/json'}
-            )
-            return json.loads(response.text)
+            return self._generate_json('pmi', prompt)
         except Exception as e:
             logger.error(f"Error PMI: {e}")
             return None
 
+    def save_past_market_intelligence(self, symbol, date_str, pmi_result):
+        """
+        Lưu kết quả PMI (tổng hợp LMI + ký ức quá khứ) vào market_memory, 1 bản ghi
+        type PMI_SUMMARY / duration ALL (không lẫn vào Diversified Retrieval theo duration).
+        """
+        try:
+            self._upsert_memory(
+                "market_memory",
+                documents=[f"Summary: {pmi_result.get('summary', '')}\nFull Analysis: {pmi_result.get('analysis', '')}"],
+                metadatas=[{
+                    "symbol": symbol,
+                    "date": date_str,
+                    "type": "PMI_SUMMARY",
+                    "duration": "ALL"
+                }],
+                ids=[f"{symbol}_{date_str}_PMI"]
+            )
+            logger.info(f"Saved PMI insight for {symbol} on {date_str}")
+        except Exception as e:
+            logger.error(f"Error saving PMI: {e}")
+
     def _save_to_market_memory(self, symbol, date_str, lmi_result):
 
         summary = lmi_result.get('summary', '')
@@ -218,7 +417,8 @@ class FinAgentSystem:  # ĐÃ ĐỔI TÊN TỪ FinAgentMarketIntelligence
         # 3. Thực hiện Upsert một lần (Batch)
         try:
             if documents:
-                self.market_memory.upsert(
+                self._upsert_memory(
+                    "market_memory",
                     documents=documents,
                     metadatas=metadatas,
                     ids=ids
@@ -292,12 +492,7 @@ class FinAgentSystem:  # ĐÃ ĐỔI TÊN TỪ FinAgentMarketIntelligence
         contents.append(prompt_text)
 
         try:
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                contents=contents,
-                config={'response_mime_type': 'application/json'}
-            )
-            result = json.loads(response.text)
+            result = self._generate_json('llr', contents)
             
             # --- LƯU VÀO MEMORY ---
             if result:
@@ -313,27 +508,7 @@ class FinAgentSystem:  # ĐÃ ĐỔI TÊN TỪ FinAgentMarketIntelligence
         [PLLR Retrieval] Sử dụng 'query' sinh ra từ LLR để tìm kiếm quá khứ.
         (Step 06 trong Flow image_097caa.png)
         """
-        query_text = llr_result.get('query')
-        if not query_text:
-            return "No query generated for retrieval."
-
-        try:
-            # Query vào low_level_memory
-            results = self.low_level_memory.query(
-                query_texts=[query_text],
-                n_results=2 # Lấy Top 2 kết quả tương tự nhất
-            )
-            
-            context_list = []
-            if results['documents']:
-                for doc, meta in zip(results['documents'][0], results['metadatas'][0]):
-                    context_list.append(f"- Past Reflection ({meta['date']}): {doc}")
-            
-            return "\n".join(context_list) if context_list else "No similar past reflections found."
-            
-        except Exception as e:
-            logger.error(f"Error Retrieval PLLR: {e}")
-            return "Error retrieving history."
+        return self.retrieve_all(llr_query=llr_result.get('query'))['pllr']
 
     def _save_to_low_level_memory(self, symbol, date_str, llr_result):
         """
@@ -364,7 +539,8 @@ class FinAgentSystem:  # ĐÃ ĐỔI TÊN TỪ FinAgentMarketIntelligence
 
         try:
             # Upsert
-            self.low_level_memory.upsert(
+            self._upsert_memory(
+                "low_level_memory",
                 documents=[full_content], # Nội dung để đọc
                 metadatas=[meta],
                 ids=[f"{symbol}_{date_str}_LLR"]
@@ -452,12 +628,7 @@ class FinAgentSystem:  # ĐÃ ĐỔI TÊN TỪ FinAgentMarketIntelligence
 
         try:
             # Gọi Gemini API
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                contents=contents,
-                config={'response_mime_type': 'application/json'}
-            )
-            result = json.loads(response.text)
+            result = self._generate_json('hlr', contents)
 
             # --- LƯU VÀO MEMORY ---
             if result:
@@ -473,29 +644,9 @@ class FinAgentSystem:  # ĐÃ ĐỔI TÊN TỪ FinAgentMarketIntelligence
         """
         [PHLR Retrieval] Truy xuất bài học HLR quá khứ.
         """
-        # Ưu tiên dùng context hiện tại để tìm bài học cũ
-        query = current_market_context if current_market_context else hlr_query_text
-        
-        if not query:
-            return "No query provided for PHLR retrieval."
-
-        try:
-            # Query vào high_level_memory
-            results = self.high_level_memory.query(
-                query_texts=[query],
-                n_results=2 
-            )
-
-            context_list = []
-            if results['documents']:
-                for doc, meta in zip(results['documents'][0], results['metadatas'][0]):
-                    context_list.append(f"--- LESSON LEARNED ({meta['date']}) ---\n{doc}")
-
-            return "\n".join(context_list) if context_list else "No relevant past trading lessons found."
-
-        except Exception as e:
-            logger.error(f"Error Retrieval PHLR: {e}")
-            return "Error retrieving HLR history."
+        return self.retrieve_all(
+            hlr_query=hlr_query_text, current_market_context=current_market_context
+        )['phlr']
 
     def _save_to_high_level_memory(self, symbol, date_str, hlr_result):
         """
@@ -521,7 +672,8 @@ class FinAgentSystem:  # ĐÃ ĐỔI TÊN TỪ FinAgentMarketIntelligence
         }
 
         try:
-            self.high_level_memory.upsert(
+            self._upsert_memory(
+                "high_level_memory",
                 documents=[full_content],
                 metadatas=[meta],
                 ids=[f"{symbol}_{date_str}_HLR"]
@@ -618,12 +770,7 @@ class FinAgentSystem:  # ĐÃ ĐỔI TÊN TỪ FinAgentMarketIntelligence
         
         try:
             # Gọi Gemini API
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                contents=prompt_text,
-                config={'response_mime_type': 'application/json'}
-            )
-            return json.loads(response.text)
+            return self._generate_json('decision', prompt_text)
 
         except Exception as e:
             logger.error(f"Error Decision Making: {e}")
@@ -0,0 +1,349 @@
+# investment_advisor/indicator_state.py
+"""
+Trạng thái chỉ báo kỹ thuật lưu trong DB (bảng TrangThaiChiBao), cập nhật tăng dần.
+
+Mỗi mã CK giữ trạng thái sau phiên cuối: các giá trị đệ quy (EMA 12/26, DEA, trung
+bình tăng/giảm Wilder, K/D) và WINDOW_SESSIONS dòng cuối của chuỗi chỉ báo (giá + chỉ
+báo từng phiên). Khi có phiên mới (post_thitruong_data), trạng thái được nối tiếp bằng
+vài phép tính vô hướng cho mỗi phiên, không phải đọc lại lịch sử giá.
+
+Phiên gửi lại trùng ngày đã có (file cafef tải bù chồng ngày) mà giá không đổi thì bỏ
+qua. Nếu có phiên cũ bị sửa / bổ sung hoặc mã chưa có trạng thái, mã đó được dựng lại
+từ đầu bằng bộ tính vector trong indicators.py.
+Lệnh `manage.py rebuild_indicator_state` dựng lại / đối chiếu toàn bộ.
+
+get_recent_indicators đọc cửa sổ này cho prompt của agent (pipeline / benchmark) thay vì
+tính lại toàn bộ lịch sử giá của mã.
+"""
+import math
+
+import datetime
+
+import numpy as np
+import pandas as pd
+from django.db import transaction
+
+from .indicators import (
+    MA_WINDOWS, BOLL_WINDOW, BOLL_WIDTH, MACD_FAST, MACD_SLOW, MACD_SIGNAL,
+    RSI_PERIOD, KDJ_WINDOW, KDJ_SMOOTH, KDJ_SEED, LOOKBACK,
+    PRICE_COLUMNS, INDICATOR_COLUMNS, STATE_COLUMNS,
+    compute_universe_indicators, get_indicators, load_price_frame, _compute,
+)
+from .models import ThiTruongChungKhoang, TrangThaiChiBao
+
+REBUILD_BATCH_TICKERS = 200
+
+# Số phiên giữ trong cửa sổ: LOOKBACK cho chỉ báo cửa sổ, + 1 cho biến động 60 phiên
+# (describe_price_movements)
+WINDOW_SESSIONS = LOOKBACK + 1
+# Mỗi dòng cửa sổ: [ngay (ISO)] + giá trị các cột này
+WINDOW_COLUMNS = PRICE_COLUMNS + INDICATOR_COLUMNS + [c for c in STATE_COLUMNS if c not in INDICATOR_COLUMNS]
+
+# Tên cột trạng thái trong indicators.py -> tên field của TrangThaiChiBao
+STATE_FIELDS = {
+    'ema_fast': 'emaNhanh',
+    'ema_slow': 'emaCham',
+    'dea': 'dea',
+    'avg_gain': 'tbTang',
+    'avg_loss': 'tbGiam',
+    'kdj_k': 'kdjK',
+    'kdj_d': 'kdjD',
+}
+UPDATE_FIELDS = ['ngayCuoi', 'soPhien', 'giaDongCuaCuoi', 'cuaSo', 'chiBao', 'ngayCapNhat'] + list(STATE_FIELDS.values())
+
+
+def _number(value):
+    """float hoặc None (NaN / thiếu -> None) để lưu JSON."""
+    if value is None:
+        return None
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+# ==========================================================
+# DỰNG TRẠNG THÁI TỪ ĐẦU (bộ tính vector)
+# ==========================================================
+def _window_row(ngay, values):
+    return [ngay.isoformat()] + [_number(values[column]) for column in WINDOW_COLUMNS]
+
+
+def _has_window(state):
+    """Cửa sổ đúng định dạng WINDOW_COLUMNS (trạng thái dựng trước khi đổi định dạng -> False)."""
+    return bool(state.cuaSo) and len(state.cuaSo[0]) == len(WINDOW_COLUMNS) + 1
+
+
+def state_from_frame(symbol, frame):
+    """TrangThaiChiBao (chưa lưu) từ DataFrame chỉ báo đầy đủ của 1 mã (indicators.compute_indicators)."""
+    last = frame.iloc[-1]
+    window = frame.tail(WINDOW_SESSIONS)
+    return TrangThaiChiBao(
+        congTy_id=symbol,
+        ngayCuoi=frame.index[-1],
+        soPhien=len(frame),
+        giaDongCuaCuoi=float(last['close']),
+        cuaSo=[_window_row(ngay, row) for ngay, row in zip(window.index, window.to_dict('records'))],
+        chiBao={column: _number(last[column]) for column in INDICATOR_COLUMNS},
+        **{field: float(last[column]) for column, field in STATE_FIELDS.items()},
+    )
+
+
+def _price_symbols(symbols=None):
+    queryset = ThiTruongChungKhoang.objects.filter(giaDongCua__isnull=False)
+    if symbols is not None:
+        queryset = queryset.filter(congTy_id__in=symbols)
+    return sorted(queryset.order_by().values_list('congTy_id', flat=True).distinct())
+
+
+def compute_fresh_states(symbols=None):
+    """Dựng trạng thái từ toàn bộ lịch sử giá, theo lô REBUILD_BATCH_TICKERS mã. Trả về dict {ma: state}."""
+    codes = _price_symbols(symbols)
+    states = {}
+    for start in range(0, len(codes), REBUILD_BATCH_TICKERS):
+        for symbol, frame in compute_universe_indicators(codes[start:start + REBUILD_BATCH_TICKERS]).items():
+            states[symbol] = state_from_frame(symbol, frame)
+    return states
+
+
+def _save_states(states):
+    TrangThaiChiBao.objects.bulk_create(
+        states,
+        batch_size=500,
+        update_conflicts=True,
+        unique_fields=['congTy'],
+        update_fields=UPDATE_FIELDS,
+    )
+
+
+def rebuild_indicator_states(symbols=None):
+    """Dựng lại và lưu trạng thái (symbols=None: mọi mã có giá). Trả về số mã đã dựng."""
+    states = compute_fresh_states(symbols)
+    with transaction.atomic():
+        if symbols is None:
+            TrangThaiChiBao.objects.exclude(congTy__in=list(states)).delete()
+        else:
+            # Mã không còn dữ liệu giá -> bỏ trạng thái cũ
+            TrangThaiChiBao.objects.filter(congTy__in=symbols).exclude(congTy__in=list(states)).delete()
+        _save_states(list(states.values()))
+    return len(states)
+
+
+# ==========================================================
+# CẬP NHẬT TĂNG DẦN (1 phiên mới)
+# ==========================================================
+def _ema_step(previous, value, alpha):
+    return previous + alpha * (value - previous)
+
+
+def advance_state(state, ngay, open_, high, low, close, volume):
+    """
+    Nối tiếp `state` (TrangThaiChiBao) thêm 1 phiên sau state.ngayCuoi.
+    Chi phí không phụ thuộc độ dài lịch sử: chỉ dùng trạng thái + cửa sổ WINDOW_SESSIONS phiên.
+    """
+    close = float(close)
+    open_ = close if open_ is None else float(open_)
+    high = close if high is None else float(high)
+    low = close if low is None else float(low)
+    change = close - state.giaDongCuaCuoi
+
+    high_at, low_at, close_at = (WINDOW_COLUMNS.index(c) + 1 for c in ('high', 'low', 'close'))
+    closes = [row[close_at] for row in state.cuaSo[-(LOOKBACK - 1):]] + [close]
+
+    # 1. Chỉ báo đệ quy
+    state.emaNhanh = _ema_step(state.emaNhanh, close, 2 / (MACD_FAST + 1))
+    state.emaCham = _ema_step(state.emaCham, close, 2 / (MACD_SLOW + 1))
+    dif = state.emaNhanh - state.emaCham
+    state.dea = _ema_step(state.dea, dif, 2 / (MACD_SIGNAL + 1))
+    state.tbTang = _ema_step(state.tbTang, max(change, 0.0), 1 / RSI_PERIOD)
+    state.tbGiam = _ema_step(state.tbGiam, max(-change, 0.0), 1 / RSI_PERIOD)
+
+    recent = state.cuaSo[-(KDJ_WINDOW - 1):]
+    lowest = min([row[low_at] for row in recent] + [low])
+    highest = max([row[high_at] for row in recent] + [high])
+    rsv = (close - lowest) / (highest - lowest) * 100 if highest != lowest else KDJ_SEED
+    state.kdjK = _ema_step(state.kdjK, rsv, 1 / KDJ_SMOOTH)
+    state.kdjD = _ema_step(state.kdjD, state.kdjK, 1 / KDJ_SMOOTH)
+
+    # 2. Chỉ báo cửa sổ
+    values = {'open': open_, 'high': high, 'low': low, 'close': close, 'volume': volume}
+    for window_size in MA_WINDOWS:
+        values[f'ma{window_size}'] = float(np.mean(closes[-window_size:])) if len(closes) >= window_size else None
+    if len(closes) >= BOLL_WINDOW:
+        mid = float(np.mean(closes[-BOLL_WINDOW:]))
+        std = float(np.std(closes[-BOLL_WINDOW:]))
+        values.update(
+            boll_mid=mid,
+            boll_upper=mid + BOLL_WIDTH * std,
+            boll_lower=mid - BOLL_WIDTH * std,
+            boll_width=2 * BOLL_WIDTH * std / mid if mid else None,
+        )
+    else:
+        values.update(boll_mid=None, boll_upper=None, boll_lower=None, boll_width=None)
+
+    if state.soPhien < RSI_PERIOD:
+        rsi = None
+    elif state.tbGiam == 0:
+        rsi = 100.0 if state.tbTang > 0 else 50.0
+    else:
+        rsi = 100 - 100 / (1 + state.tbTang / state.tbGiam)
+
+    values.update(
+        dif=dif, dea=state.dea, macd_hist=dif - state.dea, rsi=rsi,
+        kdj_k=state.kdjK, kdj_d=state.kdjD, kdj_j=3 * state.kdjK - 2 * state.kdjD,
+        ema_fast=state.emaNhanh, ema_slow=state.emaCham, avg_gain=state.tbTang, avg_loss=state.tbGiam,
+    )
+
+    state.ngayCuoi = ngay
+    state.soPhien += 1
+    state.giaDongCuaCuoi = close
+    state.cuaSo = (state.cuaSo + [_window_row(ngay, values)])[-WINDOW_SESSIONS:]
+    state.chiBao = {column: _number(values[column]) for column in INDICATOR_COLUMNS}
+    return state
+
+
+def _same_bar(state, ngay, values):
+    """Phiên `ngay` gửi lại có giá trùng với dòng đang lưu trong cửa sổ (không cần tính lại)."""
+    if ngay > state.ngayCuoi:
+        return False
+    row = next((row for row in state.cuaSo if row[0] == ngay.isoformat()), None)
+    if row is None:
+        # Phiên cũ hơn cửa sổ (hoặc ngày mới chèn vào quá khứ): không đối chiếu được
+        return False
+    close = float(values['giaDongCua'])
+    posted = {
+        'open': values.get('giaMoCua'), 'high': values.get('giaCaoNhat'),
+        'low': values.get('giaThapNhat'), 'close': close, 'volume': values.get('klKhopLenh'),
+    }
+    for column in PRICE_COLUMNS:
+        value = posted[column]
+        if value is None and column != 'volume':
+            value = close
+        stored = row[WINDOW_COLUMNS.index(column) + 1]
+        if _differs(stored, _number(value), 1e-9):
+            return False
+    return True
+
+
+def update_indicator_states(bars):
+    """
+    Cập nhật trạng thái sau khi ghi giá.
+
+    bars: dict {(ma, ngay): {cột giá ThiTruongChungKhoang: giá trị}} (như upsert_price_rows).
+    Phiên trùng ngày đã có trong cửa sổ và giá không đổi -> bỏ qua. Các phiên còn lại đều
+    sau phiên cuối -> nối tiếp từng phiên; có phiên cũ thay đổi -> dựng lại từ đầu.
+    Trả về (số mã cập nhật tăng dần, số mã dựng lại).
+    """
+    by_symbol = {}
+    for (ma, ngay), values in bars.items():
+        if values.get('giaDongCua') is not None:
+            by_symbol.setdefault(ma, []).append((ngay, values))
+    if not by_symbol:
+        return 0, 0
+
+    states = TrangThaiChiBao.objects.in_bulk(list(by_symbol))
+    advanced, rebuild = [], []
+    for ma, new_bars in by_symbol.items():
+        state = states.get(ma)
+        if state is None or not _has_window(state):
+            rebuild.append(ma)
+            continue
+        new_bars = sorted(
+            (item for item in new_bars if not _same_bar(state, *item)),
+            key=lambda item: item[0],
+        )
+        if not new_bars:
+            continue
+        if new_bars[0][0] <= state.ngayCuoi:
+            rebuild.append(ma)
+            continue
+        for ngay, values in new_bars:
+            advance_state(
+                state, ngay, values.get('giaMoCua'), values.get('giaCaoNhat'), values.get('giaThapNhat'),
+                values['giaDongCua'], values.get('klKhopLenh'),
+            )
+        advanced.append(state)
+
+    with transaction.atomic():
+        if advanced:
+            _save_states(advanced)
+        if rebuild:
+            rebuild_indicator_states(rebuild)
+    return len(advanced), len(rebuild)
+
+
+# ==========================================================
+# ĐỌC / ĐỐI CHIẾU
+# ==========================================================
+def window_frame(state):
+    """DataFrame chỉ báo (index = ngay) của các phiên trong cửa sổ trạng thái."""
+    return pd.DataFrame(
+        [row[1:] for row in state.cuaSo],
+        columns=WINDOW_COLUMNS,
+        index=pd.Index([datetime.date.fromisoformat(row[0]) for row in state.cuaSo], name='ngay'),
+        dtype=float,
+    )
+
+
+def get_recent_indicators(symbol, as_of=None):
+    """
+    Chỉ báo WINDOW_SESSIONS phiên gần nhất của `symbol` tới ngày `as_of` (None = mới nhất),
+    đủ cho summarize_technical_signals / describe_kline / describe_price_movements.
+
+    as_of không trước phiên cuối của trạng thái: đọc cửa sổ trong TrangThaiChiBao và chỉ tính
+    thêm các phiên sau ngayCuoi (DB có giá mới chưa cập nhật trạng thái). Ngày cũ hơn / mã chưa
+    có trạng thái -> get_indicators (toàn bộ lịch sử, cache trong tiến trình).
+    """
+    symbol = symbol.upper()
+    state = TrangThaiChiBao.objects.filter(congTy_id=symbol).first()
+    if (state is None or not _has_window(state) or state.soPhien < LOOKBACK
+            or (as_of is not None and as_of < state.ngayCuoi)):
+        return get_indicators(symbol, as_of=as_of).tail(WINDOW_SESSIONS)
+
+    frame = window_frame(state)
+    new_bars = load_price_frame([symbol], after=state.ngayCuoi, as_of=as_of)
+    if not new_bars.empty:
+        new_bars = new_bars.drop(columns='ma').set_index('ngay')
+        frame = pd.concat([frame, _compute(new_bars, previous=frame)])
+    return frame.tail(WINDOW_SESSIONS)
+
+
+def _differs(stored, expected, tolerance):
+    if stored is None or expected is None:
+        return stored is not expected
+    return not math.isclose(stored, expected, rel_tol=tolerance, abs_tol=tolerance)
+
+
+def verify_indicator_states(symbols=None, tolerance=1e-6):
+    """
+    So trạng thái đang lưu với trạng thái dựng lại từ đầu (không ghi DB).
+    Trả về list lỗi dạng "MA: field lưu=... đúng=...".
+    """
+    fresh = compute_fresh_states(symbols)
+    stored = TrangThaiChiBao.objects.all()
+    if symbols is not None:
+        stored = stored.filter(congTy__in=symbols)
+    stored = {state.congTy_id: state for state in stored}
+
+    problems = []
+    for ma in sorted(set(fresh) | set(stored)):
+        if ma not in stored:
+            problems.append(f"{ma}: chưa có trạng thái")
+            continue
+        if ma not in fresh:
+            problems.append(f"{ma}: có trạng thái nhưng không còn dữ liệu giá")
+            continue
+        current, expected = stored[ma], fresh[ma]
+        if not _has_window(current):
+            problems.append(f"{ma}: cửa sổ định dạng cũ, cần dựng lại")
+            continue
+        for field in ['ngayCuoi', 'soPhien']:
+            if getattr(current, field) != getattr(expected, field):
+                problems.append(f"{ma}: {field} lưu={getattr(current, field)} đúng={getattr(expected, field)}")
+        for field in ['giaDongCuaCuoi'] + list(STATE_FIELDS.values()):
+            if _differs(getattr(current, field), getattr(expected, field), tolerance):
+                problems.append(f"{ma}: {field} lưu={getattr(current, field)} đúng={getattr(expected, field)}")
+        for column in INDICATOR_COLUMNS:
+            if _differs(current.chiBao.get(column), expected.chiBao.get(column), tolerance):
+                problems.append(f"{ma}: {column} lưu={current.chiBao.get(column)} đúng={expected.chiBao.get(column)}")
+        if [bar[0] for bar in current.cuaSo] != [bar[0] for bar in expected.cuaSo]:
+            problems.append(f"{ma}: cửa sổ phiên không khớp")
+    return problems
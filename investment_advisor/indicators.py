@@ -0,0 +1,399 @@
+# investment_advisor/indicators.py
+"""
+Bộ tính chỉ báo kỹ thuật (MA, Bollinger, MACD, RSI, KDJ) từ giá ngày ThiTruongChungKhoang.
+
+- Tính dạng vector (pandas rolling / ewm) cho 1 mã hoặc cả thị trường (1 query).
+- Cache trong tiến trình theo (mã, ngày giao dịch cuối, số phiên, phiên bản dữ liệu của
+  data_cache). Khi có phiên mới, chỉ các phiên mới được tính: chỉ báo đệ quy (EMA, Wilder,
+  KDJ) nối tiếp từ trạng thái của phiên cuối, chỉ báo cửa sổ (MA, Bollinger, RSV) dùng
+  thêm LOOKBACK phiên trước đó.
+- Các hàm describe_* / summarize_* dựng đoạn text gọn để đưa vào prompt của agent.
+
+Quy ước:
+- Bollinger(20, 2): độ lệch chuẩn tổng thể (ddof=0).
+- MACD(12, 26, 9): EMA đệ quy (ewm adjust=False), histogram = DIF - DEA.
+- RSI(14): trung bình Wilder (alpha = 1/14).
+- KDJ(9, 3, 3): K, D khởi tạo 50; J = 3K - 2D.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from django.db.models import Count, Max
+
+from .data_cache import get_data_version
+from .models import ThiTruongChungKhoang
+
+MA_WINDOWS = (5, 10, 20, 60)
+BOLL_WINDOW, BOLL_WIDTH = 20, 2
+MACD_FAST, MACD_SLOW, MACD_SIGNAL = 12, 26, 9
+RSI_PERIOD = 14
+KDJ_WINDOW, KDJ_SMOOTH = 9, 3
+KDJ_SEED = 50.0
+
+# Số phiên trước đó cần giữ lại để tính tiếp các chỉ báo cửa sổ
+LOOKBACK = max(MA_WINDOWS + (BOLL_WINDOW, KDJ_WINDOW, RSI_PERIOD))
+
+PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+INDICATOR_COLUMNS = [f'ma{w}' for w in MA_WINDOWS] + [
+    'boll_mid', 'boll_upper', 'boll_lower', 'boll_width',
+    'dif', 'dea', 'macd_hist',
+    'rsi', 'kdj_k', 'kdj_d', 'kdj_j',
+]
+# Trạng thái đệ quy của phiên cuối (đủ để tính tiếp phiên sau)
+STATE_COLUMNS = ['ema_fast', 'ema_slow', 'dea', 'avg_gain', 'avg_loss', 'kdj_k', 'kdj_d']
+
+MAX_CACHED_TICKERS = 256
+
+_SOURCE_FIELDS = {
+    'open': 'giaMoCua',
+    'high': 'giaCaoNhat',
+    'low': 'giaThapNhat',
+    'close': 'giaDongCua',
+    'volume': 'klKhopLenh',
+}
+
+
+# ==========================================================
+# ĐỌC GIÁ
+# ==========================================================
+def _price_queryset(symbols=None, after=None, as_of=None):
+    queryset = ThiTruongChungKhoang.objects.filter(giaDongCua__isnull=False)
+    if symbols is not None:
+        queryset = queryset.filter(congTy_id__in=symbols)
+    if after is not None:
+        queryset = queryset.filter(ngay__gt=after)
+    if as_of is not None:
+        queryset = queryset.filter(ngay__lte=as_of)
+    return queryset
+
+
+def load_price_frame(symbols=None, after=None, as_of=None):
+    """DataFrame cột 'ma', 'ngay' + PRICE_COLUMNS (float), sắp theo (ma, ngay). 1 query."""
+    rows = (
+        _price_queryset(symbols, after, as_of)
+        .order_by('congTy_id', 'ngay')
+        .values_list('congTy_id', 'ngay', *[_SOURCE_FIELDS[c] for c in PRICE_COLUMNS])
+    )
+    frame = pd.DataFrame.from_records(list(rows), columns=['ma', 'ngay'] + PRICE_COLUMNS)
+    for column in PRICE_COLUMNS:
+        frame[column] = pd.to_numeric(frame[column], errors='coerce').astype(float)
+    # Thiếu giá mở / cao / thấp (file cũ) -> dùng giá đóng cửa
+    for column in ['open', 'high', 'low']:
+        frame[column] = frame[column].fillna(frame['close'])
+    return frame
+
+
+# ==========================================================
+# TÍNH CHỈ BÁO (1 mã)
+# ==========================================================
+def _ema(values, alpha, seed=None):
+    """EMA đệ quy y_t = (1 - alpha) * y_(t-1) + alpha * x_t; seed = y_(-1) nếu có."""
+    if seed is None:
+        return values.ewm(alpha=alpha, adjust=False).mean()
+    seeded = pd.concat([pd.Series([seed]), values], ignore_index=True)
+    result = seeded.ewm(alpha=alpha, adjust=False).mean().iloc[1:]
+    result.index = values.index
+    return result
+
+
+def _compute(bars, previous=None):
+    """
+    Tính chỉ báo cho `bars` (DataFrame 1 mã, index = ngay, cột PRICE_COLUMNS).
+
+    previous: DataFrame kết quả đã có của các phiên ngay trước `bars` (ít nhất
+    LOOKBACK phiên) -> chỉ tính các phiên trong `bars`, nối tiếp trạng thái cũ.
+    """
+    if previous is not None:
+        history = pd.concat([previous[PRICE_COLUMNS].tail(LOOKBACK), bars[PRICE_COLUMNS]])
+        last = previous.iloc[-1]
+    else:
+        history = bars[PRICE_COLUMNS]
+        last = None
+    close = history['close']
+    new = bars.index
+
+    out = bars[PRICE_COLUMNS].copy()
+
+    # 1. Chỉ báo cửa sổ: tính trên history rồi lấy phần mới
+    for window in MA_WINDOWS:
+        out[f'ma{window}'] = close.rolling(window).mean().loc[new]
+    boll_std = close.rolling(BOLL_WINDOW).std(ddof=0).loc[new]
+    out['boll_mid'] = out[f'ma{BOLL_WINDOW}'] if BOLL_WINDOW in MA_WINDOWS else close.rolling(BOLL_WINDOW).mean().loc[new]
+    out['boll_upper'] = out['boll_mid'] + BOLL_WIDTH * boll_std
+    out['boll_lower'] = out['boll_mid'] - BOLL_WIDTH * boll_std
+    out['boll_width'] = (out['boll_upper'] - out['boll_lower']) / out['boll_mid']
+
+    lowest = history['low'].rolling(KDJ_WINDOW, min_periods=1).min().loc[new]
+    highest = history['high'].rolling(KDJ_WINDOW, min_periods=1).max().loc[new]
+    price_range = highest - lowest
+    rsv = ((out['close'] - lowest) / price_range.where(price_range != 0) * 100).fillna(KDJ_SEED)
+
+    change = close.diff().loc[new].fillna(0.0)
+
+    # 2. Chỉ báo đệ quy: nối tiếp từ trạng thái phiên trước (nếu có)
+    seed = (lambda name: last[name]) if last is not None else (lambda name: None)
+    out['ema_fast'] = _ema(out['close'], 2 / (MACD_FAST + 1), seed('ema_fast'))
+    out['ema_slow'] = _ema(out['close'], 2 / (MACD_SLOW + 1), seed('ema_slow'))
+    out['dif'] = out['ema_fast'] - out['ema_slow']
+    out['dea'] = _ema(out['dif'], 2 / (MACD_SIGNAL + 1), seed('dea'))
+    out['macd_hist'] = out['dif'] - out['dea']
+
+    out['avg_gain'] = _ema(change.clip(lower=0), 1 / RSI_PERIOD, seed('avg_gain'))
+    out['avg_loss'] = _ema(-change.clip(upper=0), 1 / RSI_PERIOD, seed('avg_loss'))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsi = 100 - 100 / (1 + out['avg_gain'] / out['avg_loss'])
+    out['rsi'] = rsi.where(out['avg_loss'] != 0, np.where(out['avg_gain'] > 0, 100.0, 50.0))
+
+    out['kdj_k'] = _ema(rsv, 1 / KDJ_SMOOTH, seed('kdj_k') if last is not None else KDJ_SEED)
+    out['kdj_d'] = _ema(out['kdj_k'], 1 / KDJ_SMOOTH, seed('kdj_d') if last is not None else KDJ_SEED)
+    out['kdj_j'] = 3 * out['kdj_k'] - 2 * out['kdj_d']
+
+    # RSI chưa đủ RSI_PERIOD phiên thì chưa có ý nghĩa (giữ avg_gain/avg_loss để tính tiếp)
+    if previous is None:
+        out.iloc[:RSI_PERIOD, out.columns.get_loc('rsi')] = np.nan
+    return out
+
+
+def compute_indicators(bars):
+    """Chỉ báo cho DataFrame giá của 1 mã (cột 'ngay' + PRICE_COLUMNS, hoặc index = ngay)."""
+    if 'ngay' in bars.columns:
+        bars = bars.set_index('ngay')
+    return _compute(bars.sort_index())
+
+
+# ==========================================================
+# CACHE THEO (MÃ, NGÀY CUỐI, PHIÊN BẢN DỮ LIỆU) + CẬP NHẬT TĂNG DẦN
+# ==========================================================
+_cache = OrderedDict()  # {ma: (ngày cuối, số phiên, phiên bản dữ liệu, DataFrame)}
+_cache_lock = threading.Lock()
+
+
+def _cache_put(symbol, frame, version):
+    with _cache_lock:
+        _cache[symbol] = (frame.index[-1], len(frame), version, frame)
+        _cache.move_to_end(symbol)
+        while len(_cache) > MAX_CACHED_TICKERS:
+            _cache.popitem(last=False)
+
+
+def clear_indicator_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def get_indicators(symbol, as_of=None):
+    """
+    Chuỗi chỉ báo của `symbol` (index = ngay) tới ngày `as_of` (None = mới nhất).
+
+    Chỉ báo ngày t chỉ phụ thuộc giá <= t, nên kết quả đầy đủ được cache và cắt theo as_of.
+    Khóa cache gồm phiên bản dữ liệu (data_cache.get_data_version, đổi sau mỗi lần upload /
+    sửa trong admin): phiên bản đổi thì tính lại toàn bộ vì giá cũ có thể đã bị sửa tại chỗ.
+    Cùng phiên bản mà DB có thêm phiên mới sau phiên cuối (ghi với refresh=False) thì chỉ
+    các phiên mới được tính thêm. Sửa giá trực tiếp trong DB (không qua ứng dụng) không
+    được phát hiện.
+    """
+    symbol = symbol.upper()
+    version = get_data_version()
+    latest = _price_queryset([symbol]).aggregate(last=Max('ngay'), count=Count('id'))
+    if latest['last'] is None:
+        return pd.DataFrame(columns=PRICE_COLUMNS + INDICATOR_COLUMNS)
+
+    with _cache_lock:
+        cached = _cache.get(symbol)
+    if cached and cached[2] != version:
+        cached = None
+
+    if cached and (cached[0], cached[1]) == (latest['last'], latest['count']):
+        frame = cached[3]
+    elif cached and cached[0] < latest['last'] and cached[1] >= LOOKBACK:
+        new_bars = load_price_frame([symbol], after=cached[0]).set_index('ngay')[PRICE_COLUMNS]
+        if cached[1] + len(new_bars) == latest['count']:
+            frame = pd.concat([cached[3], _compute(new_bars, previous=cached[3])])
+        else:
+            frame = compute_indicators(load_price_frame([symbol]))
+        _cache_put(symbol, frame, version)
+    else:
+        frame = compute_indicators(load_price_frame([symbol]))
+        _cache_put(symbol, frame, version)
+
+    if as_of is not None:
+        frame = frame.loc[:as_of]
+    return frame
+
+
+def compute_universe_indicators(symbols=None, as_of=None):
+    """
+    Chỉ báo cho nhiều mã (mặc định: toàn thị trường), đọc giá trong 1 query.
+    Trả về dict {ma: DataFrame}; kết quả đầy đủ (as_of=None) được đưa luôn vào cache.
+    """
+    version = get_data_version()
+    prices = load_price_frame(symbols, as_of=as_of)
+    results = {}
+    for symbol, bars in prices.groupby('ma', sort=False):
+        frame = compute_indicators(bars.drop(columns='ma'))
+        if as_of is None:
+            _cache_put(symbol, frame, version)
+        results[symbol] = frame
+    return results
+
+
+# ==========================================================
+# TEXT CHO PROMPT
+# ==========================================================
+def _pct(now, before):
+    if before is None or not before or pd.isna(before):
+        return None
+    return (now - before) / before * 100
+
+
+def _fmt_pct(value):
+    return "N/A" if value is None or pd.isna(value) else f"{value:+.2f}%"
+
+
+def _trend_word(change, threshold=0.5):
+    if change is None or pd.isna(change):
+        return "N/A"
+    if change > threshold:
+        return "rising"
+    if change < -threshold:
+        return "falling"
+    return "flat"
+
+
+def summarize_technical_signals(frame):
+    """Đoạn text MACD / RSI / KDJ / Bollinger của phiên cuối (đầu vào technical_signals)."""
+    if len(frame) < 2:
+        return "Not enough price history for technical signals."
+    today, prev = frame.iloc[-1], frame.iloc[-2]
+    week_ago = frame.iloc[-6] if len(frame) >= 6 else frame.iloc[0]
+    lines = []
+
+    # MACD
+    if prev['dif'] <= prev['dea'] and today['dif'] > today['dea']:
+        macd_state = "Bullish Crossover (DIF crossed above DEA today)"
+    elif prev['dif'] >= prev['dea'] and today['dif'] < today['dea']:
+        macd_state = "Bearish Crossover (DIF crossed below DEA today)"
+    elif today['dif'] > today['dea']:
+        macd_state = "Bullish (DIF above DEA)"
+    else:
+        macd_state = "Bearish (DIF below DEA)"
+    lines.append(
+        f"- MACD(12,26,9): DIF {today['dif']:.2f}, DEA {today['dea']:.2f}, "
+        f"Histogram {today['macd_hist']:+.2f} ({_trend_word(today['macd_hist'] - prev['macd_hist'], 0)}) -> {macd_state}."
+    )
+
+    # RSI
+    rsi = today['rsi']
+    if pd.isna(rsi):
+        lines.append("- RSI(14): N/A (less than 14 sessions).")
+    else:
+        if rsi >= 70:
+            zone = "Overbought"
+        elif rsi <= 30:
+            zone = "Oversold"
+        elif rsi >= 50:
+            zone = "Neutral-Bullish"
+        else:
+            zone = "Neutral-Bearish"
+        lines.append(f"- RSI(14): {rsi:.1f} ({zone}, {_trend_word(rsi - week_ago['rsi'], 1)} vs 5 sessions ago).")
+
+    # KDJ
+    if prev['kdj_k'] <= prev['kdj_d'] and today['kdj_k'] > today['kdj_d']:
+        kdj_state = "Golden Cross (K crossed above D)"
+    elif prev['kdj_k'] >= prev['kdj_d'] and today['kdj_k'] < today['kdj_d']:
+        kdj_state = "Death Cross (K crossed below D)"
+    else:
+        kdj_state = f"J line is turning {'upwards' if today['kdj_j'] > prev['kdj_j'] else 'downwards'}"
+    if today['kdj_j'] > 100:
+        kdj_state += ", J > 100 (overbought)"
+    elif today['kdj_j'] < 0:
+        kdj_state += ", J < 0 (oversold)"
+    lines.append(f"- KDJ(9,3,3): K {today['kdj_k']:.1f}, D {today['kdj_d']:.1f}, J {today['kdj_j']:.1f} -> {kdj_state}.")
+
+    # Bollinger
+    if pd.isna(today['boll_mid']):
+        lines.append("- Bollinger Bands(20,2): N/A (less than 20 sessions).")
+    else:
+        band = today['boll_upper'] - today['boll_lower']
+        percent_b = (today['close'] - today['boll_lower']) / band if band else 0.5
+        if today['close'] >= today['boll_upper']:
+            position = "Price is at/above the upper band"
+        elif today['close'] <= today['boll_lower']:
+            position = "Price is at/below the lower band"
+        elif prev['low'] <= prev['boll_lower'] and today['close'] > prev['close']:
+            position = "Price touched the lower band and is bouncing back"
+        elif prev['high'] >= prev['boll_upper'] and today['close'] < prev['close']:
+            position = "Price touched the upper band and is pulling back"
+        else:
+            position = f"Price is {'above' if today['close'] >= today['boll_mid'] else 'below'} the middle band"
+        width_change = _pct(today['boll_width'], week_ago['boll_width'])
+        lines.append(
+            f"- Bollinger Bands(20,2): Upper {today['boll_upper']:.2f}, Mid {today['boll_mid']:.2f}, "
+            f"Lower {today['boll_lower']:.2f}, %B {percent_b:.2f} -> {position}; "
+            f"bandwidth {today['boll_width'] * 100:.1f}% ({'narrowing' if (width_change or 0) < 0 else 'widening'} vs 5 sessions ago)."
+        )
+
+    lines.append(f"- Current Price: {today['close'] * 1000:,.0f} VND.")
+    return "\n".join(lines)
+
+
+def describe_kline(frame):
+    """Mô tả nến + MA + Bollinger của phiên cuối (thay cho ảnh Kline chart)."""
+    if len(frame) < 2:
+        return "Not enough price history for a Kline description."
+    today = frame.iloc[-1]
+    three_ago = frame.iloc[-4] if len(frame) >= 4 else frame.iloc[0]
+    week_ago = frame.iloc[-6] if len(frame) >= 6 else frame.iloc[0]
+
+    lines = ["Kline chart with Moving Average (MA) and Bollinger Bands (BB)."]
+    ma_parts = [f"MA{w} {today[f'ma{w}']:.2f}" for w in MA_WINDOWS if not pd.isna(today[f'ma{w}'])]
+    if ma_parts:
+        ma_line = f"- {', '.join(ma_parts)}; MA5 is {_trend_word(_pct(today['ma5'], three_ago['ma5']))} over the last 3 sessions"
+        if not pd.isna(today['ma20']):
+            ma_line += f"; price is {'above' if today['close'] >= today['ma20'] else 'below'} MA20"
+        lines.append(ma_line + ".")
+    if not pd.isna(today['boll_width']):
+        width_change = _pct(today['boll_width'], week_ago['boll_width'])
+        if width_change is not None and width_change < -5:
+            lines.append("- Bollinger Bands are narrowing indicating reduced volatility.")
+        elif width_change is not None and width_change > 5:
+            lines.append("- Bollinger Bands are widening indicating rising volatility.")
+        else:
+            lines.append("- Bollinger Band width is stable.")
+
+    if today['close'] > today['open']:
+        candle = "GREEN (Closing price > Opening price), showing buying pressure"
+    elif today['close'] < today['open']:
+        candle = "RED (Closing price < Opening price), showing selling pressure"
+    else:
+        candle = "a DOJI (Closing price = Opening price), showing indecision"
+    lines.append(f"- Today's candle is {candle}.")
+
+    avg_volume = frame['volume'].tail(20).mean()
+    if avg_volume and not pd.isna(today['volume']):
+        lines.append(f"- Volume {today['volume']:,.0f} is {today['volume'] / avg_volume:.1f}x the 20-session average.")
+    return "\n".join(lines)
+
+
+def describe_price_movements(frame):
+    """Biến động giá ngắn / trung / dài hạn (1-5, 20, 60 phiên) cho Low-Level Reflection."""
+    if frame.empty:
+        return "No price data."
+    close = frame['close']
+
+    def change(sessions):
+        return _pct(close.iloc[-1], close.iloc[-1 - sessions]) if len(close) > sessions else None
+
+    def word(value):
+        if value is None:
+            return "N/A"
+        return "Increased" if value > 0 else "Decreased" if value < 0 else "Unchanged"
+
+    short, week, medium, long = change(1), change(5), change(20), change(60)
+    return (
+        f"Short-term: {word(short)} {_fmt_pct(short)} (1 day), {_fmt_pct(week)} (5 days). "
+        f"Medium-term: {word(medium)} {_fmt_pct(medium)} (20 days). "
+        f"Long-term: {word(long)} {_fmt_pct(long)} (60 days)."
+    )
@@ -0,0 +1,242 @@
+# investment_advisor/ingest.py
+"""
+Ghi dữ liệu hàng loạt (upload CSV / file cafef) theo tập hợp thay vì từng dòng.
+
+Thay cho get_or_create từng dòng (2-4 query mỗi dòng): toàn bộ công ty và kỳ báo
+cáo được tạo / tra cứu trong vài query, sau đó bảng BCTC được upsert bằng
+bulk_create(update_conflicts=True) để số liệu sửa lại được ghi đè thay vì bị bỏ qua.
+"""
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .models import CongTy, TongHopTaiChinh, ThiTruongChungKhoang
+from .utils import refresh_financial_ratios, refresh_market_stats, statement_ratio_pairs
+from .indicator_state import update_indicator_states
+
+BATCH_SIZE = 1000
+
+
+def _statement_fields(model):
+    """Các cột số liệu có thể ghi của bảng BCTC (bỏ khóa baoCao)."""
+    return {
+        field.name: field
+        for field in model._meta.concrete_fields
+        if not field.primary_key
+    }
+
+
+def _ensure_companies(codes):
+    """Tạo các công ty chưa có (1 query), tên mặc định 'Công ty <mã>'."""
+    CongTy.objects.bulk_create(
+        [CongTy(maChungKhoan=ma, tenCongTy=f"Công ty {ma}") for ma in codes],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+
+
+def _ensure_reports(periods):
+    """
+    Tạo các kỳ báo cáo (công ty, năm, quý) chưa có rồi trả về dict {(ma, nam, quy): id}.
+    """
+    TongHopTaiChinh.objects.bulk_create(
+        [TongHopTaiChinh(congTy_id=ma, nam=nam, quy=quy) for ma, nam, quy in periods],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    codes = {ma for ma, _, _ in periods}
+    years = {nam for _, nam, _ in periods}
+    mapping = {}
+    for report_id, ma, nam, quy in TongHopTaiChinh.objects.filter(
+        congTy__in=codes, nam__in=years
+    ).order_by().values_list('id', 'congTy', 'nam', 'quy'):
+        if (ma, nam, quy) in periods:
+            mapping[(ma, nam, quy)] = report_id
+    return mapping
+
+
+def ingest_statement_rows(model, rows, refresh=True):
+    """
+    Upsert hàng loạt các dòng BCTC (BangCanDoiKeToan / BangKetQuaKinhDoanh).
+
+    rows: list dict, mỗi dict có 'ma', 'years', 'quy' + các cột số liệu của model.
+    refresh: tính lại chỉ số tài chính ngay sau khi ghi (False khi người gọi tự làm).
+    Dòng trùng (cùng mã, năm, quý) trong cùng lần gửi: giữ dòng sau cùng.
+    Trả về (số dòng đã ghi, danh sách lỗi theo dòng).
+    """
+    fields = _statement_fields(model)
+    errors = []
+    parsed = {}  # {(ma, nam, quy): {cột: giá trị}}
+
+    # 1. Kiểm tra & chuẩn hóa từng dòng (không query DB)
+    for index, item in enumerate(rows):
+        if not isinstance(item, dict):
+            errors.append(f"Dòng {index + 1}: Không phải object. Bỏ qua.")
+            continue
+
+        item = dict(item)
+        ma_chung_khoan = item.pop('ma', None)
+        nam = item.pop('years', None)
+        quy = item.pop('quy', None)
+        if not ma_chung_khoan or nam is None or quy is None:
+            errors.append(f"Dòng {index + 1}: Thiếu 'ma', 'years', hoặc 'quy'. Bỏ qua.")
+            continue
+
+        unknown = [key for key in item if key not in fields]
+        if unknown:
+            errors.append(f"Dòng {index + 1} (Mã: {ma_chung_khoan}): Cột không hợp lệ {', '.join(unknown)}. Bỏ qua.")
+            continue
+
+        try:
+            key = (str(ma_chung_khoan).strip().upper(), int(nam), int(quy))
+            values = {}
+            for name, value in item.items():
+                if value == '':
+                    value = None
+                values[name] = None if value is None else fields[name].to_python(value)
+        except (ValueError, TypeError, ValidationError) as e:
+            errors.append(f"Dòng {index + 1} (Mã: {ma_chung_khoan}): Lỗi - {e}")
+            continue
+
+        parsed[key] = values
+
+    if not parsed:
+        return 0, errors
+
+    with transaction.atomic():
+        # 2. Công ty + kỳ báo cáo: tạo phần còn thiếu, tra id trong 1 query
+        _ensure_companies({ma for ma, _, _ in parsed})
+        report_ids = _ensure_reports(set(parsed))
+
+        # 3. Upsert theo nhóm cột: dòng thiếu cột nào thì không ghi đè cột đó
+        groups = {}
+        for key, values in parsed.items():
+            groups.setdefault(tuple(sorted(values)), []).append(
+                model(baoCao_id=report_ids[key], **values)
+            )
+        for columns, objects in groups.items():
+            if columns:
+                model.objects.bulk_create(
+                    objects,
+                    batch_size=BATCH_SIZE,
+                    update_conflicts=True,
+                    unique_fields=['baoCao'],
+                    update_fields=list(columns),
+                )
+            else:
+                model.objects.bulk_create(objects, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+    # 4. Tính lại chỉ số cho các (công ty, năm) bị ảnh hưởng; dòng chỉ số mới tạo chưa có
+    #    Beta / độ biến động -> ghi lại 1 lần cho các năm đó
+    if refresh:
+        affected_pairs = set()
+        for ma, nam, _ in parsed:
+            affected_pairs |= statement_ratio_pairs(ma, nam)
+        refresh_financial_ratios(affected_pairs)
+        refresh_market_stats({nam for _, nam in affected_pairs})
+
+    return len(parsed), errors
+
+
+# ==========================================================
+# DỮ LIỆU GIÁ THỊ TRƯỜNG (ThiTruongChungKhoang)
+# ==========================================================
+PRICE_REQUIRED_FIELDS = [
+    "giaDongCua", "giaDieuChinh", "thayDoi", "klKhopLenh", "gtKhopLenh",
+    "giaMoCua", "giaCaoNhat", "giaThapNhat",
+]
+PRICE_OPTIONAL_FIELDS = ["klThoaThuan", "gtThoaThuan"]
+PRICE_CHUNK_SIZE = 5000
+
+
+def upsert_price_rows(rows, chunk_size=PRICE_CHUNK_SIZE, refresh=True):
+    """
+    Upsert hàng loạt giá giao dịch ngày theo khóa (congTy, ngay).
+
+    - Mã CK được tra / tạo 1 lần cho cả lô (không get_or_create từng dòng).
+    - Dòng đã có trong DB được cập nhật thay vì làm hỏng cả lô, nên gửi lại
+      file cafef chồng ngày (tải bù hằng ngày) là an toàn.
+    - Dòng trùng (mã, ngày) trong cùng lô: giữ dòng sau cùng.
+    - refresh=False: không tính lại chỉ số tài chính / Beta / trạng thái chỉ báo (người gọi tự làm).
+
+    Trả về dict {inserted, updated, rejected (list lỗi theo dòng)}.
+    """
+    fields = {field.name: field for field in ThiTruongChungKhoang._meta.concrete_fields}
+    value_fields = PRICE_REQUIRED_FIELDS + PRICE_OPTIONAL_FIELDS
+    rejected = []
+    parsed = {}     # {(ma, ngay): {cột: giá trị}}
+    companies = {}  # {ma: (tenCongTy, nganh)} dùng khi phải tạo công ty mới
+
+    # 1. Kiểm tra & chuẩn hóa từng dòng (không query DB)
+    for index, record in enumerate(rows):
+        if not isinstance(record, dict):
+            rejected.append(f"Dòng {index + 1}: Không phải object.")
+            continue
+        ma_chung_khoan = record.get("congTy")
+        missing = [name for name in ["congTy", "ngay"] + PRICE_REQUIRED_FIELDS if name not in record]
+        if missing:
+            rejected.append(f"Dòng {index + 1} (Mã: {ma_chung_khoan}): Thiếu {', '.join(missing)}.")
+            continue
+
+        try:
+            ma = str(ma_chung_khoan).strip().upper()
+            ngay = fields["ngay"].to_python(record["ngay"])
+            if not ma or ngay is None:
+                raise ValueError("mã CK hoặc ngày rỗng")
+            values = {}
+            for name in value_fields:
+                value = record.get(name)
+                values[name] = None if value in (None, '') else fields[name].to_python(value)
+        except (ValueError, TypeError, ValidationError) as e:
+            rejected.append(f"Dòng {index + 1} (Mã: {ma_chung_khoan}): Lỗi - {e}")
+            continue
+
+        parsed[(ma, ngay)] = values
+        companies.setdefault(ma, (record.get("tenCongTy") or ma, record.get("nganh")))
+
+    inserted = updated = 0
+    if not parsed:
+        return {"inserted": 0, "updated": 0, "rejected": rejected}
+
+    # 2. Tạo các mã CK chưa có (1 query cho cả lô)
+    CongTy.objects.bulk_create(
+        [CongTy(maChungKhoan=ma, tenCongTy=ten, nganh=nganh) for ma, (ten, nganh) in companies.items()],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+
+    # 3. Upsert theo từng khối (tránh transaction / câu lệnh quá lớn)
+    keys = list(parsed)
+    for start in range(0, len(keys), chunk_size):
+        chunk = keys[start:start + chunk_size]
+        codes = {ma for ma, _ in chunk}
+        dates = [ngay for _, ngay in chunk]
+
+        with transaction.atomic():
+            # Đếm trước các dòng đã có để báo inserted / updated
+            existing = set(
+                ThiTruongChungKhoang.objects
+                .filter(congTy__in=codes, ngay__range=(min(dates), max(dates)))
+                .order_by()
+                .values_list('congTy', 'ngay')
+            )
+            ThiTruongChungKhoang.objects.bulk_create(
+                [ThiTruongChungKhoang(congTy_id=ma, ngay=ngay, **parsed[(ma, ngay)]) for ma, ngay in chunk],
+                batch_size=BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=['congTy', 'ngay'],
+                update_fields=value_fields,
+            )
+        chunk_updated = sum(1 for key in chunk if key in existing)
+        updated += chunk_updated
+        inserted += len(chunk) - chunk_updated
+
+    # 4. Giá cuối năm thay đổi -> tính lại PE/PB của các năm liên quan; Beta / độ biến động
+    #    (chỉ số thị trường dựng từ mọi mã) ghi lại 1 lần cho cả các năm đó;
+    #    chỉ báo kỹ thuật nối tiếp từ trạng thái đã lưu (không quét lại lịch sử).
+    if refresh:
+        years = {ngay.year for _, ngay in parsed}
+        refresh_financial_ratios({(ma, ngay.year) for ma, ngay in parsed})
+        refresh_market_stats(years)
+        update_indicator_states(parsed)
+
+    return {"inserted": inserted, "updated": updated, "rejected": rejected}
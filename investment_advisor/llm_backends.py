@@ -0,0 +1,242 @@
+# investment_advisor/llm_backends.py
+"""
+Backend LLM cho FinAgentSystem.
+
+Mọi module (LMI, PMI, LLR, HLR, Decision) gọi backend.generate(task, model, contents, config)
+và nhận về chuỗi JSON, nên có thể thay Gemini thật bằng:
+
+- RecordReplayBackend: lưu / đọc lại câu trả lời theo hash của prompt trên đĩa
+  ('record' = gọi Gemini và ghi lại, 'replay' = chỉ đọc, thiếu thì báo lỗi,
+  'auto' = đọc nếu có, thiếu thì gọi Gemini và ghi lại)
+- StubBackend: câu trả lời giả lập tất định theo từng module, không cần mạng
+
+Chọn backend qua settings.FINAGENT_LLM_BACKEND (gemini | record | replay | auto | stub).
+Lời gọi Gemini thật luôn đi qua RateLimitedBackend (rate_limit.py): giới hạn chung
+requests / tokens mỗi phút và thử lại khi gặp 429 / 5xx.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from .rate_limit import DEFAULT_MAX_RETRIES, call_with_retry, estimate_tokens, get_gemini_limiter
+
+BACKEND_NAMES = ('gemini', 'record', 'replay', 'auto', 'stub')
+
+
+class CassetteMiss(LookupError):
+    """Chế độ replay nhưng chưa có câu trả lời đã ghi cho prompt này."""
+
+
+def _part_bytes(part):
+    """Nội dung (bytes) của 1 phần contents: text hoặc ảnh PIL."""
+    if isinstance(part, str):
+        return part.encode('utf-8')
+    if hasattr(part, 'tobytes'):  # PIL.Image
+        return b'image:' + str(getattr(part, 'size', '')).encode() + part.tobytes()
+    return repr(part).encode('utf-8')
+
+
+def prompt_hash(task, model, contents, config=None):
+    """Khóa tất định của 1 lời gọi: sha256(task, model, config, từng phần contents)."""
+    digest = hashlib.sha256()
+    header = json.dumps([task, model, config or {}], sort_keys=True, default=str)
+    digest.update(header.encode('utf-8'))
+    parts = contents if isinstance(contents, (list, tuple)) else [contents]
+    for part in parts:
+        data = _part_bytes(part)
+        digest.update(len(data).to_bytes(8, 'big'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def _prompt_text(contents):
+    parts = contents if isinstance(contents, (list, tuple)) else [contents]
+    return "\n".join(part for part in parts if isinstance(part, str))
+
+
+# ==========================================================
+# BACKEND
+# ==========================================================
+class LLMBackend:
+    """Giao diện chung: generate(...) -> response text (chuỗi JSON)."""
+    name = "base"
+
+    def generate(self, task, model, contents, config=None):
+        raise NotImplementedError
+
+
+class GeminiBackend(LLMBackend):
+    """Gọi Gemini thật (google-genai)."""
+    name = "gemini"
+
+    def __init__(self, api_key=None):
+        import google.genai as genai
+
+        api_key = api_key or os.environ.get("GEMINI_API_KEY") or getattr(settings, 'GEMINI_API_KEY', None)
+        if not api_key:
+            raise ValueError("Vui lòng đặt GEMINI_API_KEY trong biến môi trường hoặc settings.py.")
+        self.client = genai.Client(api_key=api_key)
+
+    def generate(self, task, model, contents, config=None):
+        response = self.client.models.generate_content(model=model, contents=contents, config=config)
+        return response.text
+
+
+class RateLimitedBackend(LLMBackend):
+    """Bọc backend khác: lấy quota từ RateLimiter trước mỗi lời gọi, thử lại khi lỗi tạm thời."""
+    name = "rate_limited"
+
+    def __init__(self, inner, limiter=None, max_retries=None):
+        self.inner = inner
+        self.limiter = limiter or get_gemini_limiter()
+        self.max_retries = max_retries if max_retries is not None else getattr(settings, 'GEMINI_MAX_RETRIES', DEFAULT_MAX_RETRIES)
+
+    def generate(self, task, model, contents, config=None):
+        response = call_with_retry(
+            lambda: self.inner.generate(task, model, contents, config),
+            limiter=self.limiter,
+            max_retries=self.max_retries,
+            tokens=estimate_tokens(contents),
+            label=f"Gemini {task}",
+        )
+        # Token của câu trả lời chỉ biết sau khi gọi -> trừ bổ sung vào xô
+        self.limiter.record_usage(estimate_tokens(response or ""))
+        return response
+
+
+class RecordReplayBackend(LLMBackend):
+    """
+    Lưu câu trả lời theo prompt_hash: mỗi lời gọi 1 file <hash>.json trong `path`
+    (ghi file tạm rồi rename, an toàn khi nhiều tiến trình cùng ghi).
+    """
+    name = "record_replay"
+
+    def __init__(self, path, mode='replay', inner=None):
+        if mode not in ('record', 'replay', 'auto'):
+            raise ValueError(f"mode phải là record, replay hoặc auto (nhận: {mode})")
+        if mode != 'replay' and inner is None:
+            raise ValueError("Chế độ record / auto cần backend thật (inner) để gọi khi chưa có bản ghi.")
+        self.path = path
+        self.mode = mode
+        self.inner = inner
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.json")
+
+    def load(self, key):
+        try:
+            with open(self._file(key), encoding='utf-8') as f:
+                return json.load(f)['response']
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, task, model, contents, response):
+        record = {
+            "task": task,
+            "model": model,
+            "prompt_preview": _prompt_text(contents)[:500],
+            "response": response,
+            "recorded_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self._file(key))
+
+    def generate(self, task, model, contents, config=None):
+        key = prompt_hash(task, model, contents, config)
+        if self.mode != 'record':
+            response = self.load(key)
+            if response is not None:
+                self.hits += 1
+                return response
+            if self.mode == 'replay':
+                self.misses += 1
+                raise CassetteMiss(f"Chưa có bản ghi cho lời gọi {task} ({key[:12]}) trong {self.path}")
+        self.misses += 1
+        response = self.inner.generate(task, model, contents, config)
+        self.save(key, task, model, contents, response)
+        return response
+
+
+# Câu trả lời mẫu (đúng định dạng JSON mỗi module yêu cầu)
+STUB_RESPONSES = {
+    'lmi': {
+        "analysis": "Stub analysis of latest market intelligence. (Duration: SHORT-TERM, Sentiment: NEUTRAL)",
+        "summary": "Stub summary: market sentiment is NEUTRAL in the short term.",
+        "queries": {
+            "short_term_query": "stub short-term price drivers",
+            "medium_term_query": "stub medium-term business outlook",
+            "long_term_query": "stub long-term industry trend",
+        },
+    },
+    'pmi': {
+        "analysis": "Stub analysis combining latest and past market intelligence.",
+        "summary": "Stub summary: overall sentiment NEUTRAL.",
+    },
+    'llr': {
+        "reasoning": {
+            "short_term_reasoning": "Stub short-term reasoning.",
+            "medium_term_reasoning": "Stub medium-term reasoning.",
+            "long_term_reasoning": "Stub long-term reasoning.",
+        },
+        "query": "stub price movement reasoning",
+    },
+    'hlr': {
+        "reasoning": "Stub reflection on past decisions.",
+        "improvement": "No improvement suggested (stub).",
+        "summary": "Stub lessons learnt.",
+        "query": "stub trading lesson",
+    },
+    'decision': {
+        "analysis": "Stub step-by-step analysis.",
+        "action": "HOLD",
+        "reasoning": "Stub decision.",
+    },
+}
+
+
+class StubBackend(LLMBackend):
+    """
+    Câu trả lời giả lập tất định (không gọi mạng). Lệnh của Decision chọn theo hash prompt
+    để kết quả đổi theo đầu vào nhưng lặp lại được. `latency`: giây chờ giả lập mỗi lời gọi.
+    """
+    name = "stub"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate(self, task, model, contents, config=None):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        response = json.loads(json.dumps(STUB_RESPONSES.get(task, {})))
+        if task == 'decision':
+            key = prompt_hash(task, model, contents, config)
+            response['action'] = ('BUY', 'SELL', 'HOLD')[int(key[:8], 16) % 3]
+        return json.dumps(response)
+
+
+def get_backend(name=None, api_key=None):
+    """Backend theo tên (mặc định settings.FINAGENT_LLM_BACKEND)."""
+    name = (name or getattr(settings, 'FINAGENT_LLM_BACKEND', 'gemini')).lower()
+    if name not in BACKEND_NAMES:
+        raise ValueError(f"FINAGENT_LLM_BACKEND phải là một trong: {', '.join(BACKEND_NAMES)}")
+    if name == 'stub':
+        return StubBackend(latency=getattr(settings, 'FINAGENT_STUB_LATENCY', 0.0))
+    if name == 'gemini':
+        return RateLimitedBackend(GeminiBackend(api_key))
+    path = getattr(settings, 'FINAGENT_LLM_CASSETTE_DIR', 'llm_cassettes')
+    inner = None if name == 'replay' else RateLimitedBackend(GeminiBackend(api_key))
+    return RecordReplayBackend(path, mode=name, inner=inner)
@@ -1,8 +1,13 @@
-from django.core.management.base import BaseCommand
-from ...models import CongTy, ThiTruongChungKhoang
+from django.core.management.base import BaseCommand, CommandError
+from ...models import BackfillTask, CongTy
 from ...gemeni_system import FinAgentSystem
-from ...utils import get_formatted_news, get_formatted_financials, get_price_action
+from ...backfill import DEFAULT_WORKERS, plan_backfill, pending_tasks, backfill_progress, run_backfill
+from ...rate_limit import get_gemini_limiter
+from ...memory_buffer import DEFAULT_MAX_RECORDS
+from django.db.models import Avg, Max
 import datetime
+import signal
+import threading
 import time
 import os
 from django.conf import settings
@@ -10,67 +15,117 @@ from django.conf import settings
 api_key = os.environ.get("GEMINI_API_KEY") or getattr(settings, 'GEMINI_API_KEY', None)
 
 class Command(BaseCommand):
-    help = 'Chạy backfill dữ liệu lịch sử vào Vector DB (FULL FLOW)'
+    help = (
+        'Backfill market intelligence (LMI -> Retrieval -> PMI) vào Vector DB cho nhiều mã / nhiều ngày, '
+        'chạy song song theo rate limit, checkpoint trong bảng BackfillTask để chạy tiếp khi bị ngắt'
+    )
 
-    def handle(self, *args, **kwargs):
-        symbol = "HPG" 
-        # Chạy từ quá khứ xa để tích lũy kinh nghiệm
-        start_date = datetime.date(2025, 12, 1) 
-        end_date = datetime.date(2025, 12, 3)
-        
+    def add_arguments(self, parser):
+        parser.add_argument('--ticker', nargs='+', help='Danh sách mã (VD: VN30). Mặc định: HPG')
+        parser.add_argument('--all', action='store_true', help='Mọi mã có trong bảng Công Ty')
+        parser.add_argument('--start', type=datetime.date.fromisoformat, required=True, help='Ngày bắt đầu (YYYY-MM-DD)')
+        parser.add_argument('--end', type=datetime.date.fromisoformat, required=True, help='Ngày kết thúc (YYYY-MM-DD)')
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Số worker chạy đồng thời')
+        parser.add_argument('--retry-failed', action='store_true', help='Chạy lại cả các công việc FAILED')
+        parser.add_argument('--unordered', action='store_true', help='Cho phép chạy song song nhiều ngày của cùng 1 mã')
+        parser.add_argument(
+            '--memory-batch', type=int,
+            help=(
+                'Gom N bản ghi ký ức rồi ghi Chroma 1 lần (0 = ghi ngay); công việc chỉ DONE sau khi ký ức đã ghi. '
+                'Mặc định: 0 khi chạy theo thứ tự ngày (ký ức ngày N phải truy vấn được ở ngày N+1 cùng mã, '
+                f'bật bộ đệm thì phải flush trước mỗi ngày kế tiếp nên lô ghi nhỏ), {DEFAULT_MAX_RECORDS} khi --unordered'
+            ),
+        )
+        parser.add_argument('--status', action='store_true', help='Chỉ in tiến độ, không chạy')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            symbols = list(CongTy.objects.order_by('maChungKhoan').values_list('maChungKhoan', flat=True))
+        else:
+            symbols = [ma.upper() for ma in (options['ticker'] or ["HPG"])]
+        start_date, end_date = options['start'], options['end']
+        if start_date > end_date:
+            raise CommandError("--start phải trước --end.")
+
+        # 1. Hàng đợi công việc (mã, ngày giao dịch) - checkpoint trong DB
+        created = plan_backfill(symbols, start_date, end_date)
+        progress = backfill_progress(symbols, start_date, end_date)
+        self.stdout.write(
+            f"--- BACKFILL {len(symbols)} mã, {start_date} -> {end_date}: {sum(progress.values())} công việc "
+            f"({created} mới) | " + ", ".join(f"{status}: {count}" for status, count in progress.items()) + " ---"
+        )
+        if options['status']:
+            self._report_timings(symbols, start_date, end_date)
+            return
+
+        tasks = pending_tasks(symbols, start_date, end_date, retry_failed=options['retry_failed'])
+        if not tasks:
+            self.stdout.write(self.style.SUCCESS("Không còn công việc cần chạy."))
+            return
+
+        # 2. Chạy song song; Ctrl+C -> dừng nhận việc mới, chờ việc đang chạy xong (chạy lại để tiếp tục)
         agent = FinAgentSystem(api_key=api_key)
+        memory_batch = options['memory_batch']
+        if memory_batch is None:
+            memory_batch = DEFAULT_MAX_RECORDS if options['unordered'] else 0
+        if memory_batch > 0:
+            # Ghi ký ức theo lô; ký ức chưa flush chưa truy vấn được (đánh đổi lấy tốc độ ghi)
+            agent.enable_memory_buffer(max_records=memory_batch)
+        stop_event = threading.Event()
+        previous_handler = signal.signal(signal.SIGINT, lambda *_: self._stop(stop_event))
+        start_time = time.time()
+        finished = [0]
 
-        current_date = start_date
-        
-        self.stdout.write(f"--- BẮT ĐẦU BACKFILL CHO {symbol} ---")
+        def on_done(symbol, date, ok, seconds):
+            finished[0] += 1
+            line = f"[{finished[0]}/{len(tasks)}] {symbol} {date}: {seconds:.1f}s"
+            self.stdout.write(self.style.SUCCESS(line) if ok else self.style.ERROR(f"{line} (lỗi)"))
 
-        while current_date <= end_date:
-            # 1. Kiểm tra có dữ liệu giao dịch không (Bỏ qua T7, CN, ngày lễ)
-            has_data = ThiTruongChungKhoang.objects.filter(
-                congTy__maChungKhoan=symbol, ngay=current_date
-            ).exists()
-            
-            if has_data:
-                self.stdout.write(f"Đang xử lý ngày: {current_date}...")
-                
-                try:
-                    # --- BƯỚC CHUẨN BỊ DỮ LIỆU ---
-                    news = get_formatted_news(symbol, current_date)
-                    fins = get_formatted_financials(symbol, current_date)
-                    prices = get_price_action(symbol, current_date)
+        try:
+            succeeded, failed = run_backfill(
+                agent, tasks, workers=options['workers'], ordered=not options['unordered'],
+                on_done=on_done, stop_event=stop_event,
+            )
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+            try:
+                flushed = agent.close()
+            except Exception as e:
+                # Công việc có ký ức chưa ghi được giữ trạng thái FLUSHING -> chạy lại ở lần sau
+                raise CommandError(f"Ghi ký ức thất bại ({e}); chạy lại cùng lệnh để làm lại các công việc FLUSHING.")
+            if agent.memory_buffer is not None:
+                buffer = agent.memory_buffer
+                self.stdout.write(f"Ký ức: {buffer.flushed} bản ghi / {buffer.flushes} lần ghi Chroma (lần cuối {flushed})")
 
-                    # --- STEP 1: PHÂN TÍCH HIỆN TẠI ---
-                    latest_analysis = agent.step_1_analyze_latest(
-                        symbol, str(current_date), news, fins, prices
-                    )
-                    
-                    if latest_analysis:
-                        # --- STEP 2: TRUY VẤN QUÁ KHỨ (RAG) ---
-                        queries = latest_analysis.get('queries', {})
-                        historical_context = agent.step_2_retrieve_history(queries)
-                        
-                        # --- STEP 3: TỔNG HỢP ---
-                        final_insight = agent.step_3_synthesize(latest_analysis, historical_context)
-                        
-                        if final_insight:
-                            # --- STEP 4: LƯU VÀO MEMORY ---
-                            agent.save_to_memory(
-                                symbol, 
-                                str(current_date), 
-                                latest_analysis['summary'], 
-                                final_insight 
-                            )
-                            self.stdout.write(self.style.SUCCESS(f"-> Đã lưu ký ức ngày {current_date}"))
-                        else:
-                            self.stdout.write(self.style.WARNING(f"-> Bỏ qua lưu ngày {current_date} do lỗi Step 3"))
-                    
-                    # --- THAY ĐỔI Ở ĐÂY ---
-                    self.stdout.write("Đang nghỉ 60 giây để tránh giới hạn API...")
-                    time.sleep(60) # Nghỉ 1 phút giữa các lần chạy
+        # 3. Tổng kết
+        elapsed = time.time() - start_time
+        metrics = get_gemini_limiter().metrics()
+        self.stdout.write(
+            f"Thời gian: {elapsed:.1f} giây ({(succeeded + failed) / elapsed * 3600:.0f} công việc / giờ) | "
+            f"Gemini: {metrics['calls']} lời gọi, {metrics['retries']} lần thử lại, chờ quota {metrics['total_wait_seconds']} giây"
+        )
+        self._report_timings(symbols, start_date, end_date)
+        if failed:
+            self.stdout.write(self.style.WARNING(f"{failed} công việc lỗi (chạy lại với --retry-failed)."))
+        if stop_event.is_set():
+            self.stdout.write(self.style.WARNING("Đã dừng giữa chừng, chạy lại cùng lệnh để tiếp tục."))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'--- BACKFILL HOÀN TẤT: {succeeded} thành công ---'))
 
-                except Exception as e:
-                      self.stdout.write(self.style.ERROR(f"Lỗi ngày {current_date}: {e}"))
+    def _stop(self, stop_event):
+        self.stdout.write(self.style.WARNING("Đang dừng: chờ các công việc đang chạy hoàn tất..."))
+        stop_event.set()
 
-            current_date += datetime.timedelta(days=1)
-            
-        self.stdout.write(self.style.SUCCESS('--- BACKFILL HOÀN TẤT ---'))
\ No newline at end of file
+    def _report_timings(self, symbols, start_date, end_date):
+        done = BackfillTask.objects.filter(
+            cong_ty_id__in=symbols, date__range=(start_date, end_date), status='DONE'
+        )
+        stats = done.aggregate(avg=Avg('duration_seconds'), max=Max('duration_seconds'))
+        if stats['avg'] is None:
+            return
+        steps = {}
+        for timings in done.values_list('timings', flat=True):
+            for step, seconds in timings.items():
+                steps.setdefault(step, []).append(seconds)
+        detail = ", ".join(f"{step} {sum(values) / len(values):.2f}s" for step, values in steps.items())
+        self.stdout.write(f"Thời gian / công việc: TB {stats['avg']:.2f}s, lớn nhất {stats['max']:.2f}s ({detail})")
@@ -0,0 +1,190 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...models import ThiTruongChungKhoang
+from ...utils import get_formatted_news, get_formatted_financials, get_price_action
+from ...indicators import summarize_technical_signals, describe_kline, describe_price_movements
+from ...indicator_state import get_recent_indicators
+from ...backtest import account_status_before, format_past_decisions
+from ...llm_backends import BACKEND_NAMES, RecordReplayBackend, StubBackend, get_backend
+from ...pipeline import DEFAULT_WORKERS, build_finagent_pipeline
+import json
+import statistics
+import time
+
+STAGES = ['data', 'lmi', 'retrieval', 'pmi', 'llr', 'pllr', 'hlr', 'phlr', 'decision']
+MIN_REGRESSION_MS = 5  # Bỏ qua chênh lệch tuyệt đối nhỏ hơn (nhiễu đo ở các bước rất nhanh)
+
+
+class Command(BaseCommand):
+    help = (
+        'Đo thời gian từng bước pipeline FinAgent (LMI -> PMI -> LLR -> HLR -> Decision) trên nhiều phiên; '
+        'dùng backend stub / replay để chạy offline và so với kết quả lần đo trước (baseline)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('symbol', nargs='?', default='HPG')
+        parser.add_argument('--days', type=int, default=5, help='Số phiên gần nhất để chạy')
+        parser.add_argument('--backend', choices=BACKEND_NAMES, default='stub', help='Backend LLM (mặc định stub, không cần mạng)')
+        parser.add_argument('--cassette-dir', help='Thư mục bản ghi cho record / replay / auto')
+        parser.add_argument('--latency', type=float, default=0.0, help='Độ trễ giả lập mỗi lời gọi (giây, chỉ backend stub)')
+        parser.add_argument('--pipeline', action='store_true', help='Chạy theo đồ thị phụ thuộc (các bước độc lập chạy đồng thời)')
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Số worker của --pipeline')
+        parser.add_argument(
+            '--persist-memory', action='store_true',
+            help='Ghi ký ức vào kho Chroma thật (./chroma_db_storage). Mặc định dùng kho tạm trong bộ nhớ '
+                 'vì ID ký ức cố định theo mã / ngày, chạy benchmark sẽ ghi đè ký ức thật bằng kết quả stub / replay'
+        )
+        parser.add_argument('--output', help='Ghi kết quả đo ra file JSON')
+        parser.add_argument('--baseline', help='File JSON của lần đo trước để so sánh')
+        parser.add_argument('--max-regression', type=float, default=0.2, help='Tỉ lệ chậm hơn baseline cho phép (0.2 = 20%%)')
+
+    def handle(self, *args, **options):
+        import chromadb
+        from ...gemeni_system import FinAgentSystem
+
+        symbol = options['symbol'].upper()
+        backend = self._backend(options)
+        chroma_client = None if options['persist_memory'] else chromadb.EphemeralClient()
+        try:
+            agent = FinAgentSystem(backend=backend, chroma_client=chroma_client)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        dates = list(
+            ThiTruongChungKhoang.objects.filter(congTy_id=symbol)
+            .order_by('-ngay').values_list('ngay', flat=True)[:options['days']]
+        )
+        if not dates:
+            raise CommandError(f"Không có dữ liệu giá của {symbol}.")
+
+        mode = 'pipeline' if options['pipeline'] else 'sequential'
+        self.stdout.write(f"--- BENCHMARK FINAGENT: {symbol}, {len(dates)} phiên, backend={options['backend']}, {mode} ---")
+        timings = {} if options['pipeline'] else {stage: [] for stage in STAGES}
+        totals = []
+        critical_paths = []
+        for date in sorted(dates):
+            start_time = time.perf_counter()
+            if options['pipeline']:
+                critical_paths.append(self._run_pipeline(agent, symbol, date, timings, options['workers']))
+            else:
+                self._run_once(agent, symbol, date, timings)
+            totals.append(time.perf_counter() - start_time)
+            self.stdout.write(f"  {date}: {totals[-1] * 1000:.1f} ms")
+
+        report = {stage: self._summary(values) for stage, values in timings.items() if values}
+        if critical_paths:
+            # Cận dưới của total khi các bước độc lập chạy đồng thời
+            report['critical'] = self._summary(critical_paths)
+        report['total'] = self._summary(totals)
+        self._print(report)
+        if isinstance(backend, RecordReplayBackend):
+            self.stdout.write(f"Bản ghi: {backend.hits} trúng, {backend.misses} thiếu")
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump({'symbol': symbol, 'backend': options['backend'], 'mode': mode, 'stages': report}, f, indent=2)
+            self.stdout.write(f"Đã ghi kết quả ra {options['output']}")
+        if options['baseline']:
+            self._compare(report, options['baseline'], options['max_regression'])
+
+    def _backend(self, options):
+        if options['backend'] == 'stub':
+            return StubBackend(latency=options['latency'])
+        try:
+            backend = get_backend(options['backend'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['cassette_dir'] and isinstance(backend, RecordReplayBackend):
+            backend = RecordReplayBackend(options['cassette_dir'], mode=backend.mode, inner=backend.inner)
+        return backend
+
+    def _run_once(self, agent, symbol, date, timings):
+        """1 phiên của pipeline như test_single_run, đo thời gian từng bước."""
+        date_str = str(date)
+
+        def timed(stage, func, *args, **kwargs):
+            start_time = time.perf_counter()
+            result = func(*args, **kwargs)
+            timings[stage].append(time.perf_counter() - start_time)
+            return result
+
+        def load_inputs():
+            frame = get_recent_indicators(symbol, as_of=date)
+            return {
+                'news': get_formatted_news(symbol, date),
+                'financials': get_formatted_financials(symbol, date),
+                'price': get_price_action(symbol, date),
+                'signals': summarize_technical_signals(frame),
+                'kline': describe_kline(frame),
+                'movements': describe_price_movements(frame),
+                'past_decisions': format_past_decisions(symbol, date),
+                'account_status': account_status_before(symbol, date),
+            }
+
+        inputs = timed('data', load_inputs)
+        lmi = timed('lmi', agent.run_latest_market_intelligence, symbol, date_str, inputs['news'], inputs['financials'], inputs['price'])
+        if not lmi:
+            raise CommandError(f"LMI thất bại ngày {date_str}.")
+        history = timed('retrieval', agent.retrieve_past_market_intelligence, lmi.get('queries', {}))
+        pmi = timed('pmi', agent.run_past_market_intelligence, lmi, history) or {}
+        summary = pmi.get('summary') or lmi.get('summary')
+        llr = timed('llr', agent.run_low_level_reflection, symbol, date_str, summary, inputs['movements'], inputs['kline']) or {}
+        pllr = timed('pllr', agent.retrieve_past_low_level_reflection, llr)
+        hlr = timed(
+            'hlr', agent.run_high_level_reflection, symbol, date_str, summary,
+            json.dumps(llr.get('reasoning', {})), inputs['past_decisions'],
+        ) or {}
+        phlr = timed('phlr', agent.retrieve_past_high_level_reflection, hlr_query_text=hlr.get('query'))
+        timed(
+            'decision', agent.run_decision_making, symbol, date_str,
+            market_intelligence=f"Latest Summary: {lmi.get('summary', '')}\nPast Context: {pmi.get('summary', 'N/A')}",
+            llr_reflection=f"{json.dumps(llr.get('reasoning', {}))}\nPast Reflections: {pllr}",
+            hlr_reflection=f"Current Reflection: {hlr.get('summary', 'N/A')}\nPast Lessons: {phlr}",
+            technical_signals=inputs['signals'],
+            account_status=inputs['account_status'],
+        )
+
+    def _run_pipeline(self, agent, symbol, date, timings, workers):
+        """1 phiên chạy theo DAG (pipeline.py); thời gian từng bước lấy từ trace. Trả về giây của đường găng."""
+        run = build_finagent_pipeline(agent, symbol, date, max_workers=workers).run()
+        if run.failed:
+            errors = ", ".join(f"{name}: {run.trace[name]['error']}" for name in run.failed)
+            raise CommandError(f"Pipeline thất bại ngày {date} ({errors}).")
+        for name, entry in run.trace.items():
+            timings.setdefault(name, []).append(entry['seconds'])
+        return run.critical_path()[1]
+
+    @staticmethod
+    def _summary(values):
+        ordered = sorted(values)
+        return {
+            'runs': len(values),
+            'mean_ms': statistics.fmean(values) * 1000,
+            'median_ms': statistics.median(values) * 1000,
+            'p95_ms': ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))] * 1000,
+        }
+
+    def _print(self, report):
+        self.stdout.write(f"{'Bước':<14}{'TB (ms)':>12}{'Trung vị':>12}{'P95':>12}")
+        for stage, values in report.items():
+            self.stdout.write(f"{stage:<14}{values['mean_ms']:>12.1f}{values['median_ms']:>12.1f}{values['p95_ms']:>12.1f}")
+
+    def _compare(self, report, path, max_regression):
+        try:
+            with open(path, encoding='utf-8') as f:
+                baseline = json.load(f)['stages']
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError(f"Không đọc được baseline {path}: {e}")
+
+        regressions = []
+        for stage, values in report.items():
+            previous = baseline.get(stage)
+            if not previous or previous['median_ms'] <= 0:
+                continue
+            ratio = values['median_ms'] / previous['median_ms'] - 1
+            if ratio > max_regression and values['median_ms'] - previous['median_ms'] >= MIN_REGRESSION_MS:
+                regressions.append(f"{stage}: {previous['median_ms']:.1f} -> {values['median_ms']:.1f} ms (+{ratio * 100:.0f}%)")
+        for line in regressions:
+            self.stdout.write(self.style.WARNING(f"  {line}"))
+        if regressions:
+            raise CommandError(f"{len(regressions)} bước chậm hơn baseline quá {max_regression * 100:.0f}%.")
+        self.stdout.write(self.style.SUCCESS("Không có bước nào chậm hơn baseline."))
@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand
+from ...ratio_engine import STATEMENT_COLUMNS, RATIO_KEYS, MARKET_KEYS, compute_ratio_frame, compute_ratios_reference
+import numpy as np
+import pandas as pd
+import time
+
+
+class Command(BaseCommand):
+    help = 'So sánh tốc độ bộ tính chỉ số vector hóa với vòng lặp cũ (dữ liệu giả lập, không cần DB)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tickers', type=int, default=1600, help='Số mã cổ phiếu giả lập')
+        parser.add_argument('--years', type=int, default=10, help='Số năm BCTC mỗi mã')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--null-rate', type=float, default=0.01, help='Tỉ lệ dòng BCTC có 1 trường NULL')
+
+    def handle(self, *args, **options):
+        n_tickers, n_years = options['tickers'], options['years']
+        rng = np.random.default_rng(options['seed'])
+
+        # 1. SINH DỮ LIỆU GIẢ LẬP (số nguyên VNĐ như BigIntegerField)
+        codes = [f"M{i:04d}" for i in range(n_tickers)]
+        years = list(range(2025 - n_years + 1, 2026))
+        n_rows = n_tickers * n_years
+
+        statements = pd.DataFrame({
+            'ma': np.repeat(codes, n_years),
+            'nam': np.tile(years, n_tickers),
+        })
+        for column in STATEMENT_COLUMNS:
+            statements[column] = rng.integers(10**9, 10**13, size=n_rows)
+        statements['LoiNhuanSauThue'] = rng.integers(-10**11, 10**12, size=n_rows)
+
+        # Dòng BCTC thiếu trường (NULL trong DB): công thức gốc lỗi TypeError -> bỏ qua cặp đó,
+        # hoặc vẫn tính được (VD: thiếu Nợ ngắn hạn -> safe_divide trả 0)
+        null_rows = np.flatnonzero(rng.random(n_rows) < options['null_rate'])
+        null_columns = rng.choice(STATEMENT_COLUMNS, size=len(null_rows))
+        for column in set(null_columns):
+            statements[column] = statements[column].astype(np.float64)
+        for row, column in zip(null_rows, null_columns):
+            statements.at[row, column] = np.nan
+        # Bản ghi cho vòng lặp cũ: NaN -> None như giá trị ORM đọc từ DB
+        records = statements.astype(object).where(statements.notna(), None).to_dict('records')
+
+        prices = {
+            (ma, nam): float(rng.integers(5, 200)) * 1000
+            for ma, nam in zip(statements['ma'], statements['nam'])
+        }
+        self.stdout.write(f"--- BENCHMARK: {n_tickers} mã x {n_years} năm ({n_rows} dòng BCTC) ---")
+
+        # 2. CÁCH CŨ: lặp từng công ty / từng năm
+        start_time = time.perf_counter()
+        reference = {}
+        by_company = {}
+        for record in records:
+            by_company.setdefault(record['ma'], {})[record['nam']] = record
+        for ma, processed_data in by_company.items():
+            for nam in years:
+                data_N = processed_data.get(nam)
+                data_N_minus_1 = processed_data.get(nam - 1)
+                if not data_N or not data_N_minus_1:
+                    continue
+                try:
+                    reference[(ma, nam)] = compute_ratios_reference(data_N, data_N_minus_1, prices.get((ma, nam), 0))
+                except TypeError:
+                    continue
+        loop_time = time.perf_counter() - start_time
+
+        # 3. CÁCH MỚI: vector hóa
+        start_time = time.perf_counter()
+        frame = compute_ratio_frame(statements, prices)
+        vector_time = time.perf_counter() - start_time
+
+        # 4. ĐỐI CHIẾU KẾT QUẢ
+        computed_pairs = set(zip(frame['ma'], frame['nam']))
+        if computed_pairs != set(reference):
+            self.stdout.write(self.style.ERROR(
+                f"Tập cặp khác nhau: {len(frame)} vs {len(reference)} "
+                f"(thừa {len(computed_pairs - set(reference))}, thiếu {len(set(reference) - computed_pairs)})"
+            ))
+            return
+        # Beta / độ biến động lấy từ chuỗi giá ngày (returns_engine), không so ở đây
+        keys = [key for key in RATIO_KEYS if key not in MARKET_KEYS]
+        pairs = zip(frame['ma'], frame['nam'])
+        expected = np.array([[reference[pair][key] for key in keys] for pair in pairs], dtype=np.float64)
+        max_diff = np.nanmax(np.abs(expected - frame[keys].to_numpy()) / np.maximum(np.abs(expected), 1e-12))
+
+        self.stdout.write(f"Vòng lặp cũ : {loop_time * 1000:.1f} ms")
+        self.stdout.write(f"Vector hóa  : {vector_time * 1000:.1f} ms")
+        self.stdout.write(f"Sai số tương đối lớn nhất: {max_diff:.2e} ({len(null_rows)} dòng có trường NULL)")
+        self.stdout.write(self.style.SUCCESS(f"Nhanh hơn {loop_time / vector_time:.1f} lần ({len(frame)} cặp công ty-năm)."))
@@ -0,0 +1,224 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from ...models import CongTy, TongHopTaiChinh, ThiTruongChungKhoang, BangCanDoiKeToan, BangKetQuaKinhDoanh
+from ...file_formats import read_price_file, read_statement_file, describe_file, PRICE_COLUMNS
+from ...ingest import upsert_price_rows, ingest_statement_rows
+from ...utils import refresh_financial_ratios
+from ...indicator_state import rebuild_indicator_states
+import io
+import time
+
+STATEMENT_MODELS = {
+    'balance': BangCanDoiKeToan,
+    'income': BangKetQuaKinhDoanh,
+}
+
+
+def _table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def _column(model, name):
+    return connection.ops.quote_name(model._meta.get_field(name).column)
+
+
+def _copy_frame(cursor, staging_table, columns, frame):
+    """COPY DataFrame vào bảng tạm qua STDIN (CSV, ô trống = NULL)."""
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False, header=False, columns=columns)
+    buffer.seek(0)
+    column_sql = ", ".join(connection.ops.quote_name(c) for c in columns)
+    cursor.copy_expert(f"COPY {staging_table} ({column_sql}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+class Command(BaseCommand):
+    help = (
+        'Nạp file lịch sử (CSV/XLS cafef, vietstock) vào DB: giá giao dịch (prices), '
+        'Bảng CĐKT (balance) hoặc Bảng KQKD (income). PostgreSQL dùng COPY vào bảng tạm '
+        'rồi merge bằng INSERT ... ON CONFLICT; DB khác dùng bulk upsert của ORM.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['prices', 'balance', 'income'], help='Loại dữ liệu trong file')
+        parser.add_argument('paths', nargs='+', help='Đường dẫn file CSV / XLS / XLSX')
+        parser.add_argument('--chunk-size', type=int, default=50000, help='Số dòng mỗi lần COPY / merge')
+        parser.add_argument('--method', choices=['auto', 'copy', 'orm'], default='auto',
+                            help='auto = COPY trên PostgreSQL, ORM trên DB khác')
+        parser.add_argument('--no-refresh', action='store_true', help='Không tính lại bảng chỉ số tài chính / trạng thái chỉ báo sau khi nạp')
+
+    def handle(self, *args, **options):
+        kind = options['kind']
+        method = options['method']
+        if method == 'auto':
+            method = 'copy' if connection.vendor == 'postgresql' else 'orm'
+        if method == 'copy' and connection.vendor != 'postgresql':
+            raise CommandError("COPY chỉ hỗ trợ PostgreSQL. Dùng --method orm.")
+
+        self.totals = {'rows': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'companies': 0}
+        price_symbols = set()
+        self.start_time = time.perf_counter()
+        self.stdout.write(f"--- NẠP DỮ LIỆU '{kind}' ({method.upper()}) ---")
+
+        for path in options['paths']:
+            self.stdout.write(f"📄 {describe_file(path)}")
+            try:
+                if kind == 'prices':
+                    chunks = read_price_file(path, options['chunk_size'])
+                else:
+                    value_fields = [f.name for f in STATEMENT_MODELS[kind]._meta.concrete_fields if not f.primary_key]
+                    chunks = read_statement_file(path, kind, options['chunk_size'], value_fields)
+
+                for frame, skipped in chunks:
+                    self.totals['skipped'] += skipped
+                    if frame.empty:
+                        continue
+                    if kind == 'prices':
+                        frame = frame.drop_duplicates(subset=['congTy', 'ngay'], keep='last')
+                        price_symbols.update(frame['congTy'].unique())
+                        result = self.load_prices_copy(frame) if method == 'copy' else self.load_prices_orm(frame)
+                    else:
+                        frame = frame.drop_duplicates(subset=['ma', 'nam', 'quy'], keep='last')
+                        model = STATEMENT_MODELS[kind]
+                        result = self.load_statements_copy(model, frame) if method == 'copy' else self.load_statements_orm(model, frame)
+                    self.report_progress(len(frame), result)
+            except (OSError, ImportError, ValueError, KeyError) as e:
+                raise CommandError(f"Không đọc được {path}: {e}")
+
+        duration = time.perf_counter() - self.start_time
+        totals = self.totals
+        self.stdout.write(self.style.SUCCESS(
+            f"Hoàn tất: {totals['rows']} dòng trong {duration:.2f} giây "
+            f"({totals['rows'] / duration if duration else 0:,.0f} dòng/giây). "
+            f"Thêm {totals['inserted']}, cập nhật {totals['updated']}, bỏ qua {totals['skipped']}, "
+            f"công ty mới {totals['companies']}."
+        ))
+
+        if not options['no_refresh']:
+            refresh_start = time.perf_counter()
+            count = refresh_financial_ratios()
+            self.stdout.write(f"Đã tính lại {count} dòng chỉ số tài chính trong {time.perf_counter() - refresh_start:.2f} giây.")
+            if price_symbols:
+                refresh_start = time.perf_counter()
+                count = rebuild_indicator_states(sorted(price_symbols))
+                self.stdout.write(f"Đã dựng lại trạng thái chỉ báo của {count} mã trong {time.perf_counter() - refresh_start:.2f} giây.")
+
+    def report_progress(self, rows, result):
+        for key, value in result.items():
+            self.totals[key] += value
+        self.totals['rows'] += rows
+        elapsed = time.perf_counter() - self.start_time
+        self.stdout.write(
+            f"  + {rows} dòng (tổng {self.totals['rows']}, "
+            f"{self.totals['rows'] / elapsed if elapsed else 0:,.0f} dòng/giây)"
+        )
+
+    # ==========================================================
+    # POSTGRESQL: COPY -> bảng tạm -> INSERT ... ON CONFLICT
+    # ==========================================================
+    def load_prices_copy(self, frame):
+        price_table = _table(ThiTruongChungKhoang)
+        company_table = _table(CongTy)
+        columns = [ThiTruongChungKhoang._meta.get_field(name).column for name in PRICE_COLUMNS]
+        column_sql = ", ".join(connection.ops.quote_name(c) for c in columns)
+        value_columns = [connection.ops.quote_name(c) for c in columns[2:]]
+        congty_col = _column(ThiTruongChungKhoang, 'congTy')
+        ngay_col = _column(ThiTruongChungKhoang, 'ngay')
+
+        frame = frame.rename(columns=dict(zip(PRICE_COLUMNS, columns)))
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMP TABLE stg_thitruong ON COMMIT DROP AS "
+                f"SELECT {column_sql} FROM {price_table} WITH NO DATA"
+            )
+            _copy_frame(cursor, "stg_thitruong", columns, frame)
+
+            # 1 câu lệnh: tạo mã CK còn thiếu + upsert giá (FK của Django là DEFERRABLE
+            # nên được kiểm tra lúc commit, sau khi công ty mới đã được thêm)
+            cursor.execute(f"""
+                WITH new_companies AS (
+                    INSERT INTO {company_table} ({_column(CongTy, 'tenCongTy')}, {_column(CongTy, 'maChungKhoan')})
+                    SELECT DISTINCT 'Công ty ' || {congty_col}, {congty_col} FROM stg_thitruong
+                    ON CONFLICT ({_column(CongTy, 'maChungKhoan')}) DO NOTHING
+                    RETURNING 1
+                ), upserted AS (
+                    INSERT INTO {price_table} ({column_sql})
+                    SELECT {column_sql} FROM stg_thitruong
+                    ON CONFLICT ({congty_col}, {ngay_col}) DO UPDATE SET
+                        {", ".join(f"{c} = EXCLUDED.{c}" for c in value_columns)}
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT
+                    (SELECT count(*) FROM new_companies),
+                    count(*) FILTER (WHERE inserted),
+                    count(*) FILTER (WHERE NOT inserted)
+                FROM upserted
+            """)
+            companies, inserted, updated = cursor.fetchone()
+        return {'inserted': inserted, 'updated': updated, 'companies': companies}
+
+    def load_statements_copy(self, model, frame):
+        statement_table = _table(model)
+        report_table = _table(TongHopTaiChinh)
+        company_table = _table(CongTy)
+        value_fields = [name for name in frame.columns if name not in ('ma', 'nam', 'quy')]
+        value_columns = [connection.ops.quote_name(model._meta.get_field(name).column) for name in value_fields]
+        bao_cao_col = _column(model, 'baoCao')
+        report_congty = _column(TongHopTaiChinh, 'congTy')
+        report_id = _column(TongHopTaiChinh, 'id')
+
+        staging_columns = ["ma varchar(10)", "nam integer", "quy integer"] + [
+            f"{column} {model._meta.get_field(name).db_type(connection)}"
+            for name, column in zip(value_fields, value_columns)
+        ]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"CREATE TEMP TABLE stg_bctc ({', '.join(staging_columns)}) ON COMMIT DROP")
+            frame = frame.rename(columns={name: model._meta.get_field(name).column for name in value_fields})
+            _copy_frame(cursor, "stg_bctc", list(frame.columns), frame)
+
+            # 1. Mã CK và kỳ báo cáo còn thiếu
+            cursor.execute(f"""
+                INSERT INTO {company_table} ({_column(CongTy, 'tenCongTy')}, {_column(CongTy, 'maChungKhoan')})
+                SELECT DISTINCT 'Công ty ' || ma, ma FROM stg_bctc
+                ON CONFLICT ({_column(CongTy, 'maChungKhoan')}) DO NOTHING
+            """)
+            companies = cursor.rowcount
+            cursor.execute(f"""
+                INSERT INTO {report_table} ({report_congty}, nam, quy)
+                SELECT DISTINCT ma, nam, quy FROM stg_bctc
+                ON CONFLICT ({report_congty}, nam, quy) DO NOTHING
+            """)
+
+            # 2. Upsert số liệu theo baoCao
+            cursor.execute(f"""
+                WITH upserted AS (
+                    INSERT INTO {statement_table} ({bao_cao_col}, {", ".join(value_columns)})
+                    SELECT r.{report_id}, {", ".join(f"s.{c}" for c in value_columns)}
+                    FROM stg_bctc s
+                    JOIN {report_table} r ON r.{report_congty} = s.ma AND r.nam = s.nam AND r.quy = s.quy
+                    ON CONFLICT ({bao_cao_col}) DO UPDATE SET
+                        {", ".join(f"{c} = EXCLUDED.{c}" for c in value_columns)}
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted
+            """)
+            inserted, updated = cursor.fetchone()
+        return {'inserted': inserted, 'updated': updated, 'companies': companies}
+
+    # ==========================================================
+    # DB KHÁC (SQLite khi dev): bulk upsert qua ORM
+    # ==========================================================
+    def load_prices_orm(self, frame):
+        records = frame.astype(object).where(frame.notna(), None).to_dict('records')
+        result = upsert_price_rows(records, refresh=False)
+        for error in result['rejected'][:5]:
+            self.stdout.write(self.style.WARNING(f"    {error}"))
+        return {'inserted': result['inserted'], 'updated': result['updated'], 'skipped': len(result['rejected'])}
+
+    def load_statements_orm(self, model, frame):
+        frame = frame.rename(columns={'nam': 'years'})
+        records = frame.astype(object).where(frame.notna(), None).to_dict('records')
+        saved_count, errors = ingest_statement_rows(model, records, refresh=False)
+        for error in errors[:5]:
+            self.stdout.write(self.style.WARNING(f"    {error}"))
+        # ORM không phân biệt thêm mới / cập nhật
+        return {'inserted': saved_count, 'skipped': len(errors)}
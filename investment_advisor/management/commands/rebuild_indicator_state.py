@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...indicator_state import rebuild_indicator_states, verify_indicator_states
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        'Dựng lại bảng trạng thái chỉ báo kỹ thuật (TrangThaiChiBao) từ toàn bộ lịch sử giá, '
+        'hoặc đối chiếu trạng thái đang lưu (cập nhật tăng dần) với kết quả tính lại từ đầu'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ticker', nargs='+', help='Chỉ xử lý các mã này (mặc định: tất cả)')
+        parser.add_argument('--check', action='store_true', help='Chỉ đối chiếu, không ghi DB')
+        parser.add_argument('--tolerance', type=float, default=1e-6, help='Sai số tương đối cho phép khi đối chiếu')
+
+    def handle(self, *args, **options):
+        symbols = [ma.upper() for ma in options['ticker']] if options['ticker'] else None
+        start_time = time.time()
+
+        if not options['check']:
+            self.stdout.write("--- ĐANG DỰNG LẠI TRẠNG THÁI CHỈ BÁO ---")
+            count = rebuild_indicator_states(symbols)
+            self.stdout.write(f"Đã dựng {count} mã trong {time.time() - start_time:.2f} giây.")
+
+        self.stdout.write("--- ĐỐI CHIẾU VỚI KẾT QUẢ TÍNH TỪ ĐẦU ---")
+        problems = verify_indicator_states(symbols, tolerance=options['tolerance'])
+        for problem in problems[:50]:
+            self.stdout.write(self.style.WARNING(f"  {problem}"))
+        if problems:
+            raise CommandError(f"{len(problems)} sai lệch giữa trạng thái đang lưu và kết quả tính lại.")
+        self.stdout.write(self.style.SUCCESS(f"Trạng thái khớp ({time.time() - start_time:.2f} giây)."))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from ...utils import refresh_financial_ratios
+import time
+
+
+class Command(BaseCommand):
+    help = 'Tính lại toàn bộ bảng chỉ số tài chính (ChiSoTaiChinh) từ BCTC và giá thị trường'
+
+    def handle(self, *args, **kwargs):
+        self.stdout.write("--- ĐANG DỰNG LẠI BẢNG CHỈ SỐ TÀI CHÍNH ---")
+        start_time = time.time()
+
+        count = refresh_financial_ratios()
+
+        duration = time.time() - start_time
+        self.stdout.write(self.style.SUCCESS(f"Đã ghi {count} dòng chỉ số trong {duration:.2f} giây."))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from ...utils import refresh_market_stats
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        'Tính lại Beta / độ biến động năm của mọi mã (chỉ số thị trường dựng từ toàn bộ mã). '
+        'Upload qua API đã tự ghi cho các năm bị ảnh hưởng; lệnh này dùng khi sửa giá trực tiếp trong DB / admin'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int, nargs='+', help='Chỉ các năm này (mặc định: mọi năm đã có chỉ số)')
+
+    def handle(self, *args, **options):
+        years = options['year']
+        self.stdout.write(f"--- TÍNH LẠI BETA / ĐỘ BIẾN ĐỘNG ({', '.join(map(str, years)) if years else 'mọi năm'}) ---")
+        start_time = time.time()
+
+        count = refresh_market_stats(years)
+
+        duration = time.time() - start_time
+        self.stdout.write(self.style.SUCCESS(f"Đã cập nhật {count} dòng chỉ số trong {duration:.2f} giây."))
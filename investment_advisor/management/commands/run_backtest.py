@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...backtest import RULE_STRATEGIES, AgentStrategy, DEFAULT_CASH, run_backtest, strategy_label
+import datetime
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        'Backtest theo từng phiên trên ThiTruongChungKhoang: chiến lược quy tắc (MACD / KDJ+RSI / '
+        'Mean Reversion) hoặc FinAgent, ghi quyết định vào TradingDecision và báo cáo equity / drawdown / Sharpe'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('symbol', help='Mã chứng khoán (VD: HPG)')
+        parser.add_argument(
+            '--strategy', default='macd_crossover', choices=list(RULE_STRATEGIES) + ['agent'],
+            help='Chiến lược ra quyết định (agent = gọi Gemini từng phiên, chậm)',
+        )
+        parser.add_argument('--start', type=datetime.date.fromisoformat, help='Ngày bắt đầu (YYYY-MM-DD)')
+        parser.add_argument('--end', type=datetime.date.fromisoformat, help='Ngày kết thúc (YYYY-MM-DD)')
+        parser.add_argument('--cash', type=float, default=DEFAULT_CASH, help='Tiền mặt ban đầu (VNĐ)')
+        parser.add_argument('--fill', choices=['close', 'next_open'], default='close', help='Giá khớp lệnh')
+        parser.add_argument('--no-save', action='store_true', help='Không ghi TradingDecision')
+        parser.add_argument(
+            '--append', action='store_true',
+            help='Ghi thêm thay vì thay thế quyết định cũ cùng mã / chiến lược / cách khớp / khoảng ngày (mặc định thay thế)',
+        )
+
+    def handle(self, *args, **options):
+        if options['strategy'] == 'agent':
+            from ...gemeni_system import FinAgentSystem
+            try:
+                # Backend LLM theo settings.FINAGENT_LLM_BACKEND (gemini / replay / stub ...)
+                strategy = AgentStrategy(FinAgentSystem())
+            except ValueError as e:
+                raise CommandError(str(e))
+        else:
+            strategy = RULE_STRATEGIES[options['strategy']]()
+
+        def progress(index, total, date):
+            self.stdout.write(f"  [{index + 1}/{total}] {date}")
+
+        start_time = time.time()
+        try:
+            result = run_backtest(
+                options['symbol'], strategy,
+                start=options['start'], end=options['end'], initial_cash=options['cash'],
+                fill=options['fill'], record=not options['no_save'], replace=not options['append'],
+                progress=progress,
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        metrics = result['metrics']
+        self.stdout.write(self.style.SUCCESS(
+            f"--- BACKTEST {options['symbol'].upper()} / {strategy.name}: "
+            f"{metrics['sessions']} phiên trong {time.time() - start_time:.2f} giây ---"
+        ))
+
+        def percent(value):
+            return "N/A" if value is None else f"{value * 100:.2f}%"
+
+        self.stdout.write(f"Vốn đầu / cuối: {metrics['start_equity']:,.0f} -> {metrics['end_equity']:,.0f} VNĐ")
+        self.stdout.write(f"Lợi nhuận: {percent(metrics['total_return'])} (năm hóa {percent(metrics['annual_return'])})")
+        self.stdout.write(f"Độ biến động năm: {percent(metrics['annual_volatility'])}")
+        sharpe = metrics['sharpe']
+        self.stdout.write(f"Sharpe: {'N/A' if sharpe is None else f'{sharpe:.2f}'}")
+        self.stdout.write(f"Max drawdown: {percent(metrics['max_drawdown'])} ({metrics['max_drawdown_date'].date()})")
+        self.stdout.write(f"Số lệnh khớp: {metrics['trades']}")
+        if not options['no_save']:
+            self.stdout.write(f"Đã ghi {len(result['decisions'])} TradingDecision (strategy='{strategy_label(strategy.name, options['fill'])}').")
@@ -0,0 +1,127 @@
+# investment_advisor/memory_buffer.py
+"""
+Bộ đệm ghi sau (write-behind) cho 3 tầng ký ức ChromaDB của FinAgentSystem.
+
+Mặc định mỗi (mã, ngày) upsert vài document vào từng collection bằng lời gọi riêng,
+Chroma embed lại từng lô nhỏ và commit SQLite mỗi lần. Khi bật bộ đệm (backfill lớn),
+bản ghi được gom lại theo collection và ghi theo lô lớn:
+
+- embedding tính trước 1 lần cho cả lô (embed_documents) rồi truyền vào upsert
+- mỗi collection 1 upsert / lô (chia theo giới hạn batch của Chroma)
+- cùng id ghi nhiều lần trước khi flush -> chỉ giữ bản cuối
+
+Bản ghi chưa flush chưa tìm thấy được qua query; gọi flush() / close() (hoặc dùng
+`with`) để chắc chắn mọi ký ức đã được ghi. on_flushed(callback) báo khi các bản ghi
+đã add tới thời điểm đó chắc chắn đã vào Chroma (VD: chỉ đánh dấu checkpoint lúc này).
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_RECORDS = 256
+DEFAULT_CHROMA_BATCH_SIZE = 5000
+
+
+class MemoryWriteBuffer:
+    """
+    collections: dict {tên: chromadb Collection}
+    embed_documents: callable(list[str]) -> list[vector]
+    max_records: tự flush khi số bản ghi chờ đạt ngưỡng
+    max_batch_size: số bản ghi tối đa mỗi lời gọi upsert (client.get_max_batch_size())
+    """
+
+    def __init__(self, collections, embed_documents, max_records=DEFAULT_MAX_RECORDS,
+                 max_batch_size=DEFAULT_CHROMA_BATCH_SIZE):
+        self.collections = collections
+        self.embed_documents = embed_documents
+        self.max_records = max_records
+        self.max_batch_size = max_batch_size
+        self._pending = {name: {} for name in collections}  # {tên: {id: (document, metadata)}}
+        self._waiters = []  # callback chờ lần flush thành công kế tiếp
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.added = 0
+        self.flushed = 0
+        self.flushes = 0
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(records) for records in self._pending.values())
+
+    def add(self, collection_name, ids, documents, metadatas):
+        """Thêm bản ghi vào hàng chờ; tự flush khi đủ max_records."""
+        with self._lock:
+            pending = self._pending[collection_name]
+            for record_id, document, metadata in zip(ids, documents, metadatas):
+                pending[record_id] = (document, metadata)
+            self.added += len(ids)
+            full = sum(len(records) for records in self._pending.values()) >= self.max_records
+        if full:
+            self.flush()
+
+    def on_flushed(self, callback):
+        """
+        Gọi callback() sau lần flush thành công kế tiếp: mọi bản ghi đã add trước lời gọi này
+        khi đó đã được ghi (kể cả khi chúng nằm trong lần flush đang chạy dở).
+        """
+        with self._lock:
+            self._waiters.append(callback)
+
+    def flush(self):
+        """Ghi toàn bộ bản ghi đang chờ. Trả về số bản ghi đã ghi."""
+        # 1 luồng flush tại một thời điểm; các luồng khác vẫn add() vào hàng chờ mới
+        with self._flush_lock:
+            with self._lock:
+                batches = {name: records for name, records in self._pending.items() if records}
+                self._pending = {name: {} for name in self.collections}
+                waiters, self._waiters = self._waiters, []
+            written = 0
+            names = list(batches)
+            for position, name in enumerate(names):
+                try:
+                    written += self._write(self.collections[name], batches[name])
+                except Exception as e:
+                    # Ghi lỗi -> trả lại hàng chờ bản ghi của collection này và các collection chưa ghi
+                    # (bản mới hơn cùng id được giữ); callback chờ lần flush sau
+                    logger.error(f"Flush memory '{name}' error: {e}")
+                    with self._lock:
+                        for unwritten in names[position:]:
+                            for record_id, record in batches[unwritten].items():
+                                self._pending[unwritten].setdefault(record_id, record)
+                        self._waiters[:0] = waiters
+                    raise
+            if written:
+                self.flushed += written
+                self.flushes += 1
+                logger.info(f"Flushed {written} memory records")
+            for callback in waiters:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"Memory flush callback error: {e}")
+            return written
+
+    def _write(self, collection, records):
+        ids = list(records)
+        documents = [records[record_id][0] for record_id in ids]
+        metadatas = [records[record_id][1] for record_id in ids]
+        embeddings = self.embed_documents(documents)
+        for start in range(0, len(ids), self.max_batch_size):
+            end = start + self.max_batch_size
+            collection.upsert(
+                ids=ids[start:end],
+                documents=documents[start:end],
+                metadatas=metadatas[start:end],
+                embeddings=embeddings[start:end],
+            )
+        return len(ids)
+
+    def close(self):
+        return self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
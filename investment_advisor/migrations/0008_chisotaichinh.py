@@ -0,0 +1,62 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:48
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_advisor', '0007_tintuc'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TradingDecision',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(default=django.utils.timezone.now)),
+                ('account_cash', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('account_position', models.IntegerField(default=0)),
+                ('analysis_log', models.TextField(verbose_name='Quá trình phân tích (Reasoning)')),
+                ('action', models.CharField(choices=[('BUY', 'MUA'), ('SELL', 'BÁN'), ('HOLD', 'GIỮ')], max_length=10)),
+                ('final_reasoning', models.TextField(verbose_name='Lý do chốt hạ')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('cong_ty', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trading_decisions', to='investment_advisor.congty')),
+            ],
+            options={
+                'verbose_name': '4. Trading Decision',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ChiSoTaiChinh',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nam', models.IntegerField(verbose_name='Năm')),
+                ('quy', models.IntegerField(default=0, verbose_name='Quý')),
+                ('roa', models.FloatField(blank=True, null=True, verbose_name='ROA')),
+                ('roe', models.FloatField(blank=True, null=True, verbose_name='ROE')),
+                ('tySuatThanhToanHienHanh', models.FloatField(blank=True, null=True, verbose_name='Tỷ suất thanh toán hiện hành')),
+                ('heSoNoTrenTongTaiSan', models.FloatField(blank=True, null=True, verbose_name='Hệ số nợ / Tổng tài sản')),
+                ('tangTruongTaiSan', models.FloatField(blank=True, null=True, verbose_name='Tăng trưởng tài sản')),
+                ('tangTruongLoiNhuan', models.FloatField(blank=True, null=True, verbose_name='Tăng trưởng lợi nhuận')),
+                ('eps', models.FloatField(blank=True, null=True, verbose_name='EPS')),
+                ('pe', models.FloatField(blank=True, null=True, verbose_name='P/E')),
+                ('pb', models.FloatField(blank=True, null=True, verbose_name='P/B')),
+                ('beta', models.FloatField(blank=True, null=True, verbose_name='Beta')),
+                ('giaDongCuaCuoiNam', models.FloatField(blank=True, null=True, verbose_name='Giá đóng cửa cuối năm (VNĐ)')),
+                ('tyLeNoDaiHan', models.FloatField(blank=True, null=True, verbose_name='Tỷ lệ nợ dài hạn')),
+                ('ngayCapNhat', models.DateTimeField(auto_now=True, verbose_name='Ngày cập nhật')),
+                ('congTy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='investment_advisor.congty', to_field='maChungKhoan', verbose_name='Công ty')),
+            ],
+            options={
+                'verbose_name': 'Chỉ Số Tài Chính',
+                'verbose_name_plural': 'Các Chỉ Số Tài Chính',
+                'ordering': ['congTy', 'nam', 'quy'],
+                'indexes': [models.Index(fields=['quy', 'nam'], name='chisotaichinh_quy_nam_idx')],
+                'unique_together': {('congTy', 'nam', 'quy')},
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.5 on 2026-10-18 09:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_advisor', '0008_chisotaichinh'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrangThaiChiBao',
+            fields=[
+                ('congTy', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='investment_advisor.congty', to_field='maChungKhoan', verbose_name='Công ty')),
+                ('ngayCuoi', models.DateField(verbose_name='Ngày giao dịch cuối')),
+                ('soPhien', models.IntegerField(default=0, verbose_name='Số phiên đã tính')),
+                ('giaDongCuaCuoi', models.FloatField(verbose_name='Giá đóng cửa phiên cuối (nghìn VNĐ)')),
+                ('emaNhanh', models.FloatField(verbose_name='EMA 12')),
+                ('emaCham', models.FloatField(verbose_name='EMA 26')),
+                ('dea', models.FloatField(verbose_name='DEA (MACD signal)')),
+                ('tbTang', models.FloatField(verbose_name='Trung bình tăng (RSI)')),
+                ('tbGiam', models.FloatField(verbose_name='Trung bình giảm (RSI)')),
+                ('kdjK', models.FloatField(verbose_name='KDJ K')),
+                ('kdjD', models.FloatField(verbose_name='KDJ D')),
+                ('cuaSo', models.JSONField(default=list, verbose_name='Cửa sổ phiên gần nhất')),
+                ('chiBao', models.JSONField(default=dict, verbose_name='Chỉ báo phiên cuối')),
+                ('ngayCapNhat', models.DateTimeField(auto_now=True, verbose_name='Ngày cập nhật')),
+            ],
+            options={
+                'verbose_name': 'Trạng Thái Chỉ Báo',
+                'verbose_name_plural': 'Trạng Thái Chỉ Báo',
+                'ordering': ['congTy'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 09:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_advisor', '0009_trangthaichibao'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chisotaichinh',
+            name='doBienDong',
+            field=models.FloatField(blank=True, null=True, verbose_name='Độ biến động năm (annualized)'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_advisor', '0010_chisotaichinh_dobiendong'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tradingdecision',
+            name='strategy',
+            field=models.CharField(db_index=True, default='agent', max_length=50),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.5 on 2026-10-18 09:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_advisor', '0011_tradingdecision_strategy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackfillTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('status', models.CharField(choices=[('PENDING', 'Chờ chạy'), ('RUNNING', 'Đang chạy'), ('DONE', 'Hoàn tất'), ('FAILED', 'Lỗi')], db_index=True, default='PENDING', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('timings', models.JSONField(default=dict)),
+                ('duration_seconds', models.FloatField(blank=True, null=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('cong_ty', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='backfill_tasks', to='investment_advisor.congty', to_field='maChungKhoan')),
+            ],
+            options={
+                'verbose_name': '5. Backfill Task',
+                'ordering': ['date', 'cong_ty'],
+                'constraints': [models.UniqueConstraint(fields=('cong_ty', 'date'), name='unique_backfill_task')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('investment_advisor', '0012_backfilltask'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='backfilltask',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Chờ chạy'), ('RUNNING', 'Đang chạy'), ('FLUSHING', 'Chờ ghi ký ức'), ('DONE', 'Hoàn tất'), ('FAILED', 'Lỗi')], db_index=True, default='PENDING', max_length=10),
+        ),
+    ]
@@ -212,6 +212,75 @@ class BangKetQuaKinhDoanh(models.Model):
         verbose_name = "Bảng Kết Quả Kinh Doanh"
         verbose_name_plural = "Các Bảng Kết Quả Kinh Doanh"
 
+# Bảng lưu sẵn chỉ số tài chính đã tính (mỗi công ty / năm / kỳ một dòng)
+# Được tính lại bởi utils.refresh_financial_ratios mỗi khi dữ liệu nguồn thay đổi.
+class ChiSoTaiChinh(models.Model):
+    congTy = models.ForeignKey(CongTy, to_field='maChungKhoan', on_delete=models.CASCADE, verbose_name="Công ty")
+    nam = models.IntegerField(verbose_name="Năm")
+    quy = models.IntegerField(default=0, verbose_name="Quý") # 0 = chỉ số cả năm
+
+    roa = models.FloatField(null=True, blank=True, verbose_name="ROA")
+    roe = models.FloatField(null=True, blank=True, verbose_name="ROE")
+    tySuatThanhToanHienHanh = models.FloatField(null=True, blank=True, verbose_name="Tỷ suất thanh toán hiện hành")
+    heSoNoTrenTongTaiSan = models.FloatField(null=True, blank=True, verbose_name="Hệ số nợ / Tổng tài sản")
+    tangTruongTaiSan = models.FloatField(null=True, blank=True, verbose_name="Tăng trưởng tài sản")
+    tangTruongLoiNhuan = models.FloatField(null=True, blank=True, verbose_name="Tăng trưởng lợi nhuận")
+    eps = models.FloatField(null=True, blank=True, verbose_name="EPS")
+    pe = models.FloatField(null=True, blank=True, verbose_name="P/E")
+    pb = models.FloatField(null=True, blank=True, verbose_name="P/B")
+    beta = models.FloatField(null=True, blank=True, verbose_name="Beta")
+    giaDongCuaCuoiNam = models.FloatField(null=True, blank=True, verbose_name="Giá đóng cửa cuối năm (VNĐ)")
+    tyLeNoDaiHan = models.FloatField(null=True, blank=True, verbose_name="Tỷ lệ nợ dài hạn")
+    doBienDong = models.FloatField(null=True, blank=True, verbose_name="Độ biến động năm (annualized)")
+
+    ngayCapNhat = models.DateTimeField(auto_now=True, verbose_name="Ngày cập nhật")
+
+    def __str__(self):
+        return f"Chỉ số - {self.congTy_id} - Năm {self.nam}, Quý {self.quy}"
+
+    class Meta:
+        verbose_name = "Chỉ Số Tài Chính"
+        verbose_name_plural = "Các Chỉ Số Tài Chính"
+        ordering = ['congTy', 'nam', 'quy']
+        unique_together = ('congTy', 'nam', 'quy') # Mỗi cty chỉ có 1 dòng chỉ số cho mỗi kỳ
+        indexes = [
+            models.Index(fields=['quy', 'nam'], name='chisotaichinh_quy_nam_idx'),
+        ]
+
+# Trạng thái chỉ báo kỹ thuật của phiên cuối (mỗi công ty một dòng).
+# Được cập nhật tăng dần bởi indicator_state.update_indicator_states khi có phiên mới,
+# nên không phải quét lại toàn bộ lịch sử giá.
+class TrangThaiChiBao(models.Model):
+    congTy = models.OneToOneField(CongTy, to_field='maChungKhoan', on_delete=models.CASCADE, primary_key=True, verbose_name="Công ty")
+    ngayCuoi = models.DateField(verbose_name="Ngày giao dịch cuối")
+    soPhien = models.IntegerField(default=0, verbose_name="Số phiên đã tính")
+    giaDongCuaCuoi = models.FloatField(verbose_name="Giá đóng cửa phiên cuối (nghìn VNĐ)")
+
+    # Trạng thái đệ quy (EMA / Wilder / KDJ) sau phiên cuối
+    emaNhanh = models.FloatField(verbose_name="EMA 12")
+    emaCham = models.FloatField(verbose_name="EMA 26")
+    dea = models.FloatField(verbose_name="DEA (MACD signal)")
+    tbTang = models.FloatField(verbose_name="Trung bình tăng (RSI)")
+    tbGiam = models.FloatField(verbose_name="Trung bình giảm (RSI)")
+    kdjK = models.FloatField(verbose_name="KDJ K")
+    kdjD = models.FloatField(verbose_name="KDJ D")
+
+    # Cửa sổ các phiên gần nhất [[ngay, giá + chỉ báo theo indicator_state.WINDOW_COLUMNS], ...]
+    # cho MA / Bollinger / RSV và prompt của agent (get_recent_indicators)
+    cuaSo = models.JSONField(default=list, verbose_name="Cửa sổ phiên gần nhất")
+    # Giá trị các chỉ báo tại phiên cuối (MA, Bollinger, MACD, RSI, KDJ)
+    chiBao = models.JSONField(default=dict, verbose_name="Chỉ báo phiên cuối")
+
+    ngayCapNhat = models.DateTimeField(auto_now=True, verbose_name="Ngày cập nhật")
+
+    def __str__(self):
+        return f"Trạng thái chỉ báo - {self.congTy_id} - {self.ngayCuoi}"
+
+    class Meta:
+        verbose_name = "Trạng Thái Chỉ Báo"
+        verbose_name_plural = "Trạng Thái Chỉ Báo"
+        ordering = ['congTy']
+
 class TinTuc(models.Model):
     title = models.CharField(max_length=500, verbose_name="Tiêu đề bài viết", blank=True, null=True)
     content = models.TextField(verbose_name="Nội dung bài viết", blank=True, null=True)
@@ -300,6 +369,9 @@ class TradingDecision(models.Model):
     action = models.CharField(max_length=10, choices=ACTION_CHOICES)
     
     final_reasoning = models.TextField(verbose_name="Lý do chốt hạ")
+
+    # Nguồn quyết định: 'agent' (Gemini) hoặc tên chiến lược backtest (backtest.py)
+    strategy = models.CharField(max_length=50, default='agent', db_index=True)
     
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -308,4 +380,36 @@ class TradingDecision(models.Model):
         verbose_name = "4. Trading Decision"
 
     def __str__(self):
-        return f"{self.action} - {self.cong_ty.maChungKhoan} - {self.date}"
\ No newline at end of file
+        return f"{self.action} - {self.cong_ty.maChungKhoan} - {self.date}"
+
+class BackfillTask(models.Model):
+    """1 công việc (mã, ngày) của backfill market intelligence; dùng làm checkpoint để chạy tiếp khi bị ngắt."""
+    cong_ty = models.ForeignKey(CongTy, to_field='maChungKhoan', on_delete=models.CASCADE, related_name='backfill_tasks')
+    date = models.DateField()
+
+    STATUS_CHOICES = [
+        ('PENDING', 'Chờ chạy'),
+        ('RUNNING', 'Đang chạy'),
+        ('FLUSHING', 'Chờ ghi ký ức'),  # LLM xong, ký ức còn trong bộ đệm ghi sau
+        ('DONE', 'Hoàn tất'),
+        ('FAILED', 'Lỗi'),
+    ]
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING', db_index=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+
+    # Thời gian từng bước (giây) của lần chạy cuối: {"data": .., "lmi": .., "retrieval": .., "pmi": ..}
+    timings = models.JSONField(default=dict)
+    duration_seconds = models.FloatField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['date', 'cong_ty']
+        verbose_name = "5. Backfill Task"
+        constraints = [
+            models.UniqueConstraint(fields=['cong_ty', 'date'], name='unique_backfill_task'),
+        ]
+
+    def __str__(self):
+        return f"{self.cong_ty_id} - {self.date} - {self.status}"
@@ -0,0 +1,309 @@
+# investment_advisor/pipeline.py
+"""
+Chạy pipeline FinAgent cho 1 (mã, ngày) theo đồ thị phụ thuộc (DAG).
+
+- Pipeline: khai báo các bước (stage) và các bước nó phụ thuộc; bước nào đủ đầu vào thì
+  chạy ngay trên ThreadPoolExecutor, nên các lời gọi LLM / truy xuất / đọc DB độc lập
+  chạy đồng thời và thời gian tổng tiến về đường găng (critical path).
+- Bước lỗi -> các bước phụ thuộc nó bị bỏ qua (skipped), các nhánh khác vẫn chạy.
+- PipelineRun: kết quả từng bước + trace thời gian (bắt đầu / kết thúc / trạng thái)
+  để in bảng, so với đường găng, hoặc gom vào benchmark.
+
+build_finagent_pipeline: DAG của luồng test_single_run
+(dữ liệu -> LMI -> Retrieval -> PMI -> LLR -> PLLR / HLR -> PHLR -> Decision).
+"""
+import json
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.db import connections
+
+from .utils import get_formatted_news, get_formatted_financials, get_price_action
+from .indicators import summarize_technical_signals, describe_kline, describe_price_movements
+from .indicator_state import get_recent_indicators
+from .backtest import account_status_before, format_past_decisions
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+TRACE_BAR_WIDTH = 30
+
+
+class StageFailed(RuntimeError):
+    """Bước pipeline thất bại (VD: module LLM trả về rỗng), các bước phụ thuộc bị bỏ qua."""
+
+
+# ==========================================================
+# DAG RUNNER
+# ==========================================================
+class Pipeline:
+    """
+    pipeline.add('pmi', lambda lmi, retrieval: ..., deps=['lmi', 'retrieval'])
+    Hàm của bước nhận kết quả các bước phụ thuộc qua tham số cùng tên.
+    Bước phụ thuộc phải được add trước (bảo đảm đồ thị không có chu trình).
+    """
+
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        self.max_workers = max_workers
+        self.stages = {}  # {tên: (func, deps)} theo thứ tự khai báo
+
+    def add(self, name, func, deps=()):
+        if name in self.stages:
+            raise ValueError(f"Bước '{name}' đã được khai báo.")
+        missing = [dep for dep in deps if dep not in self.stages]
+        if missing:
+            raise ValueError(f"Bước '{name}' phụ thuộc bước chưa khai báo: {', '.join(missing)}")
+        self.stages[name] = (func, tuple(deps))
+        return self
+
+    def run(self, on_stage=None):
+        """
+        Chạy mọi bước, trả về PipelineRun.
+        on_stage(trace_entry): callback sau mỗi bước xong / lỗi / bị bỏ qua (in tiến độ).
+        """
+        run = PipelineRun(self)
+        remaining = dict(self.stages)
+        run.started = time.perf_counter()
+
+        def settle(name, status, error=None):
+            entry = run.trace[name]
+            entry['status'] = status
+            entry['error'] = error
+            if on_stage:
+                on_stage(entry)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='pipeline') as executor:
+            running = {}
+            while True:
+                # 1. Bỏ qua các bước có bước phụ thuộc lỗi; gửi các bước đã đủ đầu vào
+                for name, (func, deps) in list(remaining.items()):
+                    statuses = [run.trace[dep]['status'] for dep in deps]
+                    if any(status in ('failed', 'skipped') for status in statuses):
+                        del remaining[name]
+                        settle(name, 'skipped')
+                    elif all(status == 'done' for status in statuses):
+                        del remaining[name]
+                        kwargs = {dep: run.results[dep] for dep in deps}
+                        running[executor.submit(self._execute, run, name, func, kwargs)] = name
+                if not running:
+                    break
+
+                # 2. Chờ ít nhất 1 bước xong
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.result()
+                    settle(name, 'failed' if error else 'done', error)
+
+        run.wall_seconds = time.perf_counter() - run.started
+        return run
+
+    @staticmethod
+    def _execute(run, name, func, kwargs):
+        """Chạy 1 bước trong worker thread; trả về thông báo lỗi (None nếu thành công)."""
+        entry = run.trace[name]
+        entry['start'] = time.perf_counter() - run.started
+        entry['thread'] = threading.current_thread().name
+        try:
+            run.results[name] = func(**kwargs)
+            return None
+        except Exception as e:
+            logger.error(f"Pipeline stage '{name}' failed: {e}")
+            return str(e) or type(e).__name__
+        finally:
+            entry['end'] = time.perf_counter() - run.started
+            entry['seconds'] = entry['end'] - entry['start']
+            # Mỗi worker thread có kết nối DB riêng -> đóng để không rò kết nối
+            connections.close_all()
+
+
+class PipelineRun:
+    """Kết quả 1 lần chạy: results {bước: output}, trace {bước: thời gian / trạng thái}."""
+
+    def __init__(self, pipeline):
+        self.results = {}
+        self.trace = {
+            name: {
+                'stage': name, 'deps': list(deps), 'status': 'pending', 'error': None,
+                'start': None, 'end': None, 'seconds': 0.0, 'thread': None,
+            }
+            for name, (_, deps) in pipeline.stages.items()
+        }
+        self.started = None
+        self.wall_seconds = 0.0
+
+    def ok(self, name):
+        return self.trace[name]['status'] == 'done'
+
+    @property
+    def failed(self):
+        return [name for name, entry in self.trace.items() if entry['status'] == 'failed']
+
+    def critical_path(self):
+        """
+        Chuỗi phụ thuộc có tổng thời gian lớn nhất (chỉ tính bước đã chạy):
+        cận dưới của wall-clock dù có bao nhiêu worker. Trả về (list tên bước, giây).
+        """
+        best = {}  # {bước: (tổng giây tới hết bước này, bước trước trên đường găng)}
+        for name, entry in self.trace.items():
+            if entry['start'] is None:
+                continue
+            previous = max(
+                (dep for dep in entry['deps'] if dep in best), key=lambda dep: best[dep][0], default=None
+            )
+            best[name] = (entry['seconds'] + (best[previous][0] if previous else 0.0), previous)
+        if not best:
+            return [], 0.0
+
+        last = max(best, key=lambda name: best[name][0])
+        total = best[last][0]
+        path = []
+        while last is not None:
+            path.append(last)
+            last = best[last][1]
+        return path[::-1], total
+
+    def format_trace(self):
+        """Bảng thời gian từng bước + thanh Gantt (thấy được các bước chạy chồng lên nhau)."""
+        scale = TRACE_BAR_WIDTH / self.wall_seconds if self.wall_seconds else 0.0
+        lines = [f"{'Bước':<12}{'Bắt đầu':>10}{'Kết thúc':>10}{'Thời gian':>11}  {'Trạng thái':<10} Timeline"]
+        for name, entry in sorted(self.trace.items(), key=lambda item: (item[1]['start'] is None, item[1]['start'] or 0)):
+            if entry['start'] is None:
+                lines.append(f"{name:<12}{'-':>10}{'-':>10}{'-':>11}  {entry['status']:<10}")
+                continue
+            offset = int(entry['start'] * scale)
+            width = max(1, int(round(entry['seconds'] * scale)))
+            bar = (" " * offset + "#" * width).ljust(TRACE_BAR_WIDTH)
+            lines.append(
+                f"{name:<12}{entry['start'] * 1000:>8.1f}ms{entry['end'] * 1000:>8.1f}ms"
+                f"{entry['seconds'] * 1000:>9.1f}ms  {entry['status']:<10} |{bar}|"
+            )
+        path, seconds = self.critical_path()
+        lines.append(
+            f"Tổng: {self.wall_seconds * 1000:.1f} ms | Đường găng ({seconds * 1000:.1f} ms): {' -> '.join(path)}"
+        )
+        return "\n".join(lines)
+
+
+# ==========================================================
+# DAG CỦA FINAGENT (1 mã, 1 ngày)
+# ==========================================================
+def build_finagent_pipeline(agent, symbol, date, current_market_context=None, trading_chart_path=None,
+                            max_workers=DEFAULT_WORKERS):
+    """
+    Các bước và phụ thuộc:
+        news, financials, price_action, technical, account   (đọc DB, độc lập)
+        lmi        <- news, financials, price_action
+        retrieval  <- lmi            (Diversified Retrieval; + PHLR nếu có current_market_context)
+        pmi        <- lmi, retrieval
+        llr        <- lmi, pmi, technical   (giá / kline đã tính sẵn song song với LMI / PMI)
+        pllr       <- llr
+        hlr        <- lmi, pmi, llr, account   (chạy song song với pllr)
+        phlr       <- retrieval (theo context hiện tại) hoặc hlr (theo query của HLR)
+        decision   <- lmi, pmi, llr, pllr, hlr, phlr, technical, account
+
+    LMI / LLR / Decision trả về rỗng -> StageFailed; PMI / HLR rỗng thì bước sau dùng giá trị thay thế
+    (summary của LMI, "N/A") như test_single_run.
+    """
+    date_str = str(date)
+    pipeline = Pipeline(max_workers=max_workers)
+
+    def market_summary(lmi, pmi):
+        return pmi.get('summary') if pmi else lmi.get('summary')
+
+    # 1. Dữ liệu đầu vào (DB / chỉ báo kỹ thuật)
+    def technical():
+        frame = get_recent_indicators(symbol, as_of=date)
+        return {
+            'signals': summarize_technical_signals(frame),
+            'kline': describe_kline(frame),
+            'movements': describe_price_movements(frame),
+        }
+
+    def account():
+        return {
+            'past_decisions': format_past_decisions(symbol, date),
+            'status': account_status_before(symbol, date),
+        }
+
+    pipeline.add('news', lambda: get_formatted_news(symbol, date))
+    pipeline.add('financials', lambda: get_formatted_financials(symbol, date))
+    pipeline.add('price_action', lambda: get_price_action(symbol, date))
+    pipeline.add('technical', technical)
+    pipeline.add('account', account)
+
+    # 2. Market Intelligence: LMI -> Retrieval -> PMI
+    def lmi(news, financials, price_action):
+        result = agent.run_latest_market_intelligence(symbol, date_str, news, financials, price_action)
+        if not result:
+            raise StageFailed("LMI thất bại")
+        return result
+
+    def retrieval(lmi):
+        return agent.retrieve_all(
+            market_queries=lmi.get('queries', {}), current_market_context=current_market_context
+        )
+
+    pipeline.add('lmi', lmi, deps=['news', 'financials', 'price_action'])
+    pipeline.add('retrieval', retrieval, deps=['lmi'])
+    pipeline.add(
+        'pmi', lambda lmi, retrieval: agent.run_past_market_intelligence(lmi, retrieval['historical_context']),
+        deps=['lmi', 'retrieval'],
+    )
+
+    # 3. Low-Level Reflection -> PLLR
+    def llr(lmi, pmi, technical):
+        result = agent.run_low_level_reflection(
+            symbol, date_str,
+            market_summary=market_summary(lmi, pmi),
+            price_text=technical['movements'],
+            kline_text=technical['kline'],
+            kline_image_path=None,
+        )
+        if not result:
+            raise StageFailed("LLR thất bại")
+        return result
+
+    pipeline.add('llr', llr, deps=['lmi', 'pmi', 'technical'])
+    pipeline.add('pllr', lambda llr: agent.retrieve_past_low_level_reflection(llr), deps=['llr'])
+
+    # 4. High-Level Reflection -> PHLR
+    def hlr(lmi, pmi, llr, account):
+        return agent.run_high_level_reflection(
+            symbol=symbol,
+            date_str=date_str,
+            market_summary=market_summary(lmi, pmi),
+            llr_reasoning=json.dumps(llr.get('reasoning', {}), indent=2),
+            past_decisions=account['past_decisions'],
+            trading_chart_path=trading_chart_path,
+        )
+
+    pipeline.add('hlr', hlr, deps=['lmi', 'pmi', 'llr', 'account'])
+    if current_market_context:
+        # Bài học quá khứ tra theo context hiện tại: đã lấy cùng vòng truy xuất với PMI
+        pipeline.add('phlr', lambda retrieval: retrieval['phlr'], deps=['retrieval'])
+    else:
+        pipeline.add(
+            'phlr', lambda hlr: agent.retrieve_past_high_level_reflection(hlr_query_text=(hlr or {}).get('query')),
+            deps=['hlr'],
+        )
+
+    # 5. Decision Making
+    def decision(lmi, pmi, llr, pllr, hlr, phlr, technical, account):
+        result = agent.run_decision_making(
+            symbol=symbol,
+            date_str=date_str,
+            market_intelligence=f"Latest Summary: {lmi.get('summary', '')}\nPast Context: {pmi.get('summary', '') if pmi else 'N/A'}",
+            llr_reflection=f"{json.dumps(llr.get('reasoning', {}), indent=2)}\nPast Reflections: {pllr}",
+            hlr_reflection=f"Current Reflection: {hlr.get('summary', '') if hlr else 'N/A'}\nPast Lessons: {phlr}",
+            technical_signals=technical['signals'],
+            account_status=account['status'],
+        )
+        if not result:
+            raise StageFailed("Decision Making thất bại")
+        return result
+
+    pipeline.add('decision', decision, deps=['lmi', 'pmi', 'llr', 'pllr', 'hlr', 'phlr', 'technical', 'account'])
+    return pipeline
@@ -0,0 +1,184 @@
+# investment_advisor/rate_limit.py
+"""
+Giới hạn tốc độ gọi Gemini (requests / phút và tokens / phút) + thử lại khi lỗi tạm thời.
+
+- TokenBucket: xô token nạp đều theo thời gian; lấy không đủ thì chờ đúng phần thiếu
+  thay vì ngủ cố định. Cho phép "nợ" (số dư âm) để trừ token thực tế sau khi gọi xong.
+- RateLimiter: 2 xô (request, token) dùng chung cho mọi thread của tiến trình.
+- call_with_retry: thử lại với exponential backoff + jitter khi gặp 429 / 5xx / lỗi mạng.
+
+Cấu hình: settings.GEMINI_REQUESTS_PER_MINUTE, GEMINI_TOKENS_PER_MINUTE, GEMINI_MAX_RETRIES.
+"""
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REQUESTS_PER_MINUTE = 10
+DEFAULT_TOKENS_PER_MINUTE = 250_000
+DEFAULT_MAX_RETRIES = 5
+BASE_RETRY_DELAY = 2.0   # giây, nhân đôi sau mỗi lần thử lại
+MAX_RETRY_DELAY = 60.0
+CHARS_PER_TOKEN = 3      # Ước lượng thận trọng như chat_context
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+def estimate_tokens(contents):
+    """Số token ước lượng của prompt (text) hoặc câu trả lời."""
+    parts = contents if isinstance(contents, (list, tuple)) else [contents]
+    chars = sum(len(part) for part in parts if isinstance(part, str))
+    images = sum(1 for part in parts if not isinstance(part, str))
+    return chars // CHARS_PER_TOKEN + images * 258  # Gemini tính ~258 token / ảnh
+
+
+# ==========================================================
+# TOKEN BUCKET
+# ==========================================================
+class TokenBucket:
+    """Nạp `rate_per_minute` đơn vị mỗi phút, tối đa `capacity` (mặc định = 1 phút)."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity or rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """Trừ `amount` ngay (có thể âm) và trả về số giây phải chờ trước khi dùng."""
+        amount = min(amount, self.capacity)  # Yêu cầu lớn hơn cả xô: chờ đầy xô là đủ
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def consume(self, amount):
+        """Ghi nhận thêm `amount` đã dùng (VD: token của câu trả lời), không chờ."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+
+    def acquire(self, amount=1):
+        """Chờ tới khi đủ `amount`; trả về số giây đã chờ."""
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+    """Giới hạn chung requests / phút và tokens / phút (0 hoặc None = không giới hạn)."""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failed = 0
+        self.total_wait_seconds = 0.0
+
+    def acquire(self, tokens=0):
+        waits = [
+            bucket.reserve(amount)
+            for bucket, amount in ((self.requests, 1), (self.tokens, tokens))
+            if bucket is not None
+        ]
+        wait = max(waits, default=0.0)
+        if wait > 0:
+            time.sleep(wait)
+        with self._lock:
+            self.calls += 1
+            self.total_wait_seconds += wait
+        return wait
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def record_usage(self, tokens):
+        if self.tokens is not None and tokens > 0:
+            self.tokens.consume(tokens)
+
+    def metrics(self):
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "failed": self.failed,
+            "total_wait_seconds": round(self.total_wait_seconds, 2),
+        }
+
+
+# ==========================================================
+# THỬ LẠI (EXPONENTIAL BACKOFF)
+# ==========================================================
+def is_retryable(error):
+    """429 / 5xx của google-genai hoặc lỗi mạng / timeout."""
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    try:
+        import httpx
+    except ImportError:
+        return False
+    return isinstance(error, httpx.TransportError)
+
+
+def retry_delay(attempt, base_delay=BASE_RETRY_DELAY, max_delay=MAX_RETRY_DELAY):
+    """Thời gian chờ lần thử lại thứ `attempt` (0, 1, ...): full jitter trên base * 2^attempt."""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def call_with_retry(func, limiter=None, max_retries=DEFAULT_MAX_RETRIES, tokens=0, label="Gemini"):
+    """
+    Gọi func() sau khi lấy quota từ `limiter`; lỗi tạm thời thì chờ backoff rồi thử lại
+    (mỗi lần thử đều đi qua limiter). Lỗi khác hoặc hết lượt thử -> ném lại lỗi cuối.
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire(tokens)
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                if limiter is not None:
+                    limiter.count('failed')
+                raise
+            delay = retry_delay(attempt)
+            if limiter is not None:
+                limiter.count('retries')
+            logger.warning(f"{label}: lỗi tạm thời ({e}), thử lại lần {attempt + 1}/{max_retries} sau {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+def build_gemini_limiter():
+    return RateLimiter(
+        getattr(settings, 'GEMINI_REQUESTS_PER_MINUTE', DEFAULT_REQUESTS_PER_MINUTE),
+        getattr(settings, 'GEMINI_TOKENS_PER_MINUTE', DEFAULT_TOKENS_PER_MINUTE),
+    )
+
+
+_gemini_limiter = None
+_gemini_limiter_lock = threading.Lock()
+
+
+def get_gemini_limiter():
+    """Limiter dùng chung cho mọi lời gọi Gemini của tiến trình (tạo khi dùng lần đầu)."""
+    global _gemini_limiter
+    with _gemini_limiter_lock:
+        if _gemini_limiter is None:
+            _gemini_limiter = build_gemini_limiter()
+        return _gemini_limiter
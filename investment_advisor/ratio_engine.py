@@ -0,0 +1,244 @@
+# investment_advisor/ratio_engine.py
+"""
+Bộ tính chỉ số tài chính dạng cột (NumPy/pandas).
+
+Số liệu BCTC được xếp thành các mảng 2 chiều (công ty x năm), năm N-1 chỉ là
+mảng dịch 1 cột, nên mọi chỉ số (RATIO_KEYS) được tính cho toàn bộ thị trường trong
+vài phép toán vector thay vì lặp từng công ty / từng năm.
+
+compute_ratios_reference() giữ nguyên công thức vô hướng cũ để đối chiếu kết quả
+(xem lệnh `manage.py benchmark_financial_ratios`).
+"""
+import numpy as np
+import pandas as pd
+
+# Các trường BCTC cần cho việc tính chỉ số
+STATEMENT_COLUMNS = [
+    "LoiNhuanSauThue",
+    "TongTaiSan",
+    "VonChuSoHuu",
+    "TaiSanNganHan",
+    "NoNganHan",
+    "NoPhaiTra",
+    "VonGop",
+    "NoDaiHan",
+]
+
+# Thứ tự các chỉ số trong dict kết quả
+RATIO_KEYS = [
+    "ROA",
+    "ROE",
+    "TySuatThanhToanHienHanh",
+    "HeSoNoTrenTongTaiSan",
+    "TangTruongTaiSan",
+    "TangTruongLoiNhuan",
+    "EPS",
+    "PE",
+    "PB",
+    "Beta",
+    "GiaDongCuaCuoiNam",
+    "TyLeNoDaiHan",
+    "DoBienDong",
+]
+# Chỉ số tính từ chuỗi giá ngày (returns_engine), không có trong công thức vô hướng gốc
+MARKET_KEYS = ["Beta", "DoBienDong"]
+
+
+def safe_divide(a, b):
+    if b is None or b == 0: return 0
+    return a / b
+
+
+def _safe_div(a, b):
+    """Phép chia vector: mẫu số NaN hoặc 0 -> 0 (giống safe_divide)."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = a / b
+    return np.where(np.isnan(b) | (b == 0), 0.0, out)
+
+
+def _computable(grid, previous):
+    """
+    Ô (công ty, năm) mà compute_ratios_reference tính được: công thức gốc gặp None trong
+    phép +, - hoặc ở tử số (mẫu số khác 0) sẽ lỗi TypeError và cặp đó bị bỏ qua, nên
+    ở đây cũng bỏ qua thay vì để _safe_div biến NaN thành 0.
+    """
+    def missing(arr):
+        return np.isnan(arr)
+
+    def nonzero(arr):
+        return ~np.isnan(arr) & (arr != 0)
+
+    # Dùng trong phép +, - (TTS, VCSH, LNST năm N và N-1) hoặc VonGop / 10000: luôn bắt buộc
+    required = [grid["TongTaiSan"], grid["VonChuSoHuu"], grid["LoiNhuanSauThue"], grid["VonGop"]]
+    required += [previous(grid[column]) for column in ("TongTaiSan", "VonChuSoHuu", "LoiNhuanSauThue")]
+    ok = np.logical_and.reduce([~missing(arr) for arr in required])
+
+    # Tử số thiếu chỉ lỗi khi mẫu số khác 0 / None (safe_divide trả 0 trước khi chia)
+    ok &= ~(missing(grid["TaiSanNganHan"]) & nonzero(grid["NoNganHan"]))
+    ok &= ~(missing(grid["NoPhaiTra"]) & nonzero(grid["TongTaiSan"]))
+    ok &= ~(missing(grid["NoDaiHan"]) & nonzero(grid["VonChuSoHuu"]))
+    return ok
+
+
+def compute_ratio_frame(statements, year_end_prices, target_pairs=None, market_stats=None):
+    """
+    Tính các chỉ số RATIO_KEYS (chỉ số BCTC / giá + Beta, độ biến động lấy từ market_stats)
+    cho mọi cặp (công ty, năm) có đủ BCTC năm N và N-1
+    (cặp có trường thiếu làm công thức gốc lỗi thì bỏ qua như trước).
+
+    statements: DataFrame có cột 'ma', 'nam' và STATEMENT_COLUMNS (None/NaN nếu thiếu).
+    year_end_prices: dict {(ma, nam): giá VNĐ} — thiếu giá thì coi như 0.
+    target_pairs: tập (ma, nam) cần tính; None = tất cả.
+    market_stats: dict {(ma, nam): (beta, độ biến động)} từ returns_engine — thiếu thì NaN.
+
+    Trả về DataFrame cột 'ma', 'nam' + RATIO_KEYS. Ô không tính được là NaN.
+    """
+    if statements.empty:
+        return pd.DataFrame(columns=['ma', 'nam'] + RATIO_KEYS)
+
+    # 1. Xếp dữ liệu thành lưới (công ty x năm)
+    company_idx, codes = pd.factorize(statements['ma'])
+    codes = np.asarray(codes, dtype=object)
+    code_pos = {code: i for i, code in enumerate(codes)}
+    years_col = statements['nam'].to_numpy(dtype=np.int64)
+    first_year = int(years_col.min())
+    n_years = int(years_col.max()) - first_year + 1
+    year_idx = years_col - first_year
+    shape = (len(codes), n_years)
+
+    present = np.zeros(shape, dtype=bool)
+    present[company_idx, year_idx] = True
+
+    grid = {}
+    for column in STATEMENT_COLUMNS:
+        arr = np.full(shape, np.nan)
+        arr[company_idx, year_idx] = pd.to_numeric(statements[column], errors='coerce').to_numpy(dtype=np.float64)
+        grid[column] = arr
+
+    def previous(arr, fill=np.nan):
+        # Dịch 1 năm: ô [c, y] chứa giá trị năm y-1
+        out = np.full_like(arr, fill)
+        out[:, 1:] = arr[:, :-1]
+        return out
+
+    # Có BCTC năm N và N-1, và công thức gốc không lỗi vì ô thiếu (None)
+    valid = present & previous(present, False) & _computable(grid, previous)
+
+    if target_pairs is not None:
+        wanted = np.zeros(shape, dtype=bool)
+        for ma, nam in target_pairs:
+            c, y = code_pos.get(ma), nam - first_year
+            if c is not None and 0 <= y < n_years:
+                wanted[c, y] = True
+        valid &= wanted
+
+    # 2. Giá cuối năm
+    price = np.zeros(shape)
+    for (ma, nam), value in year_end_prices.items():
+        c, y = code_pos.get(ma), nam - first_year
+        if c is not None and 0 <= y < n_years and value:
+            price[c, y] = value
+
+    beta = np.full(shape, np.nan)
+    volatility = np.full(shape, np.nan)
+    for (ma, nam), (beta_value, volatility_value) in (market_stats or {}).items():
+        c, y = code_pos.get(ma), nam - first_year
+        if c is not None and 0 <= y < n_years:
+            beta[c, y] = beta_value
+            volatility[c, y] = volatility_value
+
+    # 3. Tính chỉ số (toàn bộ lưới một lượt)
+    LNST_N = grid["LoiNhuanSauThue"]
+    TTS_N = grid["TongTaiSan"]
+    VCSH_N = grid["VonChuSoHuu"]
+    NDH_N = grid["NoDaiHan"]
+    LNST_N_1 = previous(LNST_N)
+    TTS_N_1 = previous(TTS_N)
+    VCSH_N_1 = previous(VCSH_N)
+
+    avg_TTS = (TTS_N + TTS_N_1) / 2
+    avg_VCSH = (VCSH_N + VCSH_N_1) / 2
+
+    tong_von_hoa = np.nan_to_num(NDH_N) + np.nan_to_num(VCSH_N)
+    num_shares = grid["VonGop"] / 10000
+    eps = _safe_div(LNST_N, num_shares)
+    bvps = _safe_div(VCSH_N, num_shares)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pe = np.where(eps > 0, price / eps, 0.0)
+
+    ratios = {
+        "ROA": _safe_div(LNST_N, avg_TTS),
+        "ROE": _safe_div(LNST_N, avg_VCSH),
+        "TySuatThanhToanHienHanh": _safe_div(grid["TaiSanNganHan"], grid["NoNganHan"]),
+        "HeSoNoTrenTongTaiSan": _safe_div(grid["NoPhaiTra"], TTS_N),
+        "TangTruongTaiSan": _safe_div(TTS_N - TTS_N_1, TTS_N_1),
+        "TangTruongLoiNhuan": _safe_div(LNST_N - LNST_N_1, LNST_N_1),
+        "EPS": eps,
+        "PE": pe,
+        "PB": _safe_div(price, bvps),
+        "Beta": beta,
+        "GiaDongCuaCuoiNam": price,
+        "TyLeNoDaiHan": _safe_div(NDH_N, tong_von_hoa),
+        "DoBienDong": volatility,
+    }
+
+    # 4. Chỉ giữ các ô hợp lệ
+    rows, cols = np.nonzero(valid)
+    result = {'ma': codes[rows], 'nam': cols + first_year}
+    result.update({key: ratios[key][rows, cols] for key in RATIO_KEYS})
+    return pd.DataFrame(result)
+
+
+def compute_ratios_reference(data_N, data_N_minus_1, market_price):
+    """Công thức vô hướng gốc: tính 12 chỉ số của một công ty trong một năm."""
+    # --- Dữ liệu Tài chính ---
+    LNST_N = data_N["LoiNhuanSauThue"]
+    TTS_N = data_N["TongTaiSan"]
+    VCSH_N = data_N["VonChuSoHuu"]
+    TSNH_N = data_N["TaiSanNganHan"]
+    NNH_N = data_N["NoNganHan"]
+    NPT_N = data_N["NoPhaiTra"]
+    VonGop_N = data_N["VonGop"]
+    NDH_N = data_N["NoDaiHan"]
+
+    # Dữ liệu N-1
+    LNST_N_1 = data_N_minus_1["LoiNhuanSauThue"]
+    TTS_N_1 = data_N_minus_1["TongTaiSan"]
+    VCSH_N_1 = data_N_minus_1["VonChuSoHuu"]
+
+    avg_TTS = safe_divide(TTS_N + TTS_N_1, 2)
+    avg_VCSH = safe_divide(VCSH_N + VCSH_N_1, 2)
+
+    roa = safe_divide(LNST_N, avg_TTS)
+    roe = safe_divide(LNST_N, avg_VCSH)
+    current_ratio = safe_divide(TSNH_N, NNH_N)
+    debt_to_assets = safe_divide(NPT_N, TTS_N)
+    asset_growth = safe_divide(TTS_N - TTS_N_1, TTS_N_1)
+    profit_growth = safe_divide(LNST_N - LNST_N_1, LNST_N_1)
+
+    tong_von_hoa = (NDH_N if NDH_N else 0) + (VCSH_N if VCSH_N else 0)
+    long_term_debt_ratio = safe_divide(NDH_N, tong_von_hoa)
+
+    num_shares = safe_divide(VonGop_N, 10000)
+    eps = safe_divide(LNST_N, num_shares)
+
+    pe = safe_divide(market_price, eps) if eps and eps > 0 else 0
+
+    bvps = safe_divide(VCSH_N, num_shares)
+    pb = safe_divide(market_price, bvps)
+    beta = 0
+
+    return {
+        "ROA": roa,
+        "ROE": roe,
+        "TySuatThanhToanHienHanh": current_ratio,
+        "HeSoNoTrenTongTaiSan": debt_to_assets,
+        "TangTruongTaiSan": asset_growth,
+        "TangTruongLoiNhuan": profit_growth,
+        "EPS": eps,
+        "PE": pe,
+        "PB": pb,
+        "Beta": beta,
+        "GiaDongCuaCuoiNam": market_price,
+        "TyLeNoDaiHan": long_term_debt_ratio
+    }
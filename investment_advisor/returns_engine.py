@@ -0,0 +1,321 @@
+# investment_advisor/returns_engine.py
+"""
+Bộ tính lợi suất ngày, Beta và độ biến động năm (NumPy/pandas).
+
+- Giá điều chỉnh (giaDieuChinh, thiếu thì giaDongCua) của mọi mã được xếp thành ma
+  trận (ngày x mã) trong 1 query, lợi suất ngày = pct_change theo cột.
+- Chỉ số thị trường được dựng từ chính dữ liệu: bình quân theo vốn hóa phiên trước
+  ('cap', số CP = vốn góp / 10000 như khi tính EPS) hoặc bình quân đều ('equal').
+- Beta = Cov(r_i, r_m) / Var(r_m) và độ biến động = độ lệch chuẩn lợi suất x sqrt(252)
+  của mọi (mã, năm) được tính cùng lúc bằng các tổng groupby theo năm, không lặp
+  từng công ty.
+- Ma trận hiệp phương sai / tương quan của một nhóm mã trên N phiên gần nhất (tùy chọn
+  co rút Ledoit-Wolf), cache theo (nhóm mã, số phiên, ngày cuối yêu cầu, phiên bản dữ liệu).
+"""
+import datetime
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db.models import FloatField
+from django.db.models.functions import Cast, Coalesce
+
+from .data_cache import get_data_version
+from .models import TongHopTaiChinh, ThiTruongChungKhoang
+
+TRADING_DAYS_PER_YEAR = 252
+MIN_OBSERVATIONS = 60  # Số phiên tối thiểu trong năm để Beta / độ biến động có nghĩa
+DEFAULT_WEIGHTING = 'cap'
+WEIGHTINGS = ('cap', 'equal')
+
+# Giá điều chỉnh (thiếu thì giá đóng cửa), ép về float ngay trong SQL để không phải
+# dựng hàng trăm nghìn Decimal khi đọc
+_ADJUSTED_PRICE = Cast(Coalesce('giaDieuChinh', 'giaDongCua'), FloatField())
+
+
+def load_price_matrix(years):
+    """
+    Giá điều chỉnh (nghìn VNĐ) dạng ma trận index = ngày, cột = mã CK, cho các năm `years`
+    (kèm tháng 12 năm liền trước để có lợi suất phiên đầu năm). 1 query.
+    """
+    start = datetime.date(min(years) - 1, 12, 1)
+    end = datetime.date(max(years), 12, 31)
+    rows = (
+        ThiTruongChungKhoang.objects
+        .filter(ngay__range=(start, end))
+        .annotate(gia=_ADJUSTED_PRICE)
+        .filter(gia__isnull=False)
+        .order_by()
+        .values_list('ngay', 'congTy_id', 'gia')
+    )
+    frame = pd.DataFrame.from_records(list(rows), columns=['ngay', 'ma', 'gia'])
+    if frame.empty:
+        return pd.DataFrame()
+    matrix = frame.pivot_table(index='ngay', columns='ma', values='gia', aggfunc='last')
+    matrix.index = pd.to_datetime(matrix.index)
+    return matrix.sort_index()
+
+
+def daily_returns(prices):
+    """Lợi suất ngày; phiên trước thiếu giá (ngừng giao dịch) -> NaN, không nội suy."""
+    returns = prices.pct_change(fill_method=None)
+    return returns.replace([np.inf, -np.inf], np.nan)
+
+
+def _share_counts(codes, years):
+    """Số cổ phiếu ước tính {(ma, nam): vốn góp / 10000} từ BCĐKT năm (quy 0 hoặc 5)."""
+    counts = {}
+    for ma, nam, von_gop in (
+        TongHopTaiChinh.objects
+        .filter(congTy__in=codes, nam__in=years, quy__in=[0, 5], bangcandoiketoan__vonGopCuaChuSoHuu__gt=0)
+        .order_by('nam', 'quy')
+        .values_list('congTy', 'nam', 'bangcandoiketoan__vonGopCuaChuSoHuu')
+    ):
+        counts[(ma, nam)] = float(von_gop) / 10000
+    return counts
+
+
+def market_returns(prices, returns, weighting=DEFAULT_WEIGHTING):
+    """
+    Lợi suất ngày của chỉ số thị trường dựng từ dữ liệu.
+
+    cap: trọng số = vốn hóa phiên trước (giá x số CP năm đó; năm chưa có BCTC dùng năm
+         gần nhất trước đó). Mã không có số CP không được tính; phiên nào không mã
+         nào có số CP thì dùng bình quân đều.
+    equal: trung bình cộng lợi suất các mã có giao dịch.
+    """
+    equal = returns.mean(axis=1, skipna=True)
+    if weighting == 'equal' or returns.empty:
+        return equal
+    if weighting not in WEIGHTINGS:
+        raise ValueError(f"weighting phải là một trong {WEIGHTINGS}")
+
+    years = prices.index.year
+    all_years = range(years.min() - 5, years.max() + 1)
+    shares = pd.DataFrame(np.nan, index=all_years, columns=prices.columns)
+    for (ma, nam), value in _share_counts(list(prices.columns), all_years).items():
+        shares.loc[nam, ma] = value
+    # Năm chưa có BCTC -> dùng số CP của năm gần nhất trước đó
+    shares = shares.ffill()
+
+    daily_shares = shares.reindex(years).to_numpy()
+    caps = pd.DataFrame(prices.to_numpy() * daily_shares, index=prices.index, columns=prices.columns)
+    weights = caps.shift(1).where(returns.notna())
+    total = weights.sum(axis=1, min_count=1)
+    weighted = (returns * weights).sum(axis=1, min_count=1) / total
+    return weighted.where(total > 0, equal)
+
+
+def compute_beta_volatility(returns, market, min_observations=MIN_OBSERVATIONS):
+    """
+    Beta và độ biến động năm (annualized) cho mọi (mã, năm) trong 1 lượt.
+
+    Dùng tổng theo năm (n, Σx, Σy, Σxy, Σy², Σx²) nên mọi mã / mọi năm được tính bằng
+    vài phép groupby-sum thay vì vòng lặp. Trả về DataFrame cột 'ma', 'nam', 'Beta', 'DoBienDong'.
+    """
+    if returns.empty:
+        return pd.DataFrame(columns=['ma', 'nam', 'Beta', 'DoBienDong'])
+    year = returns.index.year
+    market_frame = pd.DataFrame(
+        np.repeat(market.to_numpy()[:, None], returns.shape[1], axis=1),
+        index=returns.index, columns=returns.columns,
+    )
+
+    def yearly_sum(frame):
+        return frame.groupby(year).sum(min_count=1)
+
+    # Beta: chỉ các phiên cả mã và thị trường đều có lợi suất
+    paired = returns.notna() & market_frame.notna()
+    x = returns.where(paired)
+    y = market_frame.where(paired)
+    n = paired.groupby(year).sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = (yearly_sum(x * y) - yearly_sum(x) * yearly_sum(y) / n) / (n - 1)
+        var_market = (yearly_sum(y * y) - yearly_sum(y) ** 2 / n) / (n - 1)
+        beta = (cov / var_market).where((n >= min_observations) & (var_market > 0))
+
+        # Độ biến động: mọi phiên mã có lợi suất
+        n_own = returns.notna().groupby(year).sum()
+        var_own = (yearly_sum(returns * returns) - yearly_sum(returns) ** 2 / n_own) / (n_own - 1)
+        volatility = np.sqrt(var_own.clip(lower=0) * TRADING_DAYS_PER_YEAR).where(n_own >= min_observations)
+
+    result = pd.DataFrame({
+        'Beta': beta.stack(future_stack=True),
+        'DoBienDong': volatility.stack(future_stack=True),
+    }).dropna(how='all')
+    result.index.names = ['nam', 'ma']
+    return result.reset_index()[['ma', 'nam', 'Beta', 'DoBienDong']]
+
+
+def get_market_stats(years, weighting=None):
+    """
+    Beta / độ biến động cho mọi mã trong các năm `years` (chỉ số thị trường dựng từ toàn bộ mã).
+    Trả về dict {(ma, nam): (beta, do_bien_dong)}; thiếu dữ liệu -> NaN.
+    """
+    years = sorted({int(nam) for nam in years})
+    if not years:
+        return {}
+    weighting = weighting or getattr(settings, 'MARKET_INDEX_WEIGHTING', DEFAULT_WEIGHTING)
+
+    prices = load_price_matrix(years)
+    if prices.empty:
+        return {}
+    returns = daily_returns(prices)
+    market = market_returns(prices, returns, weighting)
+    stats = compute_beta_volatility(returns, market)
+    stats = stats[stats['nam'].isin(years)]
+    return {
+        (ma, int(nam)): (beta, volatility)
+        for ma, nam, beta, volatility in stats.itertuples(index=False, name=None)
+    }
+
+
+# ==========================================================
+# MA TRẬN HIỆP PHƯƠNG SAI / TƯƠNG QUAN
+# ==========================================================
+DEFAULT_WINDOW = 250
+MIN_WINDOW = 3
+MAX_WINDOW = 2500
+MIN_MATRIX_OBSERVATIONS = 2  # Hiệp phương sai mẫu chia (n - 1): cần ít nhất 2 phiên lợi suất
+MIN_COVERAGE = 0.8  # Mã phải có lợi suất ở ít nhất 80% số phiên của cửa sổ
+MAX_CACHED_MATRICES = 32
+
+_matrix_cache = OrderedDict()  # {khóa: kết quả}
+_matrix_cache_lock = threading.Lock()
+
+
+def _window_dates(symbols, window, end_date):
+    """window + 1 ngày giao dịch gần nhất (<= end_date) của nhóm mã, tăng dần."""
+    queryset = ThiTruongChungKhoang.objects.all()
+    if symbols is not None:
+        queryset = queryset.filter(congTy_id__in=symbols)
+    if end_date is not None:
+        queryset = queryset.filter(ngay__lte=end_date)
+    dates = list(queryset.order_by('-ngay').values_list('ngay', flat=True).distinct()[:window + 1])
+    return sorted(dates)
+
+
+def load_return_window(symbols, window=DEFAULT_WINDOW, end_date=None):
+    """
+    Lợi suất ngày (index = ngày, cột = mã) của `window` phiên gần nhất tới end_date, đã căn
+    theo cùng lịch giao dịch. symbols=None: mọi mã có giá trong cửa sổ.
+    """
+    dates = _window_dates(symbols, window, end_date)
+    if len(dates) < 2:
+        return pd.DataFrame()
+    return _load_returns(symbols, dates)
+
+
+def _load_returns(symbols, dates):
+    rows = (
+        ThiTruongChungKhoang.objects
+        .filter(ngay__range=(dates[0], dates[-1]))
+        .annotate(gia=_ADJUSTED_PRICE)
+        .filter(gia__isnull=False)
+        .order_by()
+    )
+    if symbols is not None:
+        rows = rows.filter(congTy_id__in=symbols)
+    frame = pd.DataFrame.from_records(list(rows.values_list('ngay', 'congTy_id', 'gia')), columns=['ngay', 'ma', 'gia'])
+    prices = frame.pivot_table(index='ngay', columns='ma', values='gia', aggfunc='last').reindex(dates)
+    return daily_returns(prices).iloc[1:]
+
+
+def ledoit_wolf_shrinkage(centered):
+    """
+    Hệ số co rút Ledoit-Wolf (2004) về ma trận đơn vị nhân hệ số (mu * I).
+    centered: mảng (n phiên x p mã) đã trừ trung bình. Trả về (hệ số trong [0, 1], mu).
+    """
+    n, p = centered.shape
+    empirical = centered.T @ centered / n
+    mu = np.trace(empirical) / p
+    squared = centered ** 2
+    # Σ_k ||x_k x_k' - S||² / n² = (Σ_k ||x_k||⁴ / n - ||S||²) / n
+    beta = (np.sum(squared.sum(axis=1) ** 2) / n - np.sum(empirical ** 2)) / (n * p)
+    delta = (np.sum(empirical ** 2) - 2 * mu * np.trace(empirical) + p * mu ** 2) / p
+    beta = min(beta, delta)
+    shrinkage = 0.0 if delta == 0 else beta / delta
+    return shrinkage, mu
+
+
+def compute_covariance(returns, shrinkage=None, min_coverage=MIN_COVERAGE):
+    """
+    Hiệp phương sai và tương quan của lợi suất ngày.
+
+    - Mã có ít hơn min_coverage số phiên có lợi suất bị loại (trả về trong 'excluded').
+    - Mỗi cột trừ trung bình trên các phiên có dữ liệu, phiên thiếu coi là 0 (không
+      đóng góp), để vẫn tính được bằng 1 phép nhân ma trận X'X; mỗi ô chia cho số phiên
+      cả 2 mã cùng có dữ liệu (M'M - 1, M = mặt nạ notna) thay vì n - 1, nên mã thiếu
+      phiên không bị ước lượng thấp phương sai / hiệp phương sai.
+    - shrinkage='ledoit_wolf': co rút về mu * I; None: hiệp phương sai mẫu.
+    - 'coverage': tỉ lệ phiên có lợi suất của từng mã được giữ.
+    """
+    coverage = returns.notna().mean()
+    kept = coverage[coverage >= min_coverage].index
+    excluded = sorted(set(returns.columns) - set(kept))
+    values = returns[kept].to_numpy()
+    n = len(values)
+
+    # Số phiên chung của từng cặp mã (đường chéo = số phiên của từng mã)
+    mask = ~np.isnan(values)
+    overlap = mask.T.astype(np.float64) @ mask
+    centered = np.nan_to_num(values - np.nanmean(values, axis=0)) if len(kept) else values
+    cross_products = centered.T @ centered
+    if shrinkage == 'ledoit_wolf' and len(kept):
+        coefficient, mu = ledoit_wolf_shrinkage(centered)
+        sample = cross_products / np.maximum(overlap, 1)
+        covariance = (1 - coefficient) * sample + coefficient * mu * np.eye(len(kept))
+    else:
+        coefficient = None
+        covariance = cross_products / np.maximum(overlap - 1, 1)
+
+    std = np.sqrt(np.diag(covariance))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = covariance / np.outer(std, std)
+    # Chia theo số phiên chung của từng cặp -> ma trận có thể lệch nhẹ khỏi [-1, 1]
+    correlation = np.clip(np.nan_to_num(correlation), -1.0, 1.0)
+    np.fill_diagonal(correlation, 1.0)
+
+    return {
+        'tickers': list(kept),
+        'excluded': excluded,
+        'observations': n,
+        'coverage': [round(float(coverage[ma]), 4) for ma in kept],
+        'shrinkage': coefficient,
+        'covariance': covariance,
+        'correlation': correlation,
+    }
+
+
+def get_covariance_matrix(symbols=None, window=DEFAULT_WINDOW, end_date=None, shrinkage=None):
+    """
+    Ma trận hiệp phương sai / tương quan (NumPy) của nhóm mã trên `window` phiên gần nhất.
+    Kết quả được cache theo (hash nhóm mã, số phiên, end_date như được truyền vào, shrinkage,
+    phiên bản dữ liệu): phiên bản đổi mỗi khi có giá mới, nên end_date=None vẫn đúng là
+    "mới nhất" và cache trúng thì không phải quét lịch giao dịch (_window_dates).
+    Trả về None nếu cửa sổ có ít hơn MIN_MATRIX_OBSERVATIONS phiên lợi suất.
+    """
+    symbols = sorted({ma.upper() for ma in symbols}) if symbols else None
+    ticker_hash = hashlib.sha1(",".join(symbols or ["*"]).encode()).hexdigest()
+    key = (ticker_hash, window, end_date, shrinkage, get_data_version())
+    with _matrix_cache_lock:
+        if key in _matrix_cache:
+            _matrix_cache.move_to_end(key)
+            return _matrix_cache[key]
+
+    dates = _window_dates(symbols, window, end_date)
+    if len(dates) < MIN_MATRIX_OBSERVATIONS + 1:
+        result = None
+    else:
+        returns = _load_returns(symbols, dates)
+        result = compute_covariance(returns, shrinkage)
+        result.update(start=dates[0], end=dates[-1], window=window)
+
+    with _matrix_cache_lock:
+        _matrix_cache[key] = result
+        while len(_matrix_cache) > MAX_CACHED_MATRICES:
+            _matrix_cache.popitem(last=False)
+    return result
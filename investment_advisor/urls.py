@@ -19,6 +19,7 @@ urlpatterns += [
     path('api/get_thitruongchungkhoan_data/', views.get_ThiTruongChungKhoan_data, name='get_ThiTruongChungKhoan_data'),
     path('api/get_bangcandoikettoan_data/', views.get_BangCanDoiKeToan_data, name='get_BangCanDoiKeToan_data'),
     path('api/get_bangketquakinhdoanh_data/', views.get_BangKetQuaKinhDoanh_data, name='get_BangKetQuaKinhDoanh_data'),
+    path('api/correlation/', views.get_correlation_matrix, name='correlation_matrix_api'),
 
     path('api/post_congty_data/', views.post_congty_data, name='post_congty_data'),
     path('api/post_thitruong_data/', views.post_thitruong_data, name='post_thitruong_data'),
@@ -38,6 +39,7 @@ urlpatterns += [
     path('chatbot/', views.chat_view, name='chat_view'),
     path('api/save-message/', views.save_message_view, name='save-message'),
     path('api/financial-ratios/', views.calculate_financial_ratios_view, name='financial_ratios_api'),
+    path('api/chat-metrics/', views.chat_metrics_view, name='chat_metrics_api'),
 ]
 
 ## Chart view
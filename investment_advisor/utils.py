@@ -3,183 +3,320 @@ import google.genai as genai
 import os
 import gspread
 import numpy as np
+import pandas as pd
 import json
-
-from django.db.models import Max, Count, Prefetch
-from .models import CongTy, TongHopTaiChinh, BangCanDoiKeToan, BangKetQuaKinhDoanh, ThiTruongChungKhoang
+import datetime
+from asgiref.sync import sync_to_async, async_to_sync
+
+from django.db import connection, transaction
+from django.db.models import Max, Count, Q, F, Window
+from django.db.models.functions import ExtractYear, RowNumber
+from .models import CongTy, TongHopTaiChinh, BangCanDoiKeToan, BangKetQuaKinhDoanh, ThiTruongChungKhoang, ChiSoTaiChinh
+from .data_cache import bump_data_version
+from .chat_concurrency import gemini_limiter
+from .answer_cache import answer_cache
+from .ratio_engine import safe_divide, compute_ratio_frame, STATEMENT_COLUMNS, RATIO_KEYS, MARKET_KEYS
+from .returns_engine import get_market_stats
 
 from django.conf import settings
 from google.oauth2.service_account import Credentials
 
-def safe_divide(a, b):
-    if b is None or b == 0: return 0
-    return a / b
-
-def get_financial_ratios_data():
+# Tên khóa trong dict kết quả -> tên cột trong bảng ChiSoTaiChinh
+RATIO_FIELDS = {
+    "ROA": "roa",
+    "ROE": "roe",
+    "TySuatThanhToanHienHanh": "tySuatThanhToanHienHanh",
+    "HeSoNoTrenTongTaiSan": "heSoNoTrenTongTaiSan",
+    "TangTruongTaiSan": "tangTruongTaiSan",
+    "TangTruongLoiNhuan": "tangTruongLoiNhuan",
+    "EPS": "eps",
+    "PE": "pe",
+    "PB": "pb",
+    "Beta": "beta",
+    "GiaDongCuaCuoiNam": "giaDongCuaCuoiNam",
+    "TyLeNoDaiHan": "tyLeNoDaiHan",
+    "DoBienDong": "doBienDong",
+}
+# Cột Beta / độ biến động: chỉ refresh_market_stats (hoặc dựng lại toàn bộ) mới ghi
+MARKET_FIELDS = [RATIO_FIELDS[key] for key in MARKET_KEYS]
+
+
+def statement_ratio_pairs(ma_chung_khoan, nam):
     """
-    Tính toán chỉ số tài chính cho một nhóm công ty cụ thể (đã được tối ưu Query).
+    Các cặp (công ty, năm) bị ảnh hưởng khi BCTC năm `nam` thay đổi:
+    chỉ số năm N dùng số liệu năm N và N-1, nên năm N+1 cũng phải tính lại.
     """
-    target_companies_queryset=CongTy.objects.all().order_by('maChungKhoan')
+    nam = int(nam)
+    return {(ma_chung_khoan, nam), (ma_chung_khoan, nam + 1)}
+
 
+# Cột BCTC (join qua TongHopTaiChinh) tương ứng với STATEMENT_COLUMNS của ratio_engine
+STATEMENT_SOURCE_FIELDS = {
+    "LoiNhuanSauThue": "bangketquakinhdoanh__loiNhuanSauThueThuNhapDoanhNghiep",
+    "TongTaiSan": "bangcandoiketoan__tongCongTaiSan",
+    "VonChuSoHuu": "bangcandoiketoan__vonChuSoHuu",
+    "TaiSanNganHan": "bangcandoiketoan__taiSanNganHan",
+    "NoNganHan": "bangcandoiketoan__noNganHan",
+    "NoPhaiTra": "bangcandoiketoan__noPhaiTra",
+    "VonGop": "bangcandoiketoan__vonGopCuaChuSoHuu",
+    "NoDaiHan": "bangcandoiketoan__noDaiHan",
+}
 
-    # 1. Xác định năm dữ liệu (Lấy global max year)
-    latest_report = (
-        TongHopTaiChinh.objects
-        .exclude(congTy__maChungKhoan__in=["SCS",'a'])
-        .aggregate(max_nam=Max('nam'))
+
+def _get_annual_statements(company_codes, years):
+    """
+    Lấy số liệu BCTC năm (quy 0 hoặc 5) cần cho việc tính chỉ số, 1 query duy nhất.
+    Trả về DataFrame cột 'ma', 'nam' + STATEMENT_COLUMNS.
+    """
+    queryset = TongHopTaiChinh.objects.filter(
+        quy__in=[0, 5],
+        bangcandoiketoan__isnull=False,
+        bangketquakinhdoanh__isnull=False,
+    ).order_by('nam', 'quy')
+    if company_codes is not None:
+        queryset = queryset.filter(congTy__in=company_codes)
+    if years is not None:
+        queryset = queryset.filter(nam__in=years)
+
+    statements = pd.DataFrame.from_records(
+        list(queryset.values_list('congTy', 'nam', *[STATEMENT_SOURCE_FIELDS[c] for c in STATEMENT_COLUMNS])),
+        columns=['ma', 'nam'] + STATEMENT_COLUMNS,
     )
-    latest_year = latest_report.get('max_nam')
+    # Nếu 1 năm có cả quy 0 và 5 -> giữ bản sau cùng (giống cách làm cũ)
+    return statements.drop_duplicates(subset=['ma', 'nam'], keep='last')
 
-    if not latest_year:
+
+def _get_year_end_prices(company_codes, years):
+    """
+    Giá đóng cửa phiên cuối cùng của mỗi năm (VNĐ), chọn ngay trong DB:
+    chỉ trả về 1 dòng cho mỗi (công ty, năm) thay vì toàn bộ phiên giao dịch.
+    Trả về dict {(maChungKhoan, nam): gia}.
+    """
+    if not years:
         return {}
-    
-    start_calc_year = latest_year - 4
-    start_data_year = latest_year - 5 
-    
-    years_to_query = list(range(start_data_year, latest_year + 1))
-    years_to_calculate = list(range(start_calc_year, latest_year + 1))
 
-    # 2. TỐI ƯU HÓA QUERY (Eager Loading)
-    # Bước này cực quan trọng: Gom tất cả dữ liệu cần thiết của 20 cty vào 1 lần query duy nhất
-    # Thay vì query lắt nhắt trong vòng lặp.
-    
-    optimized_companies = target_companies_queryset.prefetch_related(
-        # Lấy trước dữ liệu Báo cáo tài chính + join sẵn bảng con
-        Prefetch(
-            'tonghoptaichinh_set', # Lưu ý: Cần check lại related_name trong models.py nếu bạn đặt khác
-            queryset=TongHopTaiChinh.objects.filter(
-                nam__in=years_to_query,
-                quy__in=[0, 5]
-            ).select_related('bangcandoiketoan', 'bangketquakinhdoanh').order_by('nam'),
-            to_attr='fetched_reports' # Lưu kết quả vào biến tạm này
-        ),
-        # Lấy trước dữ liệu Thị trường chứng khoán
-        Prefetch(
-            'thitruongchungkhoang_set', # Lưu ý: Check lại related_name
-            queryset=ThiTruongChungKhoang.objects.filter(
-                ngay__year__in=years_to_calculate
-            ).order_by('-ngay'),
-            to_attr='fetched_market_data'
-        )
+    queryset = ThiTruongChungKhoang.objects.filter(
+        # Lọc theo khoảng ngày để dùng được index (congTy, ngay)
+        ngay__gte=datetime.date(min(years), 1, 1),
+        ngay__lte=datetime.date(max(years), 12, 31),
+    ).annotate(nam=ExtractYear('ngay')).filter(nam__in=years)
+    if company_codes is not None:
+        queryset = queryset.filter(congTy__in=company_codes)
+
+    if connection.vendor == 'postgresql':
+        # SELECT DISTINCT ON (congTy, nam) ... ORDER BY congTy, nam, ngay DESC
+        queryset = queryset.order_by('congTy', 'nam', '-ngay').distinct('congTy', 'nam')
+    else:
+        # Backend khác: ROW_NUMBER() OVER (PARTITION BY congTy, nam ORDER BY ngay DESC) = 1
+        queryset = queryset.annotate(
+            thu_tu=Window(RowNumber(), partition_by=[F('congTy'), F('nam')], order_by=F('ngay').desc())
+        ).filter(thu_tu=1).order_by()
+
+    prices = {}
+    for ma, nam, gia_dong_cua, gia_dieu_chinh in queryset.values_list(
+        'congTy', 'nam', 'giaDongCua', 'giaDieuChinh'
+    ):
+        market_price = 0
+        if gia_dong_cua:
+            market_price = float(gia_dong_cua) * 1000
+        elif gia_dieu_chinh:
+            market_price = float(gia_dieu_chinh) * 1000
+        prices[(ma, nam)] = market_price
+    return prices
+
+
+def refresh_financial_ratios(pairs=None):
+    """
+    Tính lại và lưu chỉ số tài chính vào bảng ChiSoTaiChinh.
+
+    pairs: tập các cặp (maChungKhoan, nam) có dữ liệu nguồn thay đổi.
+           None = tính lại toàn bộ bảng.
+    Trả về số dòng chỉ số đã ghi.
+
+    Beta / độ biến động đo theo chỉ số thị trường dựng từ mọi mã, nên chỉ được tính khi
+    dựng lại toàn bộ; cập nhật theo cặp giữ nguyên giá trị đã lưu (dòng mới để trống)
+    -> người gọi chạy refresh_market_stats 1 lần cho các năm bị ảnh hưởng (như ingest.py).
+    """
+    if pairs is not None:
+        pairs = {(ma, int(nam)) for ma, nam in pairs if ma and nam is not None}
+        if not pairs:
+            return 0
+        company_codes = {ma for ma, _ in pairs}
+        years = {nam for _, nam in pairs}
+        statements = _get_annual_statements(company_codes, years | {nam - 1 for nam in years})
+    else:
+        company_codes = None
+        statements = _get_annual_statements(None, None)
+        years = set(statements['nam'].astype(int))
+
+    prices = _get_year_end_prices(company_codes, years)
+    # Beta / độ biến động: chỉ số thị trường dựng từ toàn bộ mã của các năm cần tính
+    market_stats = get_market_stats(years) if pairs is None else None
+
+    # Tính toàn bộ chỉ số một lượt (vector hóa)
+    frame = compute_ratio_frame(statements, prices, target_pairs=pairs, market_stats=market_stats)
+    frame = frame.astype(object).where(frame.notna(), None)
+
+    fields = [RATIO_FIELDS[key] for key in RATIO_KEYS]
+    rows = [
+        ChiSoTaiChinh(congTy_id=ma, nam=int(nam), quy=0, **dict(zip(fields, values)))
+        for ma, nam, *values in frame[['ma', 'nam'] + RATIO_KEYS].itertuples(index=False, name=None)
+    ]
+    computed_pairs = {(row.congTy_id, row.nam) for row in rows}
+
+    with transaction.atomic():
+        if pairs is None:
+            ChiSoTaiChinh.objects.all().delete()
+        else:
+            # Cặp không còn đủ dữ liệu (VD: BCTC bị xóa) -> bỏ dòng chỉ số cũ
+            stale = pairs - computed_pairs
+            if stale:
+                # Gom theo năm để điều kiện OR không phình theo số cặp
+                stale_by_year = {}
+                for ma, nam in stale:
+                    stale_by_year.setdefault(nam, []).append(ma)
+                stale_filter = Q()
+                for nam, codes in stale_by_year.items():
+                    stale_filter |= Q(nam=nam, congTy_id__in=codes)
+                ChiSoTaiChinh.objects.filter(stale_filter, quy=0).delete()
+
+        if rows:
+            ChiSoTaiChinh.objects.bulk_create(
+                rows,
+                batch_size=1000,
+                update_conflicts=True,
+                unique_fields=['congTy', 'nam', 'quy'],
+                update_fields=[field for field in RATIO_FIELDS.values() if field not in MARKET_FIELDS] + ['ngayCapNhat'],
+            )
+
+    # Payload chỉ số đã cache (API, dashboard) hết hiệu lực
+    bump_data_version()
+    return len(rows)
+
+
+def refresh_market_stats(years=None):
+    """
+    Ghi lại Beta / độ biến động của MỌI mã trong các năm `years` (None = mọi năm đã có chỉ số).
+    Chỉ số thị trường dựng từ toàn bộ mã, nên giá của 1 mã thay đổi làm Beta của các mã
+    khác cùng năm thay đổi theo -> luôn ghi lại cả năm, không theo từng cặp.
+    Trả về số dòng chỉ số đã cập nhật.
+    """
+    ratios = ChiSoTaiChinh.objects.filter(quy=0)
+    if years is not None:
+        ratios = ratios.filter(nam__in={int(nam) for nam in years})
+    rows = list(ratios.only('id', 'congTy_id', 'nam', *MARKET_FIELDS))
+    if not rows:
+        return 0
+
+    market_stats = get_market_stats({row.nam for row in rows})
+    for row in rows:
+        values = market_stats.get((row.congTy_id, row.nam), (np.nan, np.nan))
+        for field, value in zip(MARKET_FIELDS, values):
+            setattr(row, field, None if value is None or np.isnan(value) else float(value))
+
+    with transaction.atomic():
+        ChiSoTaiChinh.objects.bulk_update(rows, MARKET_FIELDS, batch_size=1000)
+    bump_data_version()
+    return len(rows)
+
+
+def _financial_ratio_querysets(latest_year, company_codes=None):
+    """
+    Các queryset dùng chung cho get_financial_ratios_data / aget_financial_ratios_data.
+    Trả về (số năm BCTC đã thu thập, danh sách công ty, chỉ số đã tính sẵn).
+    """
+    start_calc_year = latest_year - 4
+    start_data_year = latest_year - 5
+
+    reports = TongHopTaiChinh.objects.filter(nam__range=(start_data_year, latest_year), quy__in=[0, 5])
+    companies = CongTy.objects.exclude(maChungKhoan='a')
+    ratios = ChiSoTaiChinh.objects.filter(quy=0, nam__range=(start_calc_year, latest_year))
+    if company_codes is not None:
+        reports = reports.filter(congTy__in=company_codes)
+        companies = companies.filter(maChungKhoan__in=company_codes)
+        ratios = ratios.filter(congTy__in=company_codes)
+
+    # Số năm BCTC đã thu thập của từng công ty (1 query GROUP BY)
+    collected_years = (
+        reports
+        .values('congTy')
+        .annotate(so_nam=Count('nam', distinct=True))
+        .values_list('congTy', 'so_nam')
     )
+    company_rows = companies.order_by('maChungKhoan').values_list('maChungKhoan', 'tenCongTy')
+    # Chỉ số đã tính sẵn (1 query theo index)
+    ratio_rows = (
+        ratios
+        .order_by('congTy', 'nam')
+        .values_list('congTy', 'nam', *RATIO_FIELDS.values())
+    )
+    return collected_years, company_rows, ratio_rows
 
-    results = {}
 
-    # 3. Lặp qua từng công ty (Lúc này chỉ chạy trên RAM, không gọi DB nữa)
-    for company in optimized_companies:
-        if company.maChungKhoan in ['a']:
-            continue
-        
-        company_code = company.maChungKhoan
-        
-        # Lấy dữ liệu từ biến tạm (đã prefetch)
-        reports_list = getattr(company, 'fetched_reports', [])
-        market_data_list = getattr(company, 'fetched_market_data', [])
-        
-        total_collected_years = len(set(r.nam for r in reports_list))
+def _assemble_financial_ratios(collected_years, company_rows, ratio_rows):
+    collected_years = dict(collected_years)
 
-        results[company_code] = {
-            "tenCongTy": company.tenCongTy,
-            "TongSoNamThuThap": total_collected_years,
+    results = {}
+    for ma, ten in company_rows:
+        results[ma] = {
+            "tenCongTy": ten,
+            "TongSoNamThuThap": collected_years.get(ma, 0),
             "annual_reports": {}
         }
-        
-        # Chuyển list reports thành Dictionary để tra cứu nhanh theo năm: Data[2023]
-        processed_data = {}
-        for report in reports_list:
-            try:
-                # Vì đã select_related ở trên nên truy cập vào đây không tốn query
-                bcdt = report.bangcandoiketoan  
-                kqkd = report.bangketquakinhdoanh
-                
-                processed_data[report.nam] = {
-                    "LoiNhuanSauThue": kqkd.loiNhuanSauThueThuNhapDoanhNghiep,
-                    "TongTaiSan": bcdt.tongCongTaiSan,
-                    "VonChuSoHuu": bcdt.vonChuSoHuu, 
-                    "TaiSanNganHan": bcdt.taiSanNganHan,
-                    "NoNganHan": bcdt.noNganHan,
-                    "NoPhaiTra": bcdt.noPhaiTra,
-                    "VonGop": bcdt.vonGopCuaChuSoHuu,
-                    "NoDaiHan": bcdt.noDaiHan
-                }
-            except (AttributeError, Exception):
-                continue
-
-        # Tính toán chỉ số
-        for year in years_to_calculate:
-            data_N = processed_data.get(year)
-            data_N_minus_1 = processed_data.get(year - 1)
-            
-            if not data_N or not data_N_minus_1:
-                continue
-
-            # --- Dữ liệu Tài chính ---
-            LNST_N = data_N["LoiNhuanSauThue"]
-            TTS_N = data_N["TongTaiSan"]
-            VCSH_N = data_N["VonChuSoHuu"]
-            TSNH_N = data_N["TaiSanNganHan"]
-            NNH_N = data_N["NoNganHan"]
-            NPT_N = data_N["NoPhaiTra"]
-            VonGop_N = data_N["VonGop"]
-            NDH_N = data_N["NoDaiHan"]
-
-            # Dữ liệu N-1
-            LNST_N_1 = data_N_minus_1["LoiNhuanSauThue"]
-            TTS_N_1 = data_N_minus_1["TongTaiSan"]
-            VCSH_N_1 = data_N_minus_1["VonChuSoHuu"]
-
-            # --- LẤY DỮ LIỆU THỊ TRƯỜNG (Lọc từ list RAM) ---
-            # Tìm bản ghi thị trường đầu tiên khớp với năm hiện tại
-            market_data = next((item for item in market_data_list if item.ngay.year == year), None)
-            
-            market_price = 0
-            if market_data:
-                if market_data.giaDongCua:
-                    market_price = float(market_data.giaDongCua) * 1000
-                elif market_data.giaDieuChinh:
-                    market_price = float(market_data.giaDieuChinh) * 1000
-
-            # --- TÍNH TOÁN (Giữ nguyên logic của bạn) ---
-            avg_TTS = safe_divide(TTS_N + TTS_N_1, 2)
-            avg_VCSH = safe_divide(VCSH_N + VCSH_N_1, 2)
-
-            roa = safe_divide(LNST_N, avg_TTS)
-            roe = safe_divide(LNST_N, avg_VCSH)
-            current_ratio = safe_divide(TSNH_N, NNH_N)
-            debt_to_assets = safe_divide(NPT_N, TTS_N)
-            asset_growth = safe_divide(TTS_N - TTS_N_1, TTS_N_1)
-            profit_growth = safe_divide(LNST_N - LNST_N_1, LNST_N_1)
-
-            tong_von_hoa = (NDH_N if NDH_N else 0) + (VCSH_N if VCSH_N else 0)
-            long_term_debt_ratio = safe_divide(NDH_N, tong_von_hoa)
-            
-            num_shares = safe_divide(VonGop_N, 10000)
-            eps = safe_divide(LNST_N, num_shares)
 
-            pe = safe_divide(market_price, eps) if eps and eps > 0 else 0
-            
-            bvps = safe_divide(VCSH_N, num_shares)
-            pb = safe_divide(market_price, bvps)
-            beta = 0 
-
-            results[company_code]["annual_reports"][year] = {
-                "ROA": roa,
-                "ROE": roe,
-                "TySuatThanhToanHienHanh": current_ratio,
-                "HeSoNoTrenTongTaiSan": debt_to_assets,
-                "TangTruongTaiSan": asset_growth,
-                "TangTruongLoiNhuan": profit_growth,
-                "EPS": eps,
-                "PE": pe,
-                "PB": pb,
-                "Beta": beta, 
-                "GiaDongCuaCuoiNam": market_price,
-                "TyLeNoDaiHan": long_term_debt_ratio
-            }
-            
+    for ma, nam, *values in ratio_rows:
+        if ma not in results:
+            continue
+        results[ma]["annual_reports"][nam] = dict(zip(RATIO_FIELDS.keys(), values))
+
     return results
 
 
+def _latest_report_queryset():
+    # Năm dữ liệu (global max year)
+    return TongHopTaiChinh.objects.exclude(congTy__maChungKhoan__in=["SCS",'a'])
+
+
+def get_financial_ratios_data(company_codes=None):
+    """
+    Đọc chỉ số tài chính 5 năm gần nhất từ bảng ChiSoTaiChinh.
+    Bảng được cập nhật dần bởi refresh_financial_ratios khi có dữ liệu mới.
+
+    company_codes: chỉ lấy các mã này (None = tất cả công ty).
+    """
+    latest_year = _latest_report_queryset().aggregate(max_nam=Max('nam')).get('max_nam')
+    if not latest_year:
+        return {}
+
+    # Lần chạy đầu (bảng chỉ số chưa có gì) -> dựng toàn bộ
+    if not ChiSoTaiChinh.objects.exists():
+        refresh_financial_ratios()
+
+    collected_years, company_rows, ratio_rows = _financial_ratio_querysets(latest_year, company_codes)
+    return _assemble_financial_ratios(collected_years, company_rows, ratio_rows)
+
+
+async def aget_financial_ratios_data(company_codes=None):
+    """
+    Bản async của get_financial_ratios_data (dùng async ORM), để consumer
+    không phải chiếm thread của sync_to_async khi đọc dữ liệu.
+    """
+    latest_report = await _latest_report_queryset().aaggregate(max_nam=Max('nam'))
+    latest_year = latest_report.get('max_nam')
+    if not latest_year:
+        return {}
+
+    if not await ChiSoTaiChinh.objects.aexists():
+        await sync_to_async(refresh_financial_ratios)()
+
+    collected_years, company_rows, ratio_rows = _financial_ratio_querysets(latest_year, company_codes)
+    return _assemble_financial_ratios(
+        [row async for row in collected_years],
+        [row async for row in company_rows],
+        [row async for row in ratio_rows],
+    )
+
+
 try:
     api_key=os.environ["GEMINI_API_KEY"]
 except KeyError:
@@ -190,24 +327,22 @@ except KeyError:
 
 client = genai.Client(api_key=api_key)
 
-def call_gemini(user_question: str) -> str:
+GEMINI_CHAT_MODEL = "gemini-2.5-flash" # Hoặc gemini-1.5-flash tùy version bạn có
+EMPTY_QUESTION_MESSAGE = "Vui lòng nhập nội dung câu hỏi."
+
+
+async def abuild_chat_prompt(user_question: str) -> str:
     """
-    Hàm xử lý logic gọi Gemini với vai trò Chuyên gia tài chính.
+    Dựng prompt (vai trò + dữ liệu liên quan + câu hỏi) cho chatbot tài chính.
     """
-    if not user_question.strip():
-        return "Vui lòng nhập nội dung câu hỏi."
-
-    # 1. Lấy dữ liệu tài chính mới nhất
-    # Lưu ý: Hàm này có thể chạy hơi lâu nếu DB lớn. 
-    # Trong thực tế nên cache lại kết quả này nếu dữ liệu không thay đổi liên tục.
-    raw_data = get_financial_ratios_data()
-    # raw_data=2
-    # 2. Chuyển đổi dữ liệu sang chuỗi JSON để nạp vào prompt
-    if raw_data:
-        # ensure_ascii=False để giữ tiếng Việt, indent=2 cho dễ nhìn (nếu debug)
-        data_context = json.dumps(raw_data, ensure_ascii=False, indent=2)
-    else:
+    # 1. Chỉ lấy dữ liệu liên quan tới câu hỏi (mã CK / tên công ty / ngành),
+    # nếu không nhắc tới công ty nào thì dùng bản tóm tắt theo ngành.
+    # Kích thước bị giới hạn bởi settings.CHATBOT_CONTEXT_TOKEN_BUDGET.
+    from .chat_context import abuild_ratio_context
+    data_context, data_scope = await abuild_ratio_context(user_question)
+    if not data_context:
         data_context = "Hiện tại chưa có dữ liệu báo cáo tài chính trong hệ thống."
+        data_scope = "không có dữ liệu"
 
     # 3. Xây dựng Prompt Template (Kỹ thuật Prompt Engineering)
     # Đây là phần quan trọng nhất để định hình tính cách Bot
@@ -216,7 +351,7 @@ def call_gemini(user_question: str) -> str:
     Bạn là một Chuyên gia Tư vấn Đầu tư Tài chính cấp cao. Nhiệm vụ của bạn là hỗ trợ khách hàng phân tích sức khỏe doanh nghiệp và đưa ra lời khuyên đầu tư dựa trên dữ liệu thực tế.
 
     DỮ LIỆU CUNG CẤP (Context):
-    Dưới đây là dữ liệu các chỉ số tài chính (ROA, ROE, PE, EPS, Tăng trưởng, Nợ...) của các công ty trong 5 năm gần nhất:
+    Dưới đây là dữ liệu các chỉ số tài chính (ROA, ROE, PE, EPS, Tăng trưởng, Nợ...) trong 5 năm gần nhất. Phạm vi dữ liệu: {data_scope}.
     ```json
     {data_context}
     ```
@@ -238,20 +373,90 @@ def call_gemini(user_question: str) -> str:
       + Sử dụng các con số cụ thể từ dữ liệu để dẫn chứng cho lời khuyên (Ví dụ: "Năm 2023 PE chỉ còn 10.5, thấp hơn trung bình...").
       + Giọng văn: Chuyên nghiệp, khách quan, sắc sảo nhưng thân thiện và hữu ích.
     """
+    return prompt_template
+
+
+async def acall_gemini(user_question: str) -> str:
+    """
+    Hàm xử lý logic gọi Gemini với vai trò Chuyên gia tài chính (async).
+    Dùng client.aio + async ORM nên không chiếm thread; số lời gọi đồng thời
+    bị giới hạn bởi gemini_limiter.
+    """
+    if not user_question.strip():
+        return EMPTY_QUESTION_MESSAGE
+
+    # Câu hỏi đã được trả lời với cùng phiên bản dữ liệu -> dùng lại
+    from .chat_context import amentioned_tickers
+    tickers = await amentioned_tickers(user_question)
+    cached_answer = await answer_cache.aget(user_question, tickers)
+    if cached_answer is not None:
+        return cached_answer
+
+    prompt_template = await abuild_chat_prompt(user_question)
 
     print(f"Đang gọi Gemini với câu hỏi: '{user_question[:30]}...'")
     
     try:
         # Gọi Gemini
-        response = client.models.generate_content(
-            model="gemini-2.5-flash", # Hoặc gemini-1.5-flash tùy version bạn có
-            contents=prompt_template,
-        )
+        async with gemini_limiter.slot():
+            response = await client.aio.models.generate_content(
+                model=GEMINI_CHAT_MODEL,
+                contents=prompt_template,
+            )
+        if response.text:
+            await answer_cache.aset(user_question, response.text, tickers)
         return response.text
     except Exception as e:
         print(f"Lỗi khi gọi Gemini: {e}")
         return f"Xin lỗi, hệ thống phân tích đang gặp sự cố kết nối. Vui lòng thử lại sau.\n{e}"
-    
+
+
+def call_gemini(user_question: str) -> str:
+    """Bản đồng bộ của acall_gemini (cho view / script không chạy trên event loop)."""
+    return async_to_sync(acall_gemini)(user_question)
+
+
+async def stream_gemini(user_question: str):
+    """
+    Phiên bản streaming của call_gemini: async generator trả về từng đoạn text
+    ngay khi Gemini sinh ra (dùng client.aio).
+
+    Nếu task đang chạy bị hủy (ví dụ client ngắt WebSocket), stream được đóng
+    ngay để Gemini dừng sinh tiếp, không tốn quota.
+    """
+    if not user_question.strip():
+        yield EMPTY_QUESTION_MESSAGE
+        return
+
+    from .chat_context import amentioned_tickers
+    tickers = await amentioned_tickers(user_question)
+    cached_answer = await answer_cache.aget(user_question, tickers)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+
+    prompt_template = await abuild_chat_prompt(user_question)
+
+    print(f"Đang gọi Gemini (stream) với câu hỏi: '{user_question[:30]}...'")
+    parts = []
+    async with gemini_limiter.slot():
+        stream = await client.aio.models.generate_content_stream(
+            model=GEMINI_CHAT_MODEL,
+            contents=prompt_template,
+        )
+        try:
+            async for chunk in stream:
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+        finally:
+            # Đóng kết nối HTTP tới Gemini (kể cả khi bị hủy giữa chừng)
+            await stream.aclose()
+
+    # Chỉ cache câu trả lời đã stream trọn vẹn (không bị hủy / lỗi giữa chừng)
+    if parts:
+        await answer_cache.aset(user_question, "".join(parts), tickers)
+
 
 
 # --- HÀM MỚI ĐỂ ĐẨY DỮ LIỆU LÊN GOOGLE SHEET ---
@@ -322,7 +527,8 @@ def update_financial_ratios_sheet(data_dict):
         "Mã CK", "Tên Công Ty", "Năm", "ROA", "ROE", 
         "Tỷ Suất TT Hiện Hành", "Nợ/Tổng Tài Sản", 
         "Tăng Trưởng Tài Sản", "Tăng Trưởng Lợi Nhuận",
-        "EPS", "PE", "PB", "Beta", "Giá đóng cửa cuối năm", "Tỷ lệ Nợ Dài Hạn" # Lưu thêm để kiểm tra
+        "EPS", "PE", "PB", "Beta", "Giá đóng cửa cuối năm", "Tỷ lệ Nợ Dài Hạn", # Lưu thêm để kiểm tra
+        "Độ biến động năm"
     ]
     rows_to_insert.append(header)
 
@@ -358,7 +564,8 @@ def update_financial_ratios_sheet(data_dict):
                     format_number(report.get("PB")),
                     format_number(report.get("Beta")),
                     format_number(report.get("GiaDongCuaCuoiNam")),
-                    format_number(report.get("TyLeNoDaiHan"), is_percent=False)
+                    format_number(report.get("TyLeNoDaiHan"), is_percent=False),
+                    format_number(report.get("DoBienDong"))
                 ]
             
             rows_to_insert.append(row)
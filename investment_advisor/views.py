@@ -3,14 +3,25 @@ from .models import *
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from decimal import Decimal, InvalidOperation
-from django.http import JsonResponse,HttpResponse
+from django.http import JsonResponse,HttpResponse,HttpResponseNotModified
 from django.db.models import Sum, Max, Count, F, Q
-from .utils import update_financial_ratios_sheet,get_financial_ratios_data
+from .utils import update_financial_ratios_sheet,get_financial_ratios_data,refresh_financial_ratios,refresh_market_stats,statement_ratio_pairs
+from .data_cache import get_cached_payload, etag_matches, bump_data_version
+from .chat_concurrency import gemini_limiter
+from .ingest import ingest_statement_rows, upsert_price_rows
+from .answer_cache import answer_cache
+from .api_utils import (
+    ApiQueryError, STREAM_FORMATS, STREAM_CHUNK_SIZE, parse_list, parse_int_list, parse_date, parse_limit,
+    parse_int, parse_choice, parse_fields, encode_cursor, decode_cursor, cursor_text, cursor_date, cursor_int,
+    response_format, to_columnar, stream_rows,
+)
+from .returns_engine import get_covariance_matrix, DEFAULT_WINDOW, MIN_WINDOW, MAX_WINDOW
 import threading
 import openpyxl
 import json
 import os
 import time
+import numpy as np
 from django.utils.dateparse import parse_datetime
 
 def home(request):
@@ -69,14 +80,160 @@ def get_TongHopTaiChinh_data(request):
         print(f'Error retrieving reports for company {company_id}: {str(e)}', flush=True)
         return JsonResponse({'error': str(e)}, status=500)
 def get_ThiTruongChungKhoan_data(request):
-    data = list(ThiTruongChungKhoang.objects.values())
-    return JsonResponse(data, safe=False)
+    """
+    Giá giao dịch ngày, lọc & phân trang keyset theo (congTy, ngay).
+
+    ?ticker=HPG,FPT  &from=2024-01-01  &to=2024-12-31  &fields=ngay,giaDongCua
+    &limit=1000      &cursor=<next_cursor của trang trước>
+    &format=json (mặc định, phân trang) | ndjson | csv (stream toàn bộ kết quả)
+    """
+    try:
+        columns = parse_fields(request, ThiTruongChungKhoang, required=['congTy_id', 'ngay'])
+        fmt = response_format(request)
+        queryset = ThiTruongChungKhoang.objects.all()
+
+        tickers = [ma.upper() for ma in parse_list(request, 'ticker')]
+        if tickers:
+            queryset = queryset.filter(congTy_id__in=tickers)
+        date_from, date_to = parse_date(request, 'from'), parse_date(request, 'to')
+        if date_from:
+            queryset = queryset.filter(ngay__gte=date_from)
+        if date_to:
+            queryset = queryset.filter(ngay__lte=date_to)
+
+        cursor = request.GET.get('cursor')
+        if cursor:
+            last_ma, last_ngay = decode_cursor(cursor, [cursor_text, cursor_date])
+            queryset = queryset.filter(Q(congTy_id__gt=last_ma) | Q(congTy_id=last_ma, ngay__gt=last_ngay))
+
+        queryset = queryset.order_by('congTy_id', 'ngay').values_list(*columns)
+
+        if fmt in STREAM_FORMATS:
+            if request.GET.get('limit'):
+                queryset = queryset[:parse_limit(request)]
+            return stream_rows(queryset.iterator(chunk_size=STREAM_CHUNK_SIZE), columns, fmt, 'thi_truong')
+
+        limit = parse_limit(request)
+        rows = list(queryset[:limit + 1])
+        next_cursor = encode_cursor(list(rows[limit - 1][:2])) if len(rows) > limit else None
+        rows = rows[:limit]
+        return JsonResponse({
+            'count': len(rows),
+            'next_cursor': next_cursor,
+            'results': [dict(zip(columns, row)) for row in rows],
+        })
+    except ApiQueryError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+
+STATEMENT_KEY_COLUMNS = ['baoCao_id', 'ma', 'nam', 'quy']
+
+
+def _statement_api(request, model, filename):
+    """
+    API đọc BCTC (BCĐKT / KQKD), lọc + phân trang keyset theo baoCao_id.
+
+    ?ticker=HPG,FPT  &year=2023,2024  &quarter=4  &fields=tienVaTuongDuongTien,...
+    &limit=1000      &cursor=<next_cursor của trang trước>
+    &layout=rows (mặc định, list object) | columnar (mỗi cột 1 mảng, gọn hơn)
+    &format=json | ndjson | csv
+    """
+    try:
+        value_columns = parse_fields(request, model, required=['baoCao_id'])[1:]
+        columns = STATEMENT_KEY_COLUMNS + value_columns
+        fmt = response_format(request)
+        layout = request.GET.get('layout', 'rows')
+        if layout not in ('rows', 'columnar'):
+            raise ApiQueryError("'layout' phải là rows hoặc columnar.")
+
+        queryset = model.objects.all()
+        tickers = [ma.upper() for ma in parse_list(request, 'ticker')]
+        if tickers:
+            queryset = queryset.filter(baoCao__congTy_id__in=tickers)
+        years = parse_int_list(request, 'year')
+        if years:
+            queryset = queryset.filter(baoCao__nam__in=years)
+        quarters = parse_int_list(request, 'quarter')
+        if quarters:
+            queryset = queryset.filter(baoCao__quy__in=quarters)
+
+        cursor = request.GET.get('cursor')
+        if cursor:
+            (last_id,) = decode_cursor(cursor, [cursor_int])
+            queryset = queryset.filter(baoCao_id__gt=last_id)
+
+        queryset = (
+            queryset
+            .annotate(ma=F('baoCao__congTy_id'), nam=F('baoCao__nam'), quy=F('baoCao__quy'))
+            .order_by('baoCao_id')
+            .values_list(*columns)
+        )
+
+        if fmt in STREAM_FORMATS:
+            if request.GET.get('limit'):
+                queryset = queryset[:parse_limit(request)]
+            return stream_rows(queryset.iterator(chunk_size=STREAM_CHUNK_SIZE), columns, fmt, filename)
+
+        limit = parse_limit(request)
+        rows = list(queryset[:limit + 1])
+        next_cursor = encode_cursor([rows[limit - 1][0]]) if len(rows) > limit else None
+        rows = rows[:limit]
+        if layout == 'columnar':
+            results = to_columnar(columns, rows)
+        else:
+            results = [dict(zip(columns, row)) for row in rows]
+        return JsonResponse({'count': len(rows), 'next_cursor': next_cursor, 'results': results})
+    except ApiQueryError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+
 def get_BangCanDoiKeToan_data(request):
-    data = list(BangCanDoiKeToan.objects.values())
-    return JsonResponse(data, safe=False)
+    return _statement_api(request, BangCanDoiKeToan, 'bang_can_doi_ke_toan')
 def get_BangKetQuaKinhDoanh_data(request):
-    data = list(BangKetQuaKinhDoanh.objects.values())
-    return JsonResponse(data, safe=False)
+    return _statement_api(request, BangKetQuaKinhDoanh, 'bang_ket_qua_kinh_doanh')
+
+
+MAX_MATRIX_TICKERS = 1000
+
+
+def get_correlation_matrix(request):
+    """
+    Ma trận tương quan / hiệp phương sai lợi suất ngày của nhóm mã.
+
+    ?ticker=HPG,FPT,VNM (bỏ trống = toàn thị trường)  &window=250 (số phiên)
+    &end=2024-12-31     &shrinkage=none | ledoit_wolf
+    &kind=correlation (mặc định) | covariance | both
+    """
+    try:
+        tickers = [ma.upper() for ma in parse_list(request, 'ticker')]
+        if len(tickers) > MAX_MATRIX_TICKERS:
+            raise ApiQueryError(f"Tối đa {MAX_MATRIX_TICKERS} mã mỗi lần.")
+        window = parse_int(request, 'window', DEFAULT_WINDOW, MIN_WINDOW, MAX_WINDOW)
+        end_date = parse_date(request, 'end')
+        shrinkage = parse_choice(request, 'shrinkage', ('none', 'ledoit_wolf'), 'none')
+        kind = parse_choice(request, 'kind', ('correlation', 'covariance', 'both'), 'correlation')
+    except ApiQueryError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    result = get_covariance_matrix(tickers or None, window, end_date, None if shrinkage == 'none' else shrinkage)
+    if result is None:
+        return JsonResponse({'error': 'Không đủ dữ liệu giá trong khoảng đã chọn (cần ít nhất 3 phiên).'}, status=404)
+
+    payload = {
+        'tickers': result['tickers'],
+        'excluded': result['excluded'],
+        'start': result['start'],
+        'end': result['end'],
+        'window': result['window'],
+        'observations': result['observations'],
+        'coverage': result['coverage'],
+        'shrinkage': result['shrinkage'],
+    }
+    if kind in ('correlation', 'both'):
+        payload['correlation'] = np.round(result['correlation'], 6).tolist()
+    if kind in ('covariance', 'both'):
+        payload['covariance'] = result['covariance'].tolist()
+    return JsonResponse(payload)
 
 
 
@@ -113,7 +270,8 @@ def export_financial_ratios_excel(request):
         "P/B", 
         "Beta", 
         "Giá Đóng Cửa Cuối Năm", 
-        "Tỷ Lệ Nợ Dài Hạn"
+        "Tỷ Lệ Nợ Dài Hạn",
+        "Độ Biến Động Năm"
     ]
     ws.append(headers)
 
@@ -149,7 +307,8 @@ def export_financial_ratios_excel(request):
                 metrics.get("PB"),
                 metrics.get("Beta"),
                 metrics.get("GiaDongCuaCuoiNam"),
-                metrics.get("TyLeNoDaiHan")
+                metrics.get("TyLeNoDaiHan"),
+                metrics.get("DoBienDong")
             ]
             ws.append(row)
 
@@ -170,6 +329,7 @@ def post_congty_data(request):
             nganh=data.get("nganh"),
             maChungKhoan=data.get("maChungKhoan"),
         )
+        bump_data_version()
         return JsonResponse({"message": f"Đã thêm công ty: {congty.tenCongTy}"}, status=201)
     except Exception as e:
         return JsonResponse({"message": f"Lỗi: {str(e)}"}, status=400)
@@ -182,36 +342,18 @@ def post_thitruong_data(request):
         if isinstance(data, dict):  # 🧠 Nếu chỉ có 1 bản ghi
             data = [data]
 
-        created_records = []
-        for record_data in data:
-            cong_ty, _ = CongTy.objects.get_or_create(
-                maChungKhoan=record_data["congTy"],
-                defaults={
-                    "tenCongTy": record_data.get("tenCongTy", record_data["congTy"]),
-                    "nganh": record_data.get("nganh", None),
-                }
-            )
-
-            record = ThiTruongChungKhoang(
-                congTy=cong_ty,
-                ngay=record_data["ngay"],
-                giaDongCua=record_data["giaDongCua"],
-                giaDieuChinh=record_data["giaDieuChinh"],
-                thayDoi=record_data["thayDoi"],
-                klKhopLenh=record_data["klKhopLenh"],
-                gtKhopLenh=record_data["gtKhopLenh"],
-                klThoaThuan=record_data.get("klThoaThuan"),
-                gtThoaThuan=record_data.get("gtThoaThuan"),
-                giaMoCua=record_data["giaMoCua"],
-                giaCaoNhat=record_data["giaCaoNhat"],
-                giaThapNhat=record_data["giaThapNhat"],
-            )
-            created_records.append(record)
-
-        ThiTruongChungKhoang.objects.bulk_create(created_records)
+        # Upsert theo (congTy, ngay): gửi lại file chồng ngày sẽ cập nhật thay vì báo lỗi
+        result = upsert_price_rows(data)
 
         return JsonResponse({
-            "message": f"Đã thêm {len(created_records)} bản ghi thành công!"
+            "message": (
+                f"Đã thêm {result['inserted']} bản ghi, cập nhật {result['updated']} bản ghi, "
+                f"bỏ qua {len(result['rejected'])} bản ghi lỗi."
+            ),
+            "inserted": result["inserted"],
+            "updated": result["updated"],
+            "rejected": len(result["rejected"]),
+            "errors": result["rejected"],
         }, status=201)
 
     except Exception as e:
@@ -231,6 +373,7 @@ def post_tonghoptaichinh_data(request):
             record = TongHopTaiChinh.objects.create(
                 congTy=congty, nam=nam, quy=quy
             )
+            bump_data_version()  # TongSoNamThuThap thay đổi
             return JsonResponse({
                 "message": f"Đã tạo mới báo cáo cho {ma_cty} năm {nam}, quý {quy}"
             })
@@ -250,45 +393,10 @@ def post_bangcandoiketoan_data(request):
         # TRƯỜNG HỢP 1: DỮ LIỆU HÀNG LOẠT (TỪ FILE CSV)
         # ==========================================================
         if isinstance(data, list):
-            bcdt_to_create = []
-            errors = []
-
-            for index, item in enumerate(data):
-                try:
-                    ma_chung_khoan = item.get('ma')
-                    nam = item.get('years')
-                    quy = item.get('quy')
-                    
-                    if not ma_chung_khoan or nam is None or quy is None:
-                        errors.append(f"Dòng {index + 1}: Thiếu 'ma', 'years', hoặc 'quy'. Bỏ qua.")
-                        continue
-
-                    # 1. Lấy hoặc tạo CongTy
-                    cong_ty_instance, _ = CongTy.objects.get_or_create(
-                        maChungKhoan=ma_chung_khoan.upper(),
-                        defaults={'tenCongTy': f"Công ty {ma_chung_khoan.upper()}"}
-                    )
-                    # 2. Lấy hoặc tạo TongHopTaiChinh
-                    tong_hop_instance, _ = TongHopTaiChinh.objects.get_or_create(
-                        congTy=cong_ty_instance,
-                        nam=nam,
-                        quy=quy
-                    )
-                    
-                    item.pop('ma', None); item.pop('years', None); item.pop('quy', None)
-
-                    # 3. Chuẩn bị đối tượng (chưa lưu)
-                    bcdt_object = BangCanDoiKeToan(baoCao=tong_hop_instance, **item)
-                    bcdt_to_create.append(bcdt_object)
-                
-                except Exception as e:
-                    errors.append(f"Dòng {index + 1} (Mã: {item.get('ma')}): Lỗi - {str(e)}")
+            # Ghi theo tập hợp: vài query cho cả file thay vì get_or_create từng dòng
+            saved_count, errors = ingest_statement_rows(BangCanDoiKeToan, data)
 
-            # 4. Lưu hàng loạt
-            if bcdt_to_create:
-                BangCanDoiKeToan.objects.bulk_create(bcdt_to_create, ignore_conflicts=True)
-            
-            message = f"Hoàn tất xử lý HÀNG LOẠT! Đã gửi {len(bcdt_to_create)} bản ghi. Lỗi: {len(errors)}."
+            message = f"Hoàn tất xử lý HÀNG LOẠT! Đã ghi {saved_count} bản ghi. Lỗi: {len(errors)}."
             return JsonResponse({'message': message, 'errors': errors}, status=200)
 
         # ==========================================================
@@ -316,6 +424,9 @@ def post_bangcandoiketoan_data(request):
                 baoCao=tong_hop_instance,
                 defaults=data
             )
+            affected_pairs = statement_ratio_pairs(tong_hop_instance.congTy_id, tong_hop_instance.nam)
+            refresh_financial_ratios(affected_pairs)
+            refresh_market_stats({nam for _, nam in affected_pairs})
             
             message = "Đã TẠO MỚI" if created else "Đã CẬP NHẬT"
             status_code = 201 if created else 200
@@ -340,45 +451,10 @@ def post_bangketquakinhdoanh_data(request):
         # TRƯỜNG HỢP 1: DỮ LIỆU HÀNG LOẠT (TỪ FILE CSV)
         # ==========================================================
         if isinstance(data, list):
-            kqkd_to_create = []
-            errors = []
-
-            for index, item in enumerate(data):
-                try:
-                    ma_chung_khoan = item.get('ma')
-                    nam = item.get('years')
-                    quy = item.get('quy')
-                    
-                    if not ma_chung_khoan or nam is None or quy is None:
-                        errors.append(f"Dòng {index + 1}: Thiếu 'ma', 'years', hoặc 'quy'. Bỏ qua.")
-                        continue
-
-                    # 1. Lấy hoặc tạo CongTy
-                    cong_ty_instance, _ = CongTy.objects.get_or_create(
-                        maChungKhoan=ma_chung_khoan.upper(),
-                        defaults={'tenCongTy': f"Công ty {ma_chung_khoan.upper()}"}
-                    )
-                    # 2. Lấy hoặc tạo TongHopTaiChinh
-                    tong_hop_instance, _ = TongHopTaiChinh.objects.get_or_create(
-                        congTy=cong_ty_instance,
-                        nam=nam,
-                        quy=quy
-                    )
-                    
-                    item.pop('ma', None); item.pop('years', None); item.pop('quy', None)
-
-                    # 3. Chuẩn bị đối tượng (chưa lưu)
-                    kqkd_object = BangKetQuaKinhDoanh(baoCao=tong_hop_instance, **item)
-                    kqkd_to_create.append(kqkd_object)
-                
-                except Exception as e:
-                    errors.append(f"Dòng {index + 1} (Mã: {item.get('ma')}): Lỗi - {str(e)}")
+            # Ghi theo tập hợp: vài query cho cả file thay vì get_or_create từng dòng
+            saved_count, errors = ingest_statement_rows(BangKetQuaKinhDoanh, data)
 
-            # 4. Lưu hàng loạt
-            if kqkd_to_create:
-                BangKetQuaKinhDoanh.objects.bulk_create(kqkd_to_create, ignore_conflicts=True)
-            
-            message = f"Hoàn tất xử lý HÀNG LOẠT! Đã gửi {len(kqkd_to_create)} bản ghi KQKD. Lỗi: {len(errors)}."
+            message = f"Hoàn tất xử lý HÀNG LOẠT! Đã ghi {saved_count} bản ghi KQKD. Lỗi: {len(errors)}."
             return JsonResponse({'message': message, 'errors': errors}, status=200)
 
         # ==========================================================
@@ -407,6 +483,9 @@ def post_bangketquakinhdoanh_data(request):
                 baoCao=tong_hop_instance,
                 defaults=data
             )
+            affected_pairs = statement_ratio_pairs(tong_hop_instance.congTy_id, tong_hop_instance.nam)
+            refresh_financial_ratios(affected_pairs)
+            refresh_market_stats({nam for _, nam in affected_pairs})
             
             message = "Đã TẠO MỚI" if created else "Đã CẬP NHẬT"
             status_code = 201 if created else 200
@@ -504,6 +583,16 @@ def retrieve_bangcandoikt(request):
 
 # chatbot/views.py
 
+def chat_metrics_view(request):
+    """
+    Số liệu hàng đợi Gemini (đang chạy, đang chờ, thời gian chờ...) và cache câu trả lời
+    của tiến trình hiện tại.
+    """
+    metrics = gemini_limiter.metrics()
+    metrics["answer_cache"] = answer_cache.metrics()
+    return JsonResponse(metrics)
+
+
 @require_POST # Chỉ cho phép phương thức POST
 def save_message_view(request):
     """
@@ -583,14 +672,28 @@ def safe_divide(numerator, denominator):
 
 
 
-# View API JSON cũ (được rút gọn)
-def calculate_financial_ratios_view(request):
+def _build_financial_ratios_json():
     data = get_financial_ratios_data()
-    if data is None:
-        return JsonResponse({"error": "Không có dữ liệu báo cáo tài chính"}, status=404)
-    
-    # update_financial_ratios_sheet(data) # Uncomment nếu cần update Google Sheet
-    return JsonResponse(data, safe=False, json_dumps_params={'indent': 2, 'ensure_ascii': False})
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+# View API JSON (phục vụ chart.js, chart_hieu_suat.js, table.js, chatbot /report)
+def calculate_financial_ratios_view(request):
+    # Payload đã serialize + gzip sẵn theo phiên bản dữ liệu -> không chạm DB khi cache còn hiệu lực
+    payload = get_cached_payload('financial_ratios', _build_financial_ratios_json)
+
+    if etag_matches(request, payload.etag):
+        response = HttpResponseNotModified()
+    elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = HttpResponse(payload.gzipped, content_type='application/json; charset=utf-8')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(payload.raw, content_type='application/json; charset=utf-8')
+
+    response['ETag'] = payload.etag
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = 'no-cache'  # Trình duyệt luôn hỏi lại bằng If-None-Match
+    return response
 
 
 # View API JSON cũ (được rút gọn)